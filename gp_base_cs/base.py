@@ -1,9 +1,11 @@
 import copy
-from typing import Dict
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Tuple
 
+from deap.gp import MetaEphemeral, Terminal
 from expr_codegen.codes import sources_to_exprs
 from loguru import logger
-from sympy import Basic, Function, symbols, preorder_traversal
+from sympy import Add, Basic, Function, FunctionClass, Mul, Pow, Symbol, symbols, sympify, preorder_traversal
 
 
 def convert_inverse_prim(prim, args):
@@ -52,6 +54,66 @@ def stringify_for_sympy(f):
     return string
 
 
+# 与convert_inverse_prim一致，只是直接生成sympy对象
+_SYMPY_CONVERTER = {
+    'sub': lambda a, b: Add(a, Mul(-1, b)),
+    'div': lambda a, b: Mul(a, Pow(b, -1)),
+    'mul': lambda a, b: Mul(a, b),
+    'add': lambda a, b: Add(a, b),
+    'max': lambda a, b: Function('max_')(a, b),
+    'min': lambda a, b: Function('min_')(a, b),
+}
+# 跨代共享的子树缓存。子代与父代大量子树相同，不必重新构造。超出上限时淘汰最久未用的子树
+_SYMPY_MEMO = OrderedDict()
+_SYMPY_MEMO_MAX = 1000000
+
+
+def tree_to_sympy(f, globals_, memo=None):
+    """PrimitiveTree直接转sympy表达式，不经过字符串解析
+
+    memo: 子树缓存，(算子名, *参数) -> sympy表达式。相同的子树只构造一次。None表示使用跨代共享的LRU缓存
+    """
+    lru = memo is None
+    if lru:
+        memo = _SYMPY_MEMO
+    expr = None
+    stack = []
+    for node in f:
+        stack.append((node, []))
+        while len(stack[-1][1]) == stack[-1][0].arity:
+            prim, args = stack.pop()
+            if isinstance(prim, Terminal):
+                if isinstance(prim.value, str):
+                    expr = globals_.get(prim.value, None)
+                    if not isinstance(expr, Basic):
+                        expr = Symbol(prim.value)
+                else:
+                    # 随机常量
+                    expr = sympify(prim.value)
+            else:
+                key = (prim.name, *args)
+                expr = memo.get(key, None)
+                if expr is None:
+                    name = prim.name
+                    if name[:3] in ('oo_', 'oi_', 'io_', 'of_', 'fo_') and name[3:] in _SYMPY_CONVERTER:
+                        expr = _SYMPY_CONVERTER[name[3:]](*args)
+                    else:
+                        func = globals_.get(name, None)
+                        if not isinstance(func, FunctionClass):
+                            func = Function(name)
+                        expr = func(*args)
+                    memo[key] = expr
+                elif lru:
+                    memo.move_to_end(key)
+            if len(stack) == 0:
+                break  # If stack is empty, all nodes should have been seen
+            stack[-1][1].append(expr)
+    if lru:
+        while len(memo) > _SYMPY_MEMO_MAX:
+            memo.popitem(last=False)
+    return expr
+
+
 def get_node_name(node):
     """得到节点名"""
     if hasattr(node, 'name'):
@@ -185,6 +247,127 @@ def _meaningless__xx_xx(e):
     return False
 
 
+def input_columns(pset, label: str) -> List[str]:
+    """GP实际用到的数据字段，即add_factors中注册的因子加上标签"""
+    columns = []
+    for terminals in pset.terminals.values():
+        for t in terminals:
+            # 跳过随机常量
+            if isinstance(t, MetaEphemeral) or not t.name.isidentifier():
+                continue
+            if t.name not in columns:
+                columns.append(t.name)
+    if label not in columns:
+        columns.append(label)
+    return columns
+
+
+# f(-x) = -f(x)
+ODD_FUNCS = ('ts_delay', 'ts_delta', 'ts_sum', 'ts_mean', 'ts_zscore')
+# f(-x) = f(x)
+EVEN_FUNCS = ('ts_std_dev', 'abs_')
+# 参数可交换
+COMMUTATIVE_FUNCS = ('max_', 'min_')
+
+
+def _fold_sign(e):
+    """自底向上，交换参数排序，负号提到奇函数外，偶函数内的负号直接去掉"""
+    if not isinstance(e, Basic) or e.is_Atom:
+        return e
+    args = [_fold_sign(a) for a in e.args]
+    name = get_node_name(e)
+    if name in COMMUTATIVE_FUNCS:
+        args = sorted(args, key=str)
+    if len(args) > 0 and args[0].could_extract_minus_sign():
+        if name in ODD_FUNCS:
+            return -e.func(-args[0], *args[1:])
+        if name in EVEN_FUNCS:
+            args[0] = -args[0]
+    return e.func(*args)
+
+
+def canonical_expr(e, monotone_funcs: Sequence[str] = ()) -> Tuple[Basic, int]:
+    """等价类的代表表达式
+
+    sympy已处理加法乘法的交换律，这里再处理
+    1. `max_`等函数的交换律
+    2. 负号折叠，如`ts_mean(-x, 5)`与`-ts_mean(x, 5)`
+    3. 根节点上的正比例缩放与平移，如`2*x+1`与`x`的IC相同，`-x`的IC相反
+    4. 根节点上的保序变换，如`cs_rank(x)`与`x`的RankIC相同
+
+    Parameters
+    ----------
+    e:
+        sympy表达式
+    monotone_funcs:
+        不改变适应度的单参数保序算子，由所用的适应度模块提供，见`gp_base_cs.helper.MONOTONE_FUNCS`。
+        只对横截面RankIC成立，时序Pearson IC应为空
+
+    Returns
+    -------
+    canonical:
+        代表表达式。不会退化成单元素
+    sign:
+        1或-1。原表达式的适应度 = sign * 代表表达式的适应度
+
+    """
+    if not isinstance(e, Basic):
+        return e, 1
+    e = _fold_sign(e)
+    sign = 1
+    while not e.is_Atom:
+        s = 1
+        if get_node_name(e) in monotone_funcs and len(e.args) == 1:
+            inner = e.args[0]
+        elif e.is_Mul and any(a.is_Number for a in e.args):
+            coeff, inner = e.as_coeff_Mul()
+            if coeff == 0:
+                break
+            s = 1 if coeff > 0 else -1
+        elif e.is_Add and any(a.is_Number for a in e.args):
+            inner = Add(*[a for a in e.args if not a.is_Number])
+        elif e.could_extract_minus_sign():
+            inner, s = -e, -1
+        else:
+            break
+        if inner.is_Atom:
+            break
+        e, sign = inner, sign * s
+    return e, sign
+
+
+def share_fitness(exprs_list, fitness_results, monotone_funcs: Sequence[str] = ()) -> int:
+    """同一等价类共享适应度
+
+    已有适应度的表达式，将适应度换算后登记到代表表达式下；
+    没有适应度的表达式，如果代表表达式已有适应度，直接换算得到。IC与IR都随符号取反
+
+    monotone_funcs: 见`canonical_expr`
+
+    Returns
+    -------
+    int
+        新得到适应度的表达式数
+
+    """
+    classes = []
+    for k, v, c in exprs_list:
+        canonical, sign = canonical_expr(v, monotone_funcs)
+        name, key = str(v), str(canonical)
+        d = fitness_results.get(name, None)
+        if d is not None and key not in fitness_results:
+            fitness_results[key] = {m: sign * x for m, x in d.items()}
+        classes.append((name, key, sign))
+
+    count = 0
+    for name, key, sign in classes:
+        if name in fitness_results or key not in fitness_results:
+            continue
+        fitness_results[name] = {m: sign * x for m, x in fitness_results[key].items()}
+        count += 1
+    return count
+
+
 def get_fitness(name: str, kv: Dict[str, float]) -> float:
     return kv.get(name, False) or float('nan')
 
@@ -207,9 +390,8 @@ def population_to_exprs(population, globals_):
     """群体转表达式"""
     if len(population) == 0:
         return {}
-    sources = [f'GP_{i:04d}={stringify_for_sympy(expr)}' for i, expr in enumerate(population)]
-    # sources.insert(0, 'GP_000=1') # DEBUG
-    raw, exprs_list = sources_to_exprs(globals_, '\n'.join(sources), convert_xor=False)
+    # 直接构造sympy对象，比拼成源代码再解析快得多
+    exprs_list = [(f'GP_{i:04d}', tree_to_sympy(expr, globals_), '#') for i, expr in enumerate(population)]
     return exprs_list
 
 
@@ -223,7 +405,12 @@ def strings_to_sympy(population, globals_):
     return exprs_list
 
 
-def filter_exprs(exprs_list, pset, RET_TYPE, fitness_results):
+def filter_exprs(exprs_list, pset, RET_TYPE, fitness_results, max_cost=None, rows=1, monotone_funcs: Sequence[str] = ()):
+    """剔除重复、非法、无意义、已计算过的表达式
+
+    max_cost: 单条表达式`expr_cost(v, rows)`的上限，超出的不参与计算，适应度为NaN。None表示不限制
+    monotone_funcs: 判断等价表达式时用，见`canonical_expr`
+    """
     before_len = len(exprs_list)
     # 清理重复表达式，通过字典特性删除
     exprs_list = {v: (k, v, c) for k, v, c in exprs_list}
@@ -235,9 +422,256 @@ def filter_exprs(exprs_list, pset, RET_TYPE, fitness_results):
     after_len = len(exprs_list)
     logger.info('剔除重复、非法、无意义表达式，数量由 {} -> {}', before_len, after_len)
 
-    # 历史表达式不再重复计算
+    # 历史表达式不再重复计算，等价类已计算过的也一样
     before_len = len(exprs_list)
+    share_fitness(exprs_list, fitness_results, monotone_funcs)
     exprs_list = [(k, v, c) for k, v, c in exprs_list if str(v) not in fitness_results]
     after_len = len(exprs_list)
     logger.info('剔除历史已经计算过适应度的表达式，数量由 {} -> {}', before_len, after_len)
+
+    # 同一等价类只计算一条，算完后由share_fitness共享
+    before_len = len(exprs_list)
+    exprs_list = {str(canonical_expr(v, monotone_funcs)[0]): (k, v, c) for k, v, c in reversed(exprs_list)}
+    exprs_list = list(reversed(exprs_list.values()))
+    after_len = len(exprs_list)
+    logger.info('剔除等价表达式，数量由 {} -> {}', before_len, after_len)
+
+    if max_cost is not None:
+        before_len = len(exprs_list)
+        exprs_list = [(k, v, c) for k, v, c in exprs_list if expr_cost(v, rows) <= max_cost]
+        after_len = len(exprs_list)
+        logger.info('剔除计算量超出预算的表达式，数量由 {} -> {}', before_len, after_len)
     return exprs_list
+
+
+def _subtrees(e) -> set:
+    """表达式中所有非叶子节点的子树"""
+    if not isinstance(e, Basic):
+        return set()
+    return {str(node) for node in preorder_traversal(e) if not node.is_Atom}
+
+
+def _node_kind(node) -> str:
+    """算子类别。ts_/cs_ 之外的都算作cl"""
+    if node.is_Function:
+        name = get_node_name(node)
+        if name.startswith('ts_'):
+            return 'ts'
+        if name.startswith('cs_'):
+            return 'cs'
+    return 'cl'
+
+
+def _columns(e) -> set:
+    """估计表达式在生成代码中需要落地的列
+
+    `expr_codegen`按ts/cs/cl分组，同组内嵌套的算子合并成一个polars表达式，
+    只有跨组的子树才会生成`_x_`中间列。这里输出列本身也算一列
+    """
+    if not isinstance(e, Basic) or e.is_Atom:
+        return set()
+    columns = {str(e)}
+    tops = []
+    # (节点, 最近的ts/cs祖先类别)
+    stack = [(e, None)]
+    while stack:
+        node, parent = stack.pop()
+        kind = _node_kind(node)
+        if kind != 'cl':
+            if parent is None:
+                tops.append(node)
+            elif parent != kind:
+                columns.add(str(node))
+            parent = kind
+        stack.extend((arg, parent) for arg in node.args if not arg.is_Atom)
+    # 顶层出现了多种类别，只能在cl组中合并，每个顶层子树都要单独落地
+    if len({_node_kind(n) for n in tops}) > 1:
+        columns.update(str(n) for n in tops if n is not e)
+    return columns
+
+
+def peak_columns(G) -> int:
+    """根据codegen输出的DAG估计执行时的列数峰值
+
+    输出列一直保留到最后，`_x_`中间列在最后一个使用它的层计算完后被删除
+    """
+    outputs = 0
+    lives = []
+    for node, data in G.nodes(data=True):
+        gen = int(data.get('gen', 0))
+        if gen == 0:
+            # 输入字段与常数
+            continue
+        if not str(node).startswith('_'):
+            outputs += 1
+            continue
+        last = max([int(G.nodes[n].get('gen', gen)) for n in G.successors(node)], default=gen)
+        lives.append((gen, last))
+    if len(lives) == 0:
+        return outputs
+    gens = range(min(a for a, b in lives), max(b for a, b in lives) + 1)
+    return outputs + max(sum(1 for a, b in lives if a <= g <= b) for g in gens)
+
+
+def plan_batches(exprs_list, batch_size: int, max_columns: int = None):
+    """按公共子树对表达式分批
+
+    `more_itertools.batched`按到达顺序分批，公共子表达式只能在一批内消除。
+    这里贪心地把共享子树最多的表达式放在同一批，减少每代的算子计算总次数
+
+    Parameters
+    ----------
+    exprs_list
+        [(k, v, c), ...]
+    batch_size: int
+        每批最多多少条表达式。None表示不限制
+    max_columns: int
+        每批最多新增多少列，含输出列与中间列，由内存预算换算而来。None表示不限制
+
+    Returns
+    -------
+    list
+        分好的批，每批是exprs_list的子列表
+
+    """
+    if len(exprs_list) == 0:
+        return []
+
+    trees = [_subtrees(v) for k, v, c in exprs_list]
+    columns = [_columns(v) for k, v, c in exprs_list]
+    # 子树 -> 含有它的表达式
+    index = {}
+    for i, t in enumerate(trees):
+        for s in t:
+            index.setdefault(s, []).append(i)
+
+    # 大的表达式先作为种子，后面的更容易与它共享
+    remaining = set(range(len(exprs_list)))
+    seeds = sorted(remaining, key=lambda x: len(trees[x]), reverse=True)
+
+    if batch_size is None:
+        batch_size = len(exprs_list)
+
+    batches = []
+    while len(remaining) > 0:
+        batch = []
+        nodes = set()
+        cols = set()
+        gain = {}
+
+        def add(i):
+            batch.append(i)
+            remaining.discard(i)
+            gain.pop(i, None)
+            for s in trees[i] - nodes:
+                # 新出现的子树，其它还没分配的表达式与本批的共享度都增加
+                for j in index[s]:
+                    if j in remaining:
+                        gain[j] = gain.get(j, 0) + 1
+            nodes.update(trees[i])
+            cols.update(columns[i])
+
+        add(next(i for i in seeds if i in remaining))
+        while len(batch) < batch_size and len(remaining) > 0:
+            if len(gain) > 0:
+                # 共享最多，新增最少
+                i = max(gain, key=lambda x: (gain[x], -len(trees[x])))
+            else:
+                i = next(i for i in seeds if i in remaining)
+            if max_columns is not None and len(cols | columns[i]) > max_columns:
+                break
+            add(i)
+        batches.append(batch)
+
+    def count(bs):
+        return sum(len(set().union(*[trees[i] for i in b])) for b in bs)
+
+    # 与按到达顺序分批对比
+    before = count([range(i, min(i + batch_size, len(trees))) for i in range(0, len(trees), batch_size)])
+    logger.info('表达式按公共子树分批，共 {} 批，每批 {} 条，算子数由 {} -> {}', len(batches), [len(b) for b in batches], before, count(batches))
+    return [[exprs_list[i] for i in b] for b in batches]
+
+
+# 算子的相对计算成本，未列出的按1计。时序算子还要再乘以窗口大小
+# TODO 可根据实测耗时调整，`custom.py`中注释掉的慢算子启用前最好先在这里登记
+OP_COST = {
+    'ts_rank': 4,
+    'ts_arg_max': 4,
+    'ts_arg_min': 4,
+    'ts_decay_linear': 4,
+    'ts_product': 2,
+    'ts_corr': 8,
+    'ts_covariance': 8,
+    'cs_rank': 2,
+    'cs_zscore': 2,
+    'cs_scale': 2,
+}
+
+
+def expr_cost(e, rows: int = 1) -> float:
+    """静态估计表达式的计算量，用于任务调度与超预算剔除
+
+    每个算子节点计`OP_COST`，时序算子再乘以窗口大小，最后乘以数据行数
+    """
+    if not isinstance(e, Basic):
+        return 0
+    cost = 0
+    for node in preorder_traversal(e):
+        if not node.is_Function:
+            continue
+        name = get_node_name(node)
+        window = 1
+        if name.startswith('ts_'):
+            window = max([int(a) for a in node.args if a.is_Integer], default=1)
+        cost += OP_COST.get(name, 1) * window
+    return cost * rows
+
+
+def plan_tasks(exprs_list, n_workers: int, batch_size: int = None, max_columns: int = None, tasks_per_worker: int = 4):
+    """将表达式切成许多小任务，供空闲的worker动态领取
+
+    固定分几批时，最慢的一批决定了整代的用时(木桶效应)。
+    这里先按公共子树分批，再将每批按估计的计算量切成小任务，
+    任务数约为worker数的`tasks_per_worker`倍，计算量大的任务排在前面先发出
+
+    Parameters
+    ----------
+    exprs_list
+        [(k, v, c), ...]
+    n_workers: int
+        worker数
+    batch_size: int
+        见`plan_batches`
+    max_columns: int
+        见`plan_batches`
+    tasks_per_worker: int
+        平均每个worker分到多少个任务
+
+    Returns
+    -------
+    list
+        任务列表，每个任务是exprs_list的子列表，按估计计算量从大到小排列
+
+    """
+    if len(exprs_list) == 0:
+        return []
+
+    costs = {k: expr_cost(v) for k, v, c in exprs_list}
+    target = sum(costs.values()) / max(n_workers * tasks_per_worker, 1)
+
+    tasks = []
+    # 同一批内相邻的表达式共享子树多，按顺序切分
+    for batch in plan_batches(exprs_list, batch_size, max_columns):
+        task, total = [], 0
+        for kvc in batch:
+            if len(task) > 0 and total + costs[kvc[0]] > target:
+                tasks.append((total, task))
+                task, total = [], 0
+            task.append(kvc)
+            total += costs[kvc[0]]
+        if len(task) > 0:
+            tasks.append((total, task))
+
+    tasks.sort(key=lambda x: x[0], reverse=True)
+    logger.info('表达式切分成 {} 个任务，估计计算量 最大 {}，最小 {}', len(tasks), tasks[0][0], tasks[-1][0])
+    return [t for _, t in tasks]
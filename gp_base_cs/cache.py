@@ -0,0 +1,170 @@
+"""
+跨批次、跨代的子表达式结果缓存
+
+遗传编程中子代与父代共享大量子树，如`ts_mean(CLOSE, 20)`可能出现在几十个个体中。
+`expr_codegen`的公共子表达式消除只在同一批内有效，批与批、代与代之间还是会从原始字段重新计算。
+
+这里将热门子树的计算结果以列的形式缓存下来
+1. 键为`sympy`子树的字符串形式，与`fitness_cache.pkl`的键规则一致
+2. 值为按`df_input`行顺序对齐的`pl.Series`
+3. 总内存超过`max_bytes`时按LRU淘汰
+
+计算前，表达式中已缓存的子树被替换成`CACHE_xxxxxx`符号，对应列直接并入输入数据，codegen生成的代码就不会再计算它们
+"""
+from collections import Counter, OrderedDict
+from typing import Dict, List, Tuple
+
+import polars as pl
+from sympy import Basic, Symbol, preorder_traversal
+
+from gp_base_cs.base import get_node_name
+
+# 输入数据追加的行号，用于将输出结果还原成输入的行顺序
+ROW_INDEX = 'CACHE_INDEX'
+
+
+def is_cacheable(node) -> bool:
+    """只缓存含时序或横截面算子的子树，四则运算等重算成本低，不值得占用内存"""
+    if not isinstance(node, Basic) or node.is_Atom:
+        return False
+    for n in preorder_traversal(node):
+        if n.is_Function and get_node_name(n).startswith(('ts_', 'cs_')):
+            return True
+    return False
+
+
+class ColumnCache:
+    """子表达式列缓存。LRU淘汰，内存有上限
+
+    Parameters
+    ----------
+    max_bytes: int
+        缓存列的总内存上限
+    min_hits: int
+        子树累计出现多少次后才开始缓存
+    max_new: int
+        每批最多新缓存多少条子树，防止一批输出列过多
+    max_keys: int
+        热度计数器最多记录多少条子树
+
+    """
+
+    def __init__(self, max_bytes: int = 4 * 1024 ** 3, min_hits: int = 2, max_new: int = 20, max_keys: int = 100000):
+        self.max_bytes = max_bytes
+        self.min_hits = min_hits
+        self.max_new = max_new
+        self.max_keys = max_keys
+
+        self.columns: OrderedDict[str, Tuple[str, pl.Series]] = OrderedDict()
+        self.hits: Counter = Counter()
+        self.nbytes = 0
+        self.height = None
+        self._next_id = 0
+        # 命中统计
+        self.lookups = 0
+        self.found = 0
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __contains__(self, key: str):
+        return key in self.columns
+
+    def clear(self):
+        self.columns.clear()
+        self.hits.clear()
+        self.nbytes = 0
+
+    def _new_name(self) -> str:
+        name = f'CACHE_{self._next_id:06d}'
+        self._next_id += 1
+        return name
+
+    def _count(self, exprs_list) -> None:
+        """统计每条可缓存子树在本批中出现的表达式数"""
+        for k, v, c in exprs_list:
+            if not isinstance(v, Basic):
+                continue
+            self.hits.update({str(n) for n in preorder_traversal(v) if is_cacheable(n)})
+
+        if len(self.hits) > self.max_keys:
+            # 只保留热门的一半
+            self.hits = Counter(dict(self.hits.most_common(self.max_keys // 2)))
+
+    def prepare(self, exprs_list, df_input: pl.DataFrame, count: bool = True) -> Tuple[List, pl.DataFrame, Dict[str, str]]:
+        """计算前调用。替换已缓存子树，追加待缓存子树
+
+        count: 是否累计子树热度与命中次数。同一批表达式拆分后重新调用时为False，每条表达式只计一次
+
+        Returns
+        -------
+        exprs_list:
+            替换后的表达式，尾部追加了待缓存的子树表达式
+        df_input:
+            并入了缓存列和行号的输入数据
+        pending:
+            待缓存的列名 -> 子树键
+
+        """
+        if self.height != df_input.height:
+            # 数据变了，缓存全部作废
+            self.clear()
+            self.height = df_input.height
+
+        if count:
+            self._count(exprs_list)
+
+        used: Dict[str, Tuple[str, pl.Series]] = {}
+        candidates: Dict[str, Basic] = {}
+        mapping = {}
+        for k, v, c in exprs_list:
+            if not isinstance(v, Basic):
+                continue
+            tree = preorder_traversal(v)
+            for n in tree:
+                if not is_cacheable(n):
+                    continue
+                key = str(n)
+                self.lookups += count
+                if key in self.columns:
+                    self.found += count
+                    self.columns.move_to_end(key)
+                    used[key] = self.columns[key]
+                    mapping[n] = Symbol(used[key][0])
+                    # 整棵子树都已缓存，内层不必再看
+                    tree.skip()
+                elif self.hits[key] >= self.min_hits:
+                    candidates[key] = n
+        exprs_list = [(k, v.xreplace(mapping) if isinstance(v, Basic) else v, c) for k, v, c in exprs_list]
+
+        # 热门的优先缓存
+        pending = {}
+        extra = []
+        for key in sorted(candidates, key=lambda x: self.hits[x], reverse=True)[:self.max_new]:
+            name = self._new_name()
+            pending[name] = key
+            extra.append((name, candidates[key].xreplace(mapping), '#'))
+
+        if len(used) > 0 or len(pending) > 0:
+            df_input = df_input.with_row_index(ROW_INDEX).with_columns([s.alias(name) for name, s in used.values()])
+
+        return exprs_list + extra, df_input, pending
+
+    def update(self, df_output: pl.DataFrame, pending: Dict[str, str]) -> None:
+        """计算后调用。将待缓存子树的结果按输入行顺序存入缓存"""
+        if df_output is None or len(pending) == 0:
+            return
+
+        df = df_output.select(ROW_INDEX, *pending.keys()).sort(ROW_INDEX)
+        for name, key in pending.items():
+            s = df.get_column(name)
+            self.columns[key] = (name, s)
+            self.nbytes += s.estimated_size()
+
+        while self.nbytes > self.max_bytes and len(self.columns) > 0:
+            key, (name, s) = self.columns.popitem(last=False)
+            self.nbytes -= s.estimated_size()
+
+    @property
+    def hit_rate(self) -> float:
+        return self.found / self.lookups if self.lookups > 0 else float('nan')
@@ -98,9 +98,59 @@ gp.generate = generate
 所以决定开始遇到nan时就不插入
 
 https://github.com/DEAP/deap/issues/440#issuecomment-561046939
+
+名人堂很大时，逐个调用similar比较是O(pop*hof)。默认similar为operator.eq，
+这时另外维护一份字符串计数作为哈希索引，查重为O(1)
 """
+import operator
+from collections import Counter
+
 from deap.tools.support import HallOfFame
 
+_hof_insert = HallOfFame.insert
+_hof_remove = HallOfFame.remove
+_hof_clear = HallOfFame.clear
+
+
+def _hof_index(self):
+    """字符串 -> 个数。旧版本保存的名人堂没有索引，第一次用时补建"""
+    index = self.__dict__.get('_index', None)
+    if index is None:
+        index = self._index = Counter(str(i) for i in self.items)
+    return index
+
+
+def insert(self, item):
+    # 先补建索引再插入，否则补建时已包含item，会重复计数
+    counter = _hof_index(self)
+    _hof_insert(self, item)
+    counter[str(item)] += 1
+
+
+def remove(self, index):
+    counter = _hof_index(self)
+    key = str(self[index])
+    _hof_remove(self, index)
+    counter[key] -= 1
+    if counter[key] <= 0:
+        del counter[key]
+
+
+def clear(self):
+    _hof_clear(self)
+    self._index = Counter()
+
+
+def _similar_exists(self, ind):
+    if self.similar is operator.eq:
+        return str(ind) in _hof_index(self)
+    for hofer in self:
+        # Loop through the hall of fame to check for any
+        # similar individual
+        if self.similar(ind, hofer):
+            return True
+    return False
+
 
 def update(self, population):
     """Update the hall of fame with the *population* by replacing the
@@ -122,12 +172,7 @@ def update(self, population):
             self.insert(ind)
             continue
         if ind.fitness > self[-1].fitness or len(self) < self.maxsize:
-            for hofer in self:
-                # Loop through the hall of fame to check for any
-                # similar individual
-                if self.similar(ind, hofer):
-                    break
-            else:
+            if not _similar_exists(self, ind):
                 # The individual is unique and strictly better than
                 # the worst
                 if len(self) >= self.maxsize:
@@ -137,6 +182,9 @@ def update(self, population):
 
 # 打补丁，fitness为nan时不插入
 HallOfFame.update = update
+HallOfFame.insert = insert
+HallOfFame.remove = remove
+HallOfFame.clear = clear
 # ============================================
 """
 在选择精英时，比如selTournament时，3选1，如[1,2, nan]，会选出nan,所以需要进行定制
@@ -159,15 +207,52 @@ Fitness.__gt__ = __gt__
 Fitness.__ge__ = __ge__
 
 # ===============================================
+import os
+import pickle
+
 import numpy as np
 from deap import tools
 from deap.algorithms import varOr, varAnd  # noqa
+from loguru import logger
 from tensorboardX import SummaryWriter
 
 
+def save_checkpoint(path, **state):
+    """保存进化状态。先写临时文件再改名，中途崩溃也不会损坏旧的检查点"""
+    state['random'] = random.getstate()
+    state['numpy'] = np.random.get_state()
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path):
+    """读取进化状态，返回字典，gen为已完成的代数"""
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _resume(resume_from, halloffame):
+    """恢复随机数状态与名人堂，返回检查点
+
+    resume_from: 检查点路径，或`load_checkpoint`已读出的字典
+    """
+    state = resume_from if isinstance(resume_from, dict) else load_checkpoint(resume_from)
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    if halloffame is not None and state['halloffame'] is not None:
+        halloffame.__dict__.update(state['halloffame'].__dict__)
+    logger.info('从第{}代的检查点继续', state['gen'])
+    return state
+
+
 def eaMuPlusLambda(population, toolbox, mu, lambda_, cxpb, mutpb, ngen,
                    stats=None, halloffame=None, verbose=__debug__,
-                   early_stopping_rounds=10):
+                   early_stopping_rounds=10,
+                   checkpoint=None, checkpoint_interval=1, resume_from=None, writer=None):
     r"""This is the :math:`(\mu + \lambda)` evolutionary algorithm.
 
     :param population: A list of individuals.
@@ -183,6 +268,9 @@ def eaMuPlusLambda(population, toolbox, mu, lambda_, cxpb, mutpb, ngen,
     :param halloffame: A :class:`~deap.tools.HallOfFame` object that will
                        contain the best individuals, optional.
     :param verbose: Whether or not to log the statistics.
+    :param checkpoint: 检查点文件路径，每`checkpoint_interval`代保存一次种群、日志、名人堂和随机数状态。None表示不保存
+    :param resume_from: 从检查点继续，跳过已完成的代。检查点路径或`load_checkpoint`读出的字典，None表示从头开始
+    :param writer: tensorboardX的SummaryWriter，可与性能记录共用。None表示新建，结束时关闭
     :returns: The final population
     :returns: A class:`~deap.tools.Logbook` with the statistics of the
               evolution.
@@ -214,32 +302,49 @@ def eaMuPlusLambda(population, toolbox, mu, lambda_, cxpb, mutpb, ngen,
     registered in the toolbox. This algorithm uses the :func:`varOr`
     variation.
     """
-    logbook = tools.Logbook()
-    logbook.header = ['gen', 'nevals'] + (stats.fields if stats else [])
+    # 新添
+    close_writer = writer is None
+    if close_writer:
+        writer = SummaryWriter()
+
+    if resume_from is not None:
+        state = _resume(resume_from, halloffame)
+        if 'population' in state:
+            population[:] = state['population']
+        else:
+            # 岛屿模型的检查点，合并各岛
+            population[:] = [ind for island in state['islands'] for ind in island]
+        logbook = state['logbook']
+        start_gen = state['gen'] + 1
+    else:
+        logbook = tools.Logbook()
+        logbook.header = ['gen', 'nevals'] + (stats.fields if stats else [])
 
-    # Evaluate the individuals with an invalid fitness
-    invalid_ind = [ind for ind in population if not ind.fitness.valid]
-    fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
-    for ind, fit in zip(invalid_ind, fitnesses):
-        ind.fitness.values = fit
+        # Evaluate the individuals with an invalid fitness
+        invalid_ind = [ind for ind in population if not ind.fitness.valid]
+        fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
+        for ind, fit in zip(invalid_ind, fitnesses):
+            ind.fitness.values = fit
 
-    if halloffame is not None:
-        halloffame.update(population)
+        if halloffame is not None:
+            halloffame.update(population)
 
-    record = stats.compile(population) if stats is not None else {}
+        record = stats.compile(population) if stats is not None else {}
 
-    # 新添
-    writer = SummaryWriter()
-    for k, v in record.items():
-        for i, n in enumerate(('train', 'vaild')):
-            writer.add_scalar(f'{k}/{n}', v[i], ngen)
+        for k, v in record.items():
+            for i, n in enumerate(('train', 'vaild')):
+                writer.add_scalar(f'{k}/{n}', v[i], ngen)
+
+        logbook.record(gen=0, nevals=len(invalid_ind), **record)
+        if verbose:
+            print(logbook.stream)
 
-    logbook.record(gen=0, nevals=len(invalid_ind), **record)
-    if verbose:
-        print(logbook.stream)
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, gen=0, population=population, logbook=logbook, halloffame=halloffame)
+        start_gen = 1
 
     # Begin the generational process
-    for gen in range(1, ngen + 1):
+    for gen in range(start_gen, ngen + 1):
         # Vary the population
         offspring = varOr(population, toolbox, lambda_, cxpb, mutpb)
 
@@ -266,6 +371,9 @@ def eaMuPlusLambda(population, toolbox, mu, lambda_, cxpb, mutpb, ngen,
         if verbose:
             print(logbook.stream)
 
+        if checkpoint is not None and gen % checkpoint_interval == 0:
+            save_checkpoint(checkpoint, gen=gen, population=population, logbook=logbook, halloffame=halloffame)
+
         # TODO 不知写的早停算法是否合适，用户可自行修改
         avg = logbook.select('avg')
         if len(avg) > early_stopping_rounds:
@@ -274,6 +382,144 @@ def eaMuPlusLambda(population, toolbox, mu, lambda_, cxpb, mutpb, ngen,
                 print(f'early_stopping_rounds={early_stopping_rounds}', '\t', std)
                 break
     # 关闭
-    writer.close()
+    if close_writer:
+        writer.close()
+
+    return population, logbook
+
+
+def _migrate(islands, migration_size, toolbox):
+    """环形迁移，每个岛最好的个体替换下一个岛最差的个体。nan不参与迁移"""
+    emigrants = []
+    for island in islands:
+        valid = [ind for ind in island if ind.fitness.values[0] == ind.fitness.values[0]]
+        emigrants.append(tools.selBest(valid, migration_size))
+    for i, island in enumerate(islands):
+        immigrants = emigrants[i - 1]
+        if len(immigrants) == 0:
+            continue
+        # nan排在最后，先被替换
+        island.sort(key=lambda ind: ind.fitness.wvalues if ind.fitness.values[0] == ind.fitness.values[0] else (-np.inf,), reverse=True)
+        island[-len(immigrants):] = [toolbox.clone(ind) for ind in immigrants]
+
+
+def _split_sizes(total, n):
+    """total个平分成n份，余数分给前面几份，每份至少1个"""
+    return [max(total // n + (i < total % n), 1) for i in range(n)]
+
+
+def eaMuPlusLambdaIslands(population, toolbox, mu, lambda_, cxpb, mutpb, ngen,
+                          stats=None, halloffame=None, verbose=__debug__,
+                          early_stopping_rounds=10,
+                          checkpoint=None, checkpoint_interval=1, resume_from=None, writer=None,
+                          n_islands=4, migration_interval=5, migration_size=5):
+    r"""岛屿模型的 :math:`(\mu + \lambda)` 进化算法
+
+    种群分成`n_islands`个子种群，各自独立选择、交叉、变异，每隔`migration_interval`代，
+    每个岛最好的`migration_size`个个体迁移到下一个岛，替换其最差的个体。
+    子种群间交流少，比一个大种群更不容易早熟。
+
+    计算量主要在适应度评估，所以每一代所有岛的新个体合在一起调用一次`toolbox.map`，
+    并行由`map_exprs`中的多进程或ray负责，公共子表达式消除与`fitness_cache.pkl`在岛之间也是共享的
+
+    :param mu: 所有岛合计选多少个做为下一代，平分到各岛，余数分给前面的岛
+    :param lambda\_: 所有岛合计每次生成多少新个体，平分到各岛，余数分给前面的岛
+    :param n_islands: 岛的数量
+    :param migration_interval: 每隔多少代迁移一次
+    :param migration_size: 每个岛每次迁出多少个体
+    其它参数同 :func:`eaMuPlusLambda`，`resume_from`也可以是 :func:`eaMuPlusLambda` 或岛数不同时保存的检查点
+    """
+    mu_islands = _split_sizes(mu, n_islands)
+    lambda_islands = _split_sizes(lambda_, n_islands)
+
+    close_writer = writer is None
+    if close_writer:
+        writer = SummaryWriter()
+
+    if resume_from is not None:
+        state = _resume(resume_from, halloffame)
+        islands = state.get('islands', None)
+        if islands is None or len(islands) != n_islands:
+            # 普通检查点或岛数变了，重新轮流分配到各岛
+            population_ = state['population'] if islands is None else [ind for island in islands for ind in island]
+            islands = [population_[i::n_islands] for i in range(n_islands)]
+        population[:] = [ind for island in islands for ind in island]
+        logbook = state['logbook']
+        start_gen = state['gen'] + 1
+    else:
+        logbook = tools.Logbook()
+        logbook.header = ['gen', 'nevals'] + (stats.fields if stats else [])
+
+        # Evaluate the individuals with an invalid fitness
+        invalid_ind = [ind for ind in population if not ind.fitness.valid]
+        fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
+        for ind, fit in zip(invalid_ind, fitnesses):
+            ind.fitness.values = fit
+
+        if halloffame is not None:
+            halloffame.update(population)
+
+        # 轮流分配到各岛
+        islands = [population[i::n_islands] for i in range(n_islands)]
+
+        record = stats.compile(population) if stats is not None else {}
+
+        for k, v in record.items():
+            for i, n in enumerate(('train', 'vaild')):
+                writer.add_scalar(f'{k}/{n}', v[i], ngen)
+
+        logbook.record(gen=0, nevals=len(invalid_ind), **record)
+        if verbose:
+            print(logbook.stream)
+
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, gen=0, islands=islands, logbook=logbook, halloffame=halloffame)
+        start_gen = 1
+
+    # Begin the generational process
+    for gen in range(start_gen, ngen + 1):
+        # Vary each island
+        offsprings = [varOr(island, toolbox, n, cxpb, mutpb) for island, n in zip(islands, lambda_islands)]
+
+        # 所有岛一起评估
+        invalid_ind = [ind for offspring in offsprings for ind in offspring if not ind.fitness.valid]
+        fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
+        for ind, fit in zip(invalid_ind, fitnesses):
+            ind.fitness.values = fit
+
+        # Update the hall of fame with the generated individuals
+        if halloffame is not None:
+            halloffame.update([ind for offspring in offsprings for ind in offspring])
+
+        # Select the next generation population of each island
+        islands = [toolbox.select(island + offspring, n) for island, offspring, n in zip(islands, offsprings, mu_islands)]
+
+        if gen % migration_interval == 0 and n_islands > 1:
+            _migrate(islands, migration_size, toolbox)
+
+        population[:] = [ind for island in islands for ind in island]
+
+        # Update the statistics with the new population
+        record = stats.compile(population) if stats is not None else {}
+        for k, v in record.items():
+            for i, n in enumerate(('train', 'vaild')):
+                writer.add_scalar(f'{k}/{n}', v[i], gen)
+
+        logbook.record(gen=gen, nevals=len(invalid_ind), **record)
+        if verbose:
+            print(logbook.stream)
+
+        if checkpoint is not None and gen % checkpoint_interval == 0:
+            save_checkpoint(checkpoint, gen=gen, islands=islands, logbook=logbook, halloffame=halloffame)
+
+        avg = logbook.select('avg')
+        if len(avg) > early_stopping_rounds:
+            std = np.std(avg[-early_stopping_rounds:])
+            if std < 0.00001:
+                print(f'early_stopping_rounds={early_stopping_rounds}', '\t', std)
+                break
+    # 关闭
+    if close_writer:
+        writer.close()
 
     return population, logbook
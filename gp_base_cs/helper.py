@@ -1,6 +1,8 @@
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Sequence
+from typing import Dict, Optional, Sequence
 
 import numpy as np
 import polars as pl
@@ -8,7 +10,22 @@ from expr_codegen.tool import ExprTool
 from loguru import logger
 from polars import selectors as cs
 
-from gp_base_cs.base import get_fitness
+from gp_base_cs.base import peak_columns, plan_batches
+from gp_base_cs.cache import ColumnCache
+from gp_base_cs.telemetry import add_stat
+
+# 适应度为横截面RankIC，根节点上的这些算子每天都是保序变换，不改变适应度，见`canonical_expr`
+MONOTONE_FUNCS = ('cs_rank', 'cs_scale', 'cs_zscore')
+
+
+def load_input(path: str, columns: Sequence[str], date: str = 'date', asset: str = 'asset') -> pl.DataFrame:
+    """只加载GP用到的字段，并转成float32，节省内存、加快加载
+
+    columns: 因子与标签字段，一般由`input_columns`得到
+    """
+    df = pl.scan_parquet(path).select(date, asset, pl.col(columns).cast(pl.Float32)).collect()
+    logger.info('加载数据 {}，共 {} 行 {} 列，占用 {:.1f} MB', path, df.height, df.width, df.estimated_size('mb'))
+    return df
 
 
 def fitness_individual(a: str, b: str) -> pl.Expr:
@@ -49,13 +66,301 @@ def root_operator(df: pl.DataFrame):
     return df
 
 
+def _rank_average(x: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """沿最后一维(资产)求平均排名，与polars的rank('average')一致
+
+    无效位置返回nan。NaN值视为最大，与polars中NaN的排序规则一致
+    """
+    finite = valid & ~np.isnan(x)
+    w = np.where(finite, x, np.nan)
+    order = np.argsort(w, axis=-1)
+    s = np.take_along_axis(w, order, axis=-1)
+
+    idx = np.broadcast_to(np.arange(s.shape[-1]), s.shape)
+    # 相同值为一组，组内取首尾位置的平均
+    head = np.ones(s.shape, dtype=bool)
+    head[..., 1:] = s[..., 1:] != s[..., :-1]
+    if head.all():
+        # 没有并列，排名就是位置
+        rank = idx + 1.0
+    else:
+        tail = np.ones(s.shape, dtype=bool)
+        tail[..., :-1] = head[..., 1:]
+        start = np.maximum.accumulate(np.where(head, idx, 0), axis=-1)
+        end = np.minimum.accumulate(np.where(tail, idx, s.shape[-1])[..., ::-1], axis=-1)[..., ::-1]
+        rank = (start + end) / 2 + 1
+
+    r = np.empty(s.shape, dtype=np.float64)
+    np.put_along_axis(r, order, rank, axis=-1)
+
+    # NaN排在所有有限值之后，互相并列
+    nan = valid & np.isnan(x)
+    n_finite = finite.sum(axis=-1, keepdims=True)
+    n_nan = nan.sum(axis=-1, keepdims=True)
+    r = np.where(nan, n_finite + (n_nan + 1) / 2, r)
+    return np.where(valid, r, 0)
+
+
+def rank_ic(df: pl.DataFrame, columns: Sequence[str], label: str,
+            date: str = 'date', asset: str = 'asset', max_elements: int = 2 ** 24, n_jobs: int = None):
+    """一次计算多个因子的每日RankIC
+
+    将数据转成 日期×因子×资产 的稠密矩阵，每个日期只排名一次，再用矩阵运算求Pearson相关。
+    计算量只与因子数成正比，与polars表达式数量无关
+
+    Parameters
+    ----------
+    df: pl.DataFrame
+    columns: Sequence[str]
+        因子列
+    label: str
+        标签列
+    date: str
+    asset: str
+    max_elements: int
+        同时计算的矩阵最大元素数。按日期分块，控制内存
+    n_jobs: int
+        线程数。None表示使用全部CPU
+
+    Returns
+    -------
+    dates: np.ndarray
+        排序后的日期
+    ic: np.ndarray
+        形状为 (日期数, 因子数)，无效值为nan
+
+    """
+    columns = list(columns)
+    df = df.select(date, asset, label, *columns).sort(date)
+    d = df.select(pl.col(date).rank('dense') - 1).to_series().to_numpy()
+    a = df.select(pl.col(asset).rank('dense') - 1).to_series().to_numpy()
+    x = df.select(pl.col(columns).cast(pl.Float64)).to_numpy()
+    x_valid = df.select(pl.col(columns).is_not_null()).to_numpy()
+    y = df.get_column(label).cast(pl.Float64).to_numpy()
+    y_valid = df.get_column(label).is_not_null().to_numpy()
+
+    dates = df.get_column(date).unique(maintain_order=True).to_numpy()
+    n_dates, n_assets, n_columns = len(dates), int(a.max()) + 1 if len(a) > 0 else 0, len(columns)
+    ic = np.full((n_dates, n_columns), np.nan)
+
+    def func(d0, n):
+        r0, r1 = np.searchsorted(d, [d0, d0 + n])
+        dd, aa = d[r0:r1] - d0, a[r0:r1]
+
+        xs = np.full((n, n_columns, n_assets), np.nan)
+        ys = np.full((n, 1, n_assets), np.nan)
+        y_ok = np.zeros((n, 1, n_assets), dtype=bool)
+        valid = np.zeros((n, n_columns, n_assets), dtype=bool)
+        xs[dd, :, aa] = x[r0:r1]
+        ys[dd, 0, aa] = y[r0:r1]
+        y_ok[dd, 0, aa] = y_valid[r0:r1]
+        valid[dd, :, aa] = x_valid[r0:r1] & y_valid[r0:r1, None]
+
+        # 成对剔除空值后再排名。标签每个日期只排一次，只有因子有空值的日期才需要重排
+        rx = _rank_average(xs, valid)
+        ry = np.broadcast_to(_rank_average(ys, y_ok), xs.shape)
+        diff = (valid != y_ok).any(axis=-1)
+        if diff.any():
+            ry = ry.copy()
+            i, j = np.nonzero(diff)
+            ry[i, j] = _rank_average(ys[i, 0], valid[i, j])
+
+        cnt = valid.sum(axis=-1)
+        sx = rx.sum(axis=-1)
+        sy = ry.sum(axis=-1)
+        sxx = np.einsum('dea,dea->de', rx, rx)
+        syy = np.einsum('dea,dea->de', ry, ry)
+        sxy = np.einsum('dea,dea->de', rx, ry)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = sxy - sx * sy / cnt
+            var = (sxx - sx * sx / cnt) * (syy - sy * sy / cnt)
+            ic[d0:d0 + n] = np.where((cnt >= 2) & (var > 0), cov / np.sqrt(var), np.nan)
+
+    # numpy的排序与矩阵运算会释放GIL，按日期分块后多线程计算
+    n_jobs = n_jobs or os.cpu_count() or 1
+    step = max(1, max_elements // n_jobs // max(1, n_assets * n_columns))
+    with ThreadPoolExecutor(n_jobs) as executor:
+        list(executor.map(lambda d0: func(d0, min(step, n_dates - d0)), range(0, n_dates, step)))
+
+    return dates, ic
+
+
+def _ic_stats(ic: np.ndarray, min_valid: float = None):
+    """IC序列的均值与IR。有效数比例不足min_valid时均值返回nan"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cnt = (~np.isnan(ic)).sum(axis=0)
+        mean = np.where(cnt > 0, np.nansum(ic, axis=0) / cnt, np.nan)
+        std = np.sqrt(np.where(cnt > 0, np.nansum((ic - mean) ** 2, axis=0) / cnt, np.nan))
+        ir = mean / std
+        if min_valid is not None:
+            mean = np.where(cnt / max(len(ic), 1) >= min_valid, mean, np.nan)
+    return mean, ir
+
+
+def ic_series(df: pl.DataFrame, columns: Sequence[str], label: str):
+    """种群每日IC序列。每条表达式只算一次，样本内外、滚动窗口等统计都从中切片得到
+
+    Returns
+    -------
+    dates: np.ndarray
+        排序后的日期
+    ic: np.ndarray
+        形状为 (日期数, 因子数)，无效值为nan
+
+    """
+    # TODO 是否要强插一个根算子???
+    # df = root_operator(df)
+
+    return rank_ic(df, columns, label)
+
+
+def split_fitness(dates: np.ndarray, ic: np.ndarray, split_date: datetime):
+    """按`split_date`切分IC序列，得到样本内外的IC与IR。ic沿第0维为日期，可为一维或二维"""
+    # 将IC划分成训练集与测试集
+    train = dates < np.datetime64(split_date)
+
+    # TODO 有效数不足，生成的意义不大，返回nan, 而适应度第0位是nan时不加入名人堂
+    ic_train, ir_train = _ic_stats(ic[train], min_valid=0.5)
+    ic_valid, ir_valid = _ic_stats(ic[~train])
+    return ic_train, ic_valid, ir_train, ir_valid
+
+
+def window_fitness(dates: np.ndarray, ic: np.ndarray, windows: Sequence[datetime]) -> Dict[str, np.ndarray]:
+    """滚动多窗口的IC统计。只对IC序列切片，换窗口不用重算因子
+
+    Parameters
+    ----------
+    dates: np.ndarray
+        IC序列对应的日期，升序
+    ic: np.ndarray
+        沿第0维为日期，可为一维或二维
+    windows: Sequence[datetime]
+        窗口分界，升序。相邻两个日期构成一个窗口`[windows[i], windows[i+1])`
+
+    Returns
+    -------
+    dict
+        ic_mean: 每个窗口的IC均值，第0维为窗口
+        ir: 每个窗口的IR
+        hit_rate: 每个窗口IC与整体方向一致的天数比例
+        ic: 各窗口IC均值的均值
+        stability: 各窗口IC均值的均值/标准差，越大越稳定
+        decay: 各窗口IC均值(按整体方向取正)对窗口序号的斜率/整体IC，小于0表示衰减
+
+    """
+    bounds = np.searchsorted(dates, [np.datetime64(w) for w in windows])
+    ic_mean, ir = map(np.array, zip(*[_ic_stats(ic[i0:i1]) for i0, i1 in zip(bounds[:-1], bounds[1:])]))
+    mean, stability = _ic_stats(ic_mean)
+    # 只有一个窗口或各窗口IC完全相同时无意义
+    stability = np.where(np.isfinite(stability), stability, np.nan)
+    sign = np.sign(mean)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hit_rate = np.array([(ic[i0:i1] * sign > 0).sum(axis=0) / (~np.isnan(ic[i0:i1])).sum(axis=0)
+                             for i0, i1 in zip(bounds[:-1], bounds[1:])])
+        x = np.arange(len(ic_mean)) - (len(ic_mean) - 1) / 2
+        x = x.reshape((-1,) + (1,) * (ic_mean.ndim - 1))
+        decay = (x * ic_mean * sign).sum(axis=0) / (x * x).sum() / np.abs(mean)
+    return {'ic_mean': ic_mean, 'ir': ir, 'hit_rate': hit_rate, 'ic': mean, 'stability': stability, 'decay': decay}
+
+
+def factor_sketch(df: pl.DataFrame, columns: Sequence[str], dim: int = 256, n_dates: int = 64,
+                  date: str = 'date', asset: str = 'asset', seed: int = 0) -> np.ndarray:
+    """因子值的小签名，用于快速估计两个因子的截面相关性，不用保存或重算整个因子面板
+
+    1. 等间隔抽取`n_dates`个日期，每个日期横截面排名后标准化，空值记0
+    2. 用CountSketch稀疏随机投影压缩到`dim`维，再归一化
+
+    两个签名的内积约等于抽样日期上的平均秩相关，误差约为`1/sqrt(dim)`。
+    同一份数据抽到的行与投影都相同，不同批、不同代算出的签名可以直接比较
+
+    Returns
+    -------
+    np.ndarray
+        形状为 (因子数, dim)，float32
+
+    """
+    columns = list(columns)
+    dates = df.get_column(date).unique().sort()
+    picked = dates.gather(np.unique(np.linspace(0, len(dates) - 1, min(n_dates, len(dates))).round().astype(int)))
+    r = pl.col(columns).fill_nan(None).rank()
+    z = df.select(date, asset, *columns).filter(pl.col(date).is_in(picked.implode())).sort(date, asset).select(
+        ((r - r.mean()) / r.std(ddof=0)).over(date).fill_nan(0).fill_null(0)
+    ).to_numpy()
+    return count_sketch(z, dim, seed)
+
+
+def count_sketch(z: np.ndarray, dim: int = 256, seed: int = 0) -> np.ndarray:
+    """CountSketch稀疏随机投影，每列压缩到`dim`维后归一化
+
+    z: 形状为 (行数, 因子数)，已标准化。行的顺序要固定，同样的行数与seed得到同样的投影
+
+    Returns
+    -------
+    np.ndarray
+        形状为 (因子数, dim)，float32
+
+    """
+    rng = np.random.default_rng(seed)
+    bucket = rng.integers(0, dim, size=len(z))
+    sign = rng.choice([-1.0, 1.0], size=len(z))
+    sketch = np.stack([np.bincount(bucket, weights=sign * z[:, i], minlength=dim) for i in range(z.shape[1])]) if z.shape[1] > 0 else np.zeros((0, dim))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sketch = np.nan_to_num(sketch / np.linalg.norm(sketch, axis=1, keepdims=True))
+    return sketch.astype(np.float32)
+
+
+def diversity_penalty(results, exprs_old, signatures: Dict[str, np.ndarray], hof_names: Sequence[str], weight: float):
+    """多样性惩罚。与名人堂的最大相关性越高，第0个适应度打折越多
+
+    相关性由`factor_sketch`签名的内积估计，与1000个名人堂成员比较也只是一次矩阵乘法
+
+    Parameters
+    ----------
+    results:
+        `fill_fitness`的结果
+    signatures:
+        表达式字符串 -> `factor_sketch`签名
+    hof_names:
+        名人堂成员的表达式字符串
+    weight: float
+        惩罚系数，第0个适应度乘以`1 - weight × 最大|相关性|`
+
+    """
+    hof = [(n, signatures[n]) for n in hof_names if n in signatures]
+    idx = [i for i, (k, v, c) in enumerate(exprs_old) if str(v) in signatures and results[i][0] == results[i][0]]
+    if len(hof) == 0 or len(idx) == 0:
+        return results
+
+    names = np.array([n for n, s in hof])
+    corr = np.abs(np.stack([signatures[str(exprs_old[i][1])] for i in idx]) @ np.stack([s for n, s in hof]).T)
+    # 已在名人堂中的个体不与自己比
+    corr[np.array([str(exprs_old[i][1]) for i in idx])[:, None] == names[None, :]] = 0
+    max_corr = corr.max(axis=1)
+
+    results = list(results)
+    for i, m in zip(idx, max_corr):
+        results[i] = (results[i][0] * (1 - weight * float(m)),) + tuple(results[i][1:])
+    return results
+
+
 def fitness_population(df: pl.DataFrame, columns: Sequence[str], label: str, split_date: datetime):
-    """种群fitness函数"""
+    """种群fitness函数
+
+    使用`rank_ic`一次算出所有因子的每日RankIC，再按`split_date`切分出样本内外的IC与IR。
+    如要换成其它适应度，请使用`fitness_population_polars`并修改`fitness_individual`
+    """
     if df is None:
         return {}, {}, {}, {}
 
-    # TODO 是否要强插一个根算子???
-    # df = root_operator(df)
+    dates, ic = ic_series(df, columns, label)
+    return tuple({k: float(v) for k, v in zip(columns, values)} for values in split_fitness(dates, ic, split_date))
+
+
+def fitness_population_polars(df: pl.DataFrame, columns: Sequence[str], label: str, split_date: datetime):
+    """种群fitness函数。每个因子一条polars表达式，可通过`fitness_individual`定制"""
+    if df is None:
+        return {}, {}, {}, {}
 
     df = df.group_by('date').agg(
         [fitness_individual(X, label) for X in columns]
@@ -80,61 +385,129 @@ def fitness_population(df: pl.DataFrame, columns: Sequence[str], label: str, spl
     return ic_train, ic_valid, ir_train, ir_valid
 
 
-def batched_exprs(batch_id, exprs_list, gen, label, split_date, df_input):
+def batched_exprs(batch_id, exprs_list, gen, label, split_date, df_input, cache: Optional[ColumnCache] = None,
+                  max_columns: Optional[int] = None, stats: Optional[Dict] = None, counted: bool = False):
     """每代种群分批计算
 
     由于种群数大，一次性计算可能内存不足，所以提供分批计算功能，同时也为分布式计算做准备
+
+    cache: 子表达式列缓存。跨批、跨代复用热门子树的计算结果
+    max_columns: 每批最多新增多少列。根据生成代码的DAG估计列数峰值，超出时对半拆分后再算
+    stats: 各阶段耗时与缓存命中次数累加到此字典，见`gp_base_cs.telemetry`。None表示不记录
+    counted: 子树热度与命中次数是否已在拆分前统计过。拆分后的递归调用为True，避免重复计数
     """
     if len(exprs_list) == 0:
         return {}
 
+    # 已缓存的子树替换成缓存列，同时追加需要新缓存的子树。拆分时用原始输入，缓存列与行号由下一层重新并入
+    df_raw = df_input
+    exprs_code, pending = exprs_list, {}
+    if cache is not None:
+        tic = time.perf_counter()
+        lookups, found = cache.lookups, cache.found
+        exprs_code, df_input, pending = cache.prepare(exprs_list, df_input, count=not counted)
+        add_stat(stats, 'time_cache', time.perf_counter() - tic)
+        add_stat(stats, 'cache_lookups', cache.lookups - lookups)
+        add_stat(stats, 'cache_found', cache.found - found)
+
+    tic = time.perf_counter()
     tool = ExprTool()
     # 表达式转脚本
-    codes, G = tool.all(exprs_list, style='polars', template_file='template.py.j2',
+    codes, G = tool.all(exprs_code, style='polars', template_file='template.py.j2',
                         replace=False, regroup=True, format=True,
                         date='date', asset='asset', over_null="partition_by",
                         skip_simplify=True)
+    add_stat(stats, 'time_codegen', time.perf_counter() - tic)
+
+    # 中间列在最后一个使用它的分组算完后就会被删除，输出列则一直保留
+    peak = peak_columns(G)
+    if max_columns is not None and peak > max_columns and len(exprs_list) > 1:
+        logger.info("{}代{}批 预计列数峰值 {} 超出 {}，拆分后计算", gen, batch_id, peak, max_columns)
+        new_results = {}
+        for exprs_half in plan_batches(exprs_list, (len(exprs_list) + 1) // 2):
+            new_results.update(batched_exprs(batch_id, exprs_half, gen, label, split_date, df_raw, cache, max_columns, stats, counted=True))
+        return new_results
 
     # with open('out1.py', 'w') as f:
     #     f.write(codes)
 
     cnt = len(exprs_list)
-    logger.info("{}代{}批 代码 开始执行。共 {} 条 表达式", gen, batch_id, cnt)
+    logger.info("{}代{}批 代码 开始执行。共 {} 条 表达式，预计列数峰值 {}", gen, batch_id, cnt, peak)
     tic = time.perf_counter()
 
     globals_ = {}
     exec(codes, globals_)
     df_output = globals_['main'](df_input, filter_last=False)
+    add_stat(stats, 'time_execute', time.perf_counter() - tic)
+    if cache is not None:
+        toc = time.perf_counter()
+        cache.update(df_output, pending)
+        add_stat(stats, 'time_cache', time.perf_counter() - toc)
 
     elapsed_time = time.perf_counter() - tic
     logger.info("{}代{}批 因子 计算完成。共用时 {:.3f} 秒，平均 {:.3f} 秒/条，或 {:.3f} 条/秒", gen, batch_id, elapsed_time, elapsed_time / cnt, cnt / elapsed_time)
 
-    # 计算种群适应度
-    ic_train, ic_valid, ir_train, ir_valid = fitness_population(df_output, [k for k, v, c in exprs_list], label=label, split_date=split_date)
+    # 计算种群适应度。每日IC序列一并保存，换切分日期或窗口时只需切片
+    tic = time.perf_counter()
+    dates, ic = ic_series(df_output, [k for k, v, c in exprs_list], label=label)
+    ic_train, ic_valid, ir_train, ir_valid = split_fitness(dates, ic, split_date)
+    # 因子值签名，用于名人堂多样性
+    sig = factor_sketch(df_output, [k for k, v, c in exprs_list])
+    add_stat(stats, 'time_fitness', time.perf_counter() - tic)
     logger.info("{}代{}批 适应度 计算完成", gen, batch_id)
 
     # 样本内外适应度提取
     new_results = {}
-    for k, v, c in exprs_list:
+    for i, (k, v, c) in enumerate(exprs_list):
         v = str(v)
-        new_results[v] = {'ic_train': get_fitness(k, ic_train),
-                          'ic_valid': get_fitness(k, ic_valid),
-                          'ir_train': get_fitness(k, ir_train),
-                          'ir_valid': get_fitness(k, ir_valid),
+        new_results[v] = {'ic_train': float(ic_train[i]),
+                          'ic_valid': float(ic_valid[i]),
+                          'ir_train': float(ir_train[i]),
+                          'ir_valid': float(ir_valid[i]),
+                          'ic': ic[:, i].astype(np.float32),
+                          'sig': sig[i],
                           }
     return new_results
 
 
-def fill_fitness(exprs_old, fitness_results):
-    """填充fitness"""
+def fill_fitness(exprs_old, fitness_results, dates=None, split_date=None, windows=None, series=None):
+    """填充fitness
+
+    dates: 每日IC序列对应的日期。提供时从保存的IC序列重新切分，改了split_date或windows也不用重算因子
+    split_date: 样本内外切分日期
+    windows: 滚动窗口分界，见`window_fitness`。提供时以各窗口IC均值与跨窗口稳定性为目标
+    series: 表达式 -> 每日IC序列，见`ICStore`。None表示从fitness_results中取
+    """
     results = []
     for k, v, c in exprs_old:
         v = str(v)
         d = fitness_results.get(v, None)
+        if series is not None:
+            ic = series.get(v, None)
+        else:
+            ic = None if d is None else d.get('ic', None)
+        if ic is not None and (dates is None or len(ic) != len(dates)):
+            # 旧版缓存或数据已变，只能用保存的标量
+            ic = None
         if d is None:
             logger.debug('{} 不合法/无意义/重复 等原因，在计算前就被剔除了', v)
+        elif windows is not None:
+            if ic is None:
+                # 与其它个体的目标不可比
+                logger.debug('{} 没有每日IC序列，无法按滚动窗口评估', v)
+                results.append((np.nan, np.nan))
+                continue
+            w = window_fitness(dates, ic, windows)
+            s0, s1 = abs(float(w['ic'])), abs(float(w['stability']))
+            # TODO 这地方要按自己需求定制。各窗口IC均值要大，且各窗口方向一致
+            if s0 == s0 and s0 > 0.001 and s1 == s1:
+                results.append((s0, s1))
+                continue
         else:
-            s0, s1, s2, s3 = d['ic_train'], d['ic_valid'], d['ir_train'], d['ir_valid']
+            if ic is not None and split_date is not None:
+                s0, s1, s2, s3 = map(float, split_fitness(dates, ic, split_date))
+            else:
+                s0, s1, s2, s3 = d['ic_train'], d['ic_valid'], d['ir_train'], d['ir_valid']
             # ic要看绝对值
             s0, s1, s2, s3 = abs(s0), abs(s1), s2, s3
             # TODO 这地方要按自己需求定制，过滤太多可能无法输出有效表达式
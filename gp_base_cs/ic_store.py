@@ -0,0 +1,174 @@
+"""
+每条表达式每日IC序列的列式存储
+
+`fitness_cache.pkl`只保存`ic_train`等标量，IC序列单独保存，后续筛选、去相关等分析直接读取，不用重算因子
+
+1. 目录下每次追加写一个`parquet`分片，长表格式：expr, date, ic。分片数超过上限时合并成一个，重复保存的只留最新
+2. ic为float32，按表达式、日期排序后zstd压缩，表达式列重复多，字典编码后体积小
+3. 记录每条表达式在哪个分片，读取时只打开相关分片；最近读写的序列留在内存中，LRU淘汰
+"""
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+import polars as pl
+
+from gp_base_cs.base import canonical_expr, share_fitness
+
+
+def pop_series(fitness_results: Dict[str, Dict], key: str = 'ic') -> Dict[str, np.ndarray]:
+    """从适应度字典中取出IC序列或因子签名等数组，只留下标量"""
+    return {k: d.pop(key) for k, d in fitness_results.items() if key in d}
+
+
+class ICStore:
+    """每日IC序列存储
+
+    Parameters
+    ----------
+    path:
+        目录
+    max_bytes: int
+        内存中缓存的序列总大小上限
+    max_parts: int
+        分片数上限，超过时合并。每代至少追加一个分片，不合并时打开目录与读取都越来越慢
+
+    """
+
+    def __init__(self, path, max_bytes: int = 512 * 1024 ** 2, max_parts: int = 64):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_parts = max_parts
+        # 表达式 -> 分片文件
+        self.index: Dict[str, Path] = {}
+        for part in self._parts():
+            self.index.update(dict.fromkeys(pl.read_parquet(part, columns=['expr']).get_column('expr').unique().to_list(), part))
+        # 表达式 -> (日期, IC)
+        self.memory: OrderedDict[str, tuple] = OrderedDict()
+        self.nbytes = 0
+
+    def _parts(self):
+        return sorted(self.path.glob('part_*.parquet'))
+
+    def _next_part(self) -> Path:
+        # 编号只增不减，合并后新分片仍排在旧分片之后
+        parts = self._parts()
+        n = int(parts[-1].stem.split('_')[1]) + 1 if len(parts) > 0 else 0
+        return self.path / f'part_{n:06d}.parquet'
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name: str):
+        return name in self.index
+
+    def _remember(self, name: str, dates: np.ndarray, ic: np.ndarray) -> None:
+        old = self.memory.pop(name, None)
+        if old is not None:
+            self.nbytes -= old[1].nbytes
+        self.memory[name] = (dates, ic)
+        self.nbytes += ic.nbytes
+        while self.nbytes > self.max_bytes and len(self.memory) > 0:
+            _, (_, s) = self.memory.popitem(last=False)
+            self.nbytes -= s.nbytes
+
+    def append(self, dates: np.ndarray, series: Dict[str, np.ndarray]) -> None:
+        """追加一批IC序列，新写一个分片。已存在的表达式以新的为准
+
+        dates: 与每条序列等长的日期，升序
+        """
+        if len(series) == 0:
+            return
+        # 按表达式排序后写入，同一表达式的数据连续，读取时可按统计信息跳过无关的行组
+        names = sorted(series)
+        part = self._next_part()
+        df = pl.DataFrame({
+            'expr': pl.Series(names, dtype=pl.String).gather(np.repeat(np.arange(len(names)), len(dates))),
+            'date': np.tile(dates, len(names)),
+            'ic': np.concatenate([np.asarray(series[k], dtype=np.float32) for k in names]),
+        })
+        df.write_parquet(part, compression='zstd', statistics=True)
+        for k in names:
+            self.index[k] = part
+            self._remember(k, dates, np.asarray(series[k], dtype=np.float32))
+        if len(self._parts()) > self.max_parts:
+            self.compact()
+
+    def compact(self) -> None:
+        """合并所有分片，每条表达式只留最后一次保存的序列
+
+        先写新分片再删旧分片，中途中断时新旧分片并存，读取时仍以编号大的为准，不丢数据
+        """
+        parts = self._parts()
+        if len(parts) <= 1:
+            return
+        keys: Dict[Path, list] = {}
+        for k, part in self.index.items():
+            keys.setdefault(part, []).append(k)
+        df = pl.concat([pl.scan_parquet(part).filter(pl.col('expr').is_in(keys[part])) for part in parts if part in keys])
+        part = self._next_part()
+        df.sort('expr', 'date').collect().write_parquet(part, compression='zstd', statistics=True)
+        for p in parts:
+            p.unlink()
+        self.index = dict.fromkeys(self.index, part)
+
+    def get(self, names: Iterable[str], dates: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """读取IC序列，没有保存的表达式跳过
+
+        dates: 按这些日期对齐，缺失的日期为nan。None表示按保存时的日期
+        """
+        out = {}
+        missing: Dict[Path, list] = {}
+        for k in set(names):
+            if k in self.memory:
+                self.memory.move_to_end(k)
+                out[k] = self.memory[k]
+            elif k in self.index:
+                missing.setdefault(self.index[k], []).append(k)
+
+        for part, keys in missing.items():
+            df = pl.scan_parquet(part).filter(pl.col('expr').is_in(keys)).collect()
+            for (k,), g in df.group_by('expr'):
+                out[k] = (g.get_column('date').to_numpy(), g.get_column('ic').to_numpy())
+                self._remember(k, *out[k])
+
+        if dates is None:
+            return {k: ic for k, (d, ic) in out.items()}
+        result = {}
+        for k, (d, ic) in out.items():
+            if len(d) == len(dates) and np.array_equal(d, dates):
+                result[k] = ic
+                continue
+            s = np.full(len(dates), np.nan, dtype=np.float32)
+            i = np.searchsorted(d, dates)
+            hit = i < len(d)
+            hit[hit] = d[i[hit]] == dates[hit]
+            s[hit] = ic[i[hit]]
+            result[k] = s
+        return result
+
+    def get_population(self, exprs_list, dates: Optional[np.ndarray] = None,
+                       monotone_funcs: Sequence[str] = ()) -> Dict[str, np.ndarray]:
+        """读取种群的IC序列。自身没有保存的表达式，从等价表达式换算得到
+
+        monotone_funcs: 见`canonical_expr`
+        """
+        names = [str(v) for k, v, c in exprs_list]
+        keys = [str(canonical_expr(v, monotone_funcs)[0]) for k, v, c in exprs_list]
+        series = {k: {'ic': ic} for k, ic in self.get(names + keys, dates).items()}
+        share_fitness(exprs_list, series, monotone_funcs)
+        series = {k: d['ic'] for k, d in series.items()}
+        if dates is not None:
+            # 代表表达式也保存下来，以后的等价表达式不在同一种群中也能换算
+            self.append(dates, {k: series[k] for k in set(keys) if k in series and k not in self})
+        return series
+
+    def load(self, names: Optional[Iterable[str]] = None) -> pl.DataFrame:
+        """读取为宽表，每行一个日期，每列一条表达式。用于事后分析"""
+        df = pl.scan_parquet(self._parts())
+        if names is not None:
+            df = df.filter(pl.col('expr').is_in(list(names)))
+        # 分片按写入顺序读取，重复保存的表达式以最后一次为准
+        return df.collect().pivot(on='expr', index='date', values='ic', aggregate_function='last').sort('date')
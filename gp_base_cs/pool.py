@@ -0,0 +1,159 @@
+"""
+单机多进程计算，不依赖ray
+
+`polars`是多线程的，但`polars_ta`中部分函数还是受GIL影响，单进程CPU占不满。
+这里启动多个进程，每个进程限制`polars`线程数，进程数 × 线程数 ≈ CPU核数
+
+1. 输入数据只写一次`Arrow IPC`文件，子进程以内存映射方式只读打开，各进程共享操作系统的同一份页缓存
+2. 不使用`fork`。`polars`的线程池在`fork`后的子进程中会死锁，Windows上也没有`fork`
+3. 每个子进程有自己的子表达式缓存，跨批、跨代复用
+4. 可设置每批的超时时间。超时的批对半拆分后重算，直到定位到单条慢表达式，将其适应度记为NaN
+
+注意：子进程会重新导入主程序文件，主程序中加载数据等耗时操作要判断`multiprocessing.current_process().name == 'MainProcess'`
+"""
+import multiprocessing as mp
+import os
+import time
+from collections import deque
+from itertools import count
+from pathlib import Path
+from typing import Callable, Optional
+
+import polars as pl
+from loguru import logger
+
+from gp_base_cs.cache import ColumnCache
+from gp_base_cs.helper import batched_exprs
+from gp_base_cs.telemetry import worker_stats
+
+# 子进程中的全局变量，由_init_worker设置
+_df: Optional[pl.DataFrame] = None
+_cache: Optional[ColumnCache] = None
+
+
+def _init_worker(path: str, cache_max_bytes: Optional[int]) -> None:
+    global _df, _cache
+    # 内存映射，不复制
+    _df = pl.read_ipc(path, memory_map=True, rechunk=False)
+    _cache = None if cache_max_bytes is None else ColumnCache(max_bytes=cache_max_bytes)
+
+
+def _ready(i):
+    return _df is not None
+
+
+def nan_fitness(exprs_list):
+    """计算超时的表达式，适应度记为NaN"""
+    nan = float('nan')
+    return {str(v): {'ic_train': nan, 'ic_valid': nan, 'ir_train': nan, 'ir_valid': nan} for k, v, c in exprs_list}
+
+
+def _process(args):
+    func, batch_id, exprs_list, gen, label, split_date, max_columns = args
+    tic = time.perf_counter()
+    stats = {}
+    new_results = func(batch_id, exprs_list, gen, label, split_date, _df, _cache, max_columns, stats)
+    return new_results, worker_stats(stats, time.perf_counter() - tic)
+
+
+class LocalPool:
+    """单机多进程批量计算
+
+    Parameters
+    ----------
+    df_input: pl.DataFrame
+        输入数据
+    path: str
+        共享数据的`Arrow IPC`文件路径，关闭时删除
+    n_jobs: int
+        进程数
+    n_threads: int
+        每个进程`polars`的线程数。None表示CPU核数平分给各进程
+    cache_max_bytes: int
+        每个进程子表达式缓存的内存上限。None表示不缓存
+    func: Callable
+        每批的计算函数，`gp_base_cs.helper.batched_exprs`或`gp_base_ts.helper.batched_exprs`，要定义在模块顶层
+
+    """
+
+    def __init__(self, df_input: pl.DataFrame, path, n_jobs: int, n_threads: Optional[int] = None, cache_max_bytes: Optional[int] = None,
+                 func: Callable = batched_exprs):
+        self.path = Path(path)
+        self.func = func
+        self.n_jobs = n_jobs
+        self.n_threads = n_threads or max((os.cpu_count() or 1) // n_jobs, 1)
+        self.cache_max_bytes = cache_max_bytes
+
+        # 不压缩才能内存映射
+        df_input.write_ipc(self.path, compression='uncompressed')
+        self.pool = self._start()
+
+    def _start(self):
+        # 子进程启动时读取环境变量，决定polars线程数。主进程的线程池已创建，不受影响
+        old = os.environ.get('POLARS_MAX_THREADS')
+        os.environ['POLARS_MAX_THREADS'] = str(self.n_threads)
+        try:
+            pool = mp.get_context('spawn').Pool(self.n_jobs, initializer=_init_worker, initargs=(str(self.path), self.cache_max_bytes))
+            # 等子进程启动完成，超时计时不含启动时间
+            pool.map(_ready, range(self.n_jobs), chunksize=1)
+            return pool
+        finally:
+            if old is None:
+                del os.environ['POLARS_MAX_THREADS']
+            else:
+                os.environ['POLARS_MAX_THREADS'] = old
+
+    def imap_unordered(self, tasks, gen, label, split_date, max_columns=None, timeout=None):
+        """按完成顺序逐个返回每批的适应度与性能记录，见`gp_base_cs.telemetry`
+
+        timeout: 每批的超时秒数。None表示不限制
+        """
+        if timeout is None:
+            args = [(self.func, batch_id, exprs_list, gen, label, split_date, max_columns) for batch_id, exprs_list in enumerate(tasks)]
+            return self.pool.imap_unordered(_process, args)
+        return self._imap_timeout(tasks, gen, label, split_date, max_columns, timeout)
+
+    def _imap_timeout(self, tasks, gen, label, split_date, max_columns, timeout):
+        batch_ids = count()
+        pending = deque(tasks)
+        # AsyncResult -> (表达式, 开始时间)
+        running = {}
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < self.n_jobs:
+                exprs_list = pending.popleft()
+                r = self.pool.apply_async(_process, ((self.func, next(batch_ids), exprs_list, gen, label, split_date, max_columns),))
+                running[r] = (exprs_list, time.perf_counter())
+
+            for r in [r for r in running if r.ready()]:
+                running.pop(r)
+                yield r.get()
+
+            now = time.perf_counter()
+            slow = {r for r, (exprs_list, tic) in running.items() if now - tic > timeout}
+            if len(slow) == 0:
+                time.sleep(0.01)
+                continue
+
+            # 无法单独中断某个任务，只能重启所有进程，子表达式缓存也一并丢失
+            logger.warning('{}代 有 {} 批计算超过 {} 秒，重启进程', gen, len(slow), timeout)
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = self._start()
+            for r, (exprs_list, tic) in running.items():
+                if r not in slow:
+                    # 被连累的批，原样重算
+                    pending.appendleft(exprs_list)
+                elif len(exprs_list) > 1:
+                    # 对半拆分，逐步定位慢表达式
+                    half = (len(exprs_list) + 1) // 2
+                    pending.appendleft(exprs_list[half:])
+                    pending.appendleft(exprs_list[:half])
+                else:
+                    logger.warning('{}代 表达式计算超时，适应度记为NaN: {}', gen, exprs_list[0][1])
+                    yield nan_fitness(exprs_list), {}
+            running.clear()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.path.unlink(missing_ok=True)
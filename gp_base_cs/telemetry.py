@@ -0,0 +1,148 @@
+"""
+每代的性能记录，用于找出真正的瓶颈
+
+1. 各阶段耗时：DEAP转sympy、过滤、分批、codegen、执行、适应度、缓存读写等
+2. 子表达式缓存命中率、主进程与worker的内存峰值
+3. 多进程或ray时，每个worker的忙碌时间占评估总时长的比例
+
+每代一行，同时写入TensorBoard(`perf/`前缀)和Parquet目录，每代一个文件，用`load_telemetry`读回。
+多进程时codegen、执行、适应度等是各worker耗时之和
+"""
+import os
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import count
+from pathlib import Path
+from typing import Dict, Optional
+
+import polars as pl
+
+
+def peak_rss_mb() -> float:
+    """当前进程的内存峰值，MB"""
+    try:
+        import resource
+    except ImportError:
+        # Windows没有resource，用psutil的peak_wset
+        try:
+            import psutil
+        except ImportError:
+            return float('nan')
+        return psutil.Process().memory_info().peak_wset / 1024 ** 2
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS单位为字节，Linux为KB
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+
+def add_stat(stats: Optional[Dict], key: str, value: float) -> None:
+    """累加耗时或次数。stats为None时不记录"""
+    if stats is not None:
+        stats[key] = stats.get(key, 0) + value
+
+
+def worker_stats(stats: Dict, busy: float) -> Dict:
+    """worker返回给主进程的记录，附上进程号、忙碌时间与内存峰值"""
+    stats['worker'] = stats.get('worker', os.getpid())
+    stats['busy'] = busy
+    stats['peak_rss_mb'] = peak_rss_mb()
+    return stats
+
+
+def load_telemetry(path) -> pl.DataFrame:
+    """读回`Telemetry`写入的各代记录，按代排序。各代的列可能不同，缺的列为null"""
+    parts = [pl.read_parquet(f) for f in sorted(Path(path).glob('gen_*.parquet'))]
+    if len(parts) == 0:
+        return pl.DataFrame()
+    return pl.concat(parts, how='diagonal_relaxed').sort('gen')
+
+
+class Telemetry:
+    """每代性能记录
+
+    worker按首次出现的顺序编号，`util_{i}`在各代间对应同一个进程。
+    某代没有出现的进程(如超时后进程池重启)，下一代起其编号让给新进程
+
+    Parameters
+    ----------
+    path:
+        Parquet目录，每代写一个`gen_{gen:04d}.parquet`，不重写之前各代。None表示不写文件
+    writer:
+        tensorboardX的SummaryWriter。None表示第一次提交时自动创建
+
+    """
+
+    def __init__(self, path=None, writer=None):
+        self.path = path
+        self.writer = writer
+        self.stats = defaultdict(float)
+        self.busy = defaultdict(float)
+        # 进程号 -> 编号，只保留上一代和本代出现过的进程
+        self.workers = {}
+        self.committed = False
+        self.worker_rss = 0.0
+
+    @contextmanager
+    def timer(self, stage: str):
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stats[f'time_{stage}'] += time.perf_counter() - tic
+
+    def add(self, stats: Dict) -> None:
+        """合并一批的记录，可来自本进程或worker"""
+        stats = dict(stats)
+        worker = stats.pop('worker', None)
+        busy = stats.pop('busy', 0.0)
+        if worker is not None:
+            if worker not in self.workers:
+                taken = set(self.workers.values())
+                self.workers[worker] = next(i for i in count() if i not in taken)
+            self.busy[worker] += busy
+        self.worker_rss = max(self.worker_rss, stats.pop('peak_rss_mb', 0.0))
+        for k, v in stats.items():
+            self.stats[k] += v
+
+    def commit(self, gen: int, **extra) -> Dict:
+        """一代结束，记录并清空"""
+        row = {'gen': gen, **self.stats, **extra}
+        lookups = row.pop('cache_lookups', 0)
+        found = row.pop('cache_found', 0)
+        if lookups > 0:
+            row['cache_hit_rate'] = found / lookups
+        row['peak_rss_mb'] = peak_rss_mb()
+        if self.worker_rss > 0:
+            row['worker_peak_rss_mb'] = self.worker_rss
+        # worker利用率 = 忙碌时间 / 评估总时长
+        wall = row.get('time_evaluate', 0.0)
+        if wall > 0:
+            for worker in sorted(self.busy, key=self.workers.get):
+                row[f'util_{self.workers[worker]}'] = self.busy[worker] / wall
+
+        if self.writer is None:
+            from tensorboardX import SummaryWriter
+            self.writer = SummaryWriter()
+        for k, v in row.items():
+            if k != 'gen':
+                self.writer.add_scalar(f'perf/{k}', v, gen)
+        self.writer.flush()
+
+        if self.path is not None:
+            path = Path(self.path)
+            path.mkdir(parents=True, exist_ok=True)
+            if not self.committed:
+                # 从检查点继续时保留之前各代的记录，删除之后的，重算的代以新记录为准
+                for f in path.glob('gen_*.parquet'):
+                    if int(f.stem[4:]) > gen:
+                        f.unlink()
+            pl.DataFrame([row]).write_parquet(path / f'gen_{gen:04d}.parquet')
+        self.committed = True
+
+        # 本代没有出现的进程释放编号
+        self.workers = {w: i for w, i in self.workers.items() if w in self.busy}
+        self.stats.clear()
+        self.busy.clear()
+        self.worker_rss = 0.0
+        return row
@@ -1,6 +1,8 @@
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Sequence
+from typing import Dict, Optional, Sequence
 
 import numpy as np
 import polars as pl
@@ -8,7 +10,14 @@ import polars.selectors as cs
 from expr_codegen.tool import ExprTool
 from loguru import logger
 
-from gp_base_cs.base import get_fitness
+from gp_base_cs.base import get_fitness, peak_columns, plan_batches
+from gp_base_cs.cache import ColumnCache
+from gp_base_cs.helper import count_sketch
+from gp_base_cs.helper import diversity_penalty, load_input  # noqa: F401 与gp_base_cs.helper接口一致，切换时只改导入的模块
+from gp_base_cs.telemetry import add_stat
+
+# 适应度为时序Pearson IC，保序变换会改变适应度，没有可去掉的根算子，见`canonical_expr`
+MONOTONE_FUNCS = ()
 
 
 def fitness_individual(a: str, b: str) -> pl.Expr:
@@ -49,14 +58,149 @@ def root_operator(df: pl.DataFrame):
     return df
 
 
+def ts_corr(df: pl.DataFrame, columns: Sequence[str], label: str, split_date: datetime,
+            date: str = 'date', asset: str = 'asset', max_elements: int = 2 ** 24, n_jobs: int = None):
+    """一次计算多个因子在每个资产上的时序Pearson相关系数，训练集与测试集一起算
+
+    数据按资产、日期排序后，每个资产在`split_date`处切成两段，一次分段求和得到所有因子
+    n、Σx、Σy、Σx²、Σy²、Σxy 这些充分统计量，再算相关系数。不用按资产分组、也不用分训练集测试集多次扫描
+
+    Parameters
+    ----------
+    df: pl.DataFrame
+    columns: Sequence[str]
+        因子列
+    label: str
+        标签列
+    split_date: datetime
+        训练集与测试集的切分日期
+    date: str
+    asset: str
+    max_elements: int
+        同时计算的矩阵最大元素数。按因子分块，控制内存
+    n_jobs: int
+        线程数。None表示使用全部CPU
+
+    Returns
+    -------
+    ic_train: np.ndarray
+        形状为 (资产数, 因子数)，无效值为nan
+    ic_valid: np.ndarray
+    n_train: np.ndarray
+        每个资产训练集的行数
+    n_valid: np.ndarray
+
+    """
+    columns = list(columns)
+    df = df.select(date, asset, label, *columns)
+    # 只要求同一资产的行连续、且日期有序。计算结果一般已满足，不满足时才重排整张表
+    change = pl.col(asset).ne_missing(pl.col(asset).shift())
+    if not df.select((change.sum() == pl.col(asset).n_unique()) & ((pl.col(date).diff() >= 0) | change).all()).item():
+        df = df.sort(asset, date)
+    change = df.select(change).to_series().to_numpy()
+    train = (df.get_column(date) < split_date).to_numpy()
+    y = df.get_column(label).cast(pl.Float64).to_numpy()
+    y_valid = df.get_column(label).is_not_null().to_numpy()
+    n_rows, n_columns = len(change), len(columns)
+
+    # 每个资产的起止位置，以及训练集与测试集的分界。同一资产内日期有序，训练集在前
+    starts = np.flatnonzero(change)
+    ends = np.r_[starts[1:], n_rows]
+    splits = starts + (np.add.reduceat(train.astype(np.int64), starts) if n_rows > 0 else 0)
+    n_train, n_valid = splits - starts, ends - splits
+    # 分段：资产0训练集、资产0测试集、资产1训练集...
+    bounds = np.empty(len(starts) * 2 + 1, dtype=np.int64)
+    bounds[0:-1:2], bounds[1::2], bounds[-1] = starts, splits, n_rows
+
+    # 末尾补一个0：reduceat的下标不能越界，最后一段多加一个0不影响求和
+    y = np.r_[np.where(y_valid, y, 0.0), 0.0]
+    y2 = y * y
+    # reduceat遇到空段会取下一个元素而不是0，按段长剔除
+    idx, seg_ok = bounds[:-1], np.diff(bounds) >= 2
+    ic = np.full((n_columns, len(bounds) - 1), np.nan)
+
+    def func(c0, n):
+        cols = columns[c0:c0 + n]
+        # 转置成 因子×行，沿连续内存分段求和
+        x = np.zeros((len(cols), n_rows + 1))
+        for j, c in enumerate(cols):
+            x[j, :n_rows] = df.get_column(c).cast(pl.Float64).to_numpy()
+        w = None
+        if df.select(pl.col(cols).null_count()).to_numpy().any() or not y_valid.all():
+            # 成对剔除空值，空值处置0，不参与求和
+            w = np.zeros_like(x)
+            w[:, :n_rows] = np.stack([df.get_column(c).is_not_null().to_numpy() for c in cols]) & y_valid
+            x[w == 0] = 0.0
+        # 相关系数与平移无关，减去均值，降低统计量相减时的精度损失
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = x.sum(axis=1) / (n_rows if w is None else w.sum(axis=1))
+        mean = np.where(np.isfinite(mean), mean, 0.0)[:, None]
+        # 各乘积共用一块缓冲区，避免反复分配大数组
+        buf = np.empty_like(x)
+        if w is None:
+            x[:, :n_rows] -= mean
+        else:
+            x -= np.multiply(mean, w, out=buf)
+
+        # 一次分段求和得到所有资产、训练集与测试集的充分统计量
+        if w is None:
+            cnt, sy, syy = np.diff(bounds), np.add.reduceat(y, idx), np.add.reduceat(y2, idx)
+        else:
+            cnt = np.add.reduceat(w, idx, axis=1)
+            sy = np.add.reduceat(np.multiply(w, y, out=buf), idx, axis=1)
+            syy = np.add.reduceat(np.multiply(buf, y, out=buf), idx, axis=1)
+        sx = np.add.reduceat(x, idx, axis=1)
+        sxy = np.add.reduceat(np.multiply(x, y, out=buf), idx, axis=1)
+        sxx = np.add.reduceat(np.multiply(x, x, out=buf), idx, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = cnt * sxy - sx * sy
+            var = (cnt * sxx - sx * sx) * (cnt * syy - sy * sy)
+            # 有NaN时只影响所在分段，与polars一致结果为NaN。少于2个点或方差为0时无效
+            ic[c0:c0 + n] = np.where(seg_ok & (cnt >= 2) & (var > 0), cov / np.sqrt(var), np.nan)
+
+    # numpy的矩阵运算会释放GIL，按因子分块后多线程计算
+    n_jobs = n_jobs or os.cpu_count() or 1
+    step = max(1, max_elements // n_jobs // max(1, n_rows))
+    with ThreadPoolExecutor(n_jobs) as executor:
+        list(executor.map(lambda c0: func(c0, min(step, n_columns - c0)), range(0, n_columns, step)))
+
+    return ic[:, 0::2].T, ic[:, 1::2].T, n_train, n_valid
+
+
 def fitness_population(df: pl.DataFrame, columns: Sequence[str], label: str, split_date: datetime):
-    """种群fitness函数"""
+    """种群fitness函数
+
+    使用`ts_corr`一次算出所有因子在每个资产上样本内外的时序IC。
+    如要换成其它适应度，请使用`fitness_population_polars`并修改`fitness_individual`
+    """
     if df is None:
         return {}, {}
 
     # TODO 是否要强插一个根算子???
     # df = root_operator(df)
 
+    ic_train, ic_valid, n_train, n_valid = ts_corr(df, columns, label, split_date)
+
+    # 时序IC的多资产平均。可用来挖掘在多品种上适应的因子
+    # 只统计在该时段有数据的资产
+    ic_train, ic_valid = ic_train[n_train > 0], ic_valid[n_valid > 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cnt_train = (~np.isnan(ic_train)).sum(axis=0)
+        cnt_valid = (~np.isnan(ic_valid)).sum(axis=0)
+        mean_train = np.nansum(ic_train, axis=0) / cnt_train
+        mean_valid = np.nansum(ic_valid, axis=0) / cnt_valid
+    # TODO 有效数不足，生成的意义不大，返回nan, 而适应度第0位是nan时不加入名人堂
+    mean_train = np.where((cnt_train > 0) & (cnt_train / max(len(ic_train), 1) >= 0.8), mean_train, np.nan)
+    mean_valid = np.where(cnt_valid > 0, mean_valid, np.nan)
+
+    return tuple({k: float(v) for k, v in zip(columns, values)} for values in (mean_train, mean_valid))
+
+
+def fitness_population_polars(df: pl.DataFrame, columns: Sequence[str], label: str, split_date: datetime):
+    """种群fitness函数。每个因子一条polars表达式，可通过`fitness_individual`定制"""
+    if df is None:
+        return {}, {}
+
     # 将IC划分成训练集与测试集
     df_train = df.filter(pl.col('date') < split_date)
     df_valid = df.filter(pl.col('date') >= split_date)
@@ -75,48 +219,117 @@ def fitness_population(df: pl.DataFrame, columns: Sequence[str], label: str, spl
     return ic_train, ic_valid
 
 
-def batched_exprs(batch_id, exprs_list, gen, label, split_date, df_input):
+def factor_sketch(df: pl.DataFrame, columns: Sequence[str], dim: int = 256, n_dates: int = 64,
+                  date: str = 'date', asset: str = 'asset', seed: int = 0) -> np.ndarray:
+    """因子值的小签名，用于快速估计两个因子的时序相关性，见`gp_base_cs.helper.factor_sketch`
+
+    等间隔抽取`n_dates`个日期，每个资产在这些日期上标准化，空值记0，再用CountSketch压缩。
+    两个签名的内积约等于抽样日期上各资产时序相关系数的平均
+
+    Returns
+    -------
+    np.ndarray
+        形状为 (因子数, dim)，float32
+
+    """
+    columns = list(columns)
+    dates = df.get_column(date).unique().sort()
+    picked = dates.gather(np.unique(np.linspace(0, len(dates) - 1, min(n_dates, len(dates))).round().astype(int)))
+    x = pl.col(columns).fill_nan(None)
+    z = df.select(date, asset, *columns).filter(pl.col(date).is_in(picked.implode())).sort(asset, date).select(
+        ((x - x.mean()) / x.std(ddof=0)).over(asset).fill_nan(0).fill_null(0)
+    ).to_numpy()
+    return count_sketch(z, dim, seed)
+
+
+def batched_exprs(batch_id, exprs_list, gen, label, split_date, df_input, cache: Optional[ColumnCache] = None,
+                  max_columns: Optional[int] = None, stats: Optional[Dict] = None, counted: bool = False):
     """每代种群分批计算
 
     由于种群数大，一次性计算可能内存不足，所以提供分批计算功能，同时也为分布式计算做准备
+
+    cache: 子表达式列缓存。跨批、跨代复用热门子树的计算结果
+    max_columns: 每批最多新增多少列。根据生成代码的DAG估计列数峰值，超出时对半拆分后再算
+    stats: 各阶段耗时与缓存命中次数累加到此字典，见`gp_base_cs.telemetry`。None表示不记录
+    counted: 子树热度与命中次数是否已在拆分前统计过。拆分后的递归调用为True，避免重复计数
     """
     if len(exprs_list) == 0:
         return {}
 
+    # 已缓存的子树替换成缓存列，同时追加需要新缓存的子树。拆分时用原始输入，缓存列与行号由下一层重新并入
+    df_raw = df_input
+    exprs_code, pending = exprs_list, {}
+    if cache is not None:
+        tic = time.perf_counter()
+        lookups, found = cache.lookups, cache.found
+        exprs_code, df_input, pending = cache.prepare(exprs_list, df_input, count=not counted)
+        add_stat(stats, 'time_cache', time.perf_counter() - tic)
+        add_stat(stats, 'cache_lookups', cache.lookups - lookups)
+        add_stat(stats, 'cache_found', cache.found - found)
+
+    tic = time.perf_counter()
     tool = ExprTool()
     # 表达式转脚本
-    codes, G = tool.all(exprs_list, style='polars', template_file='template.py.j2',
+    codes, G = tool.all(exprs_code, style='polars', template_file='template.py.j2',
                         replace=False, regroup=True, format=True,
                         date='date', asset='asset', over_null="partition_by",
                         skip_simplify=True)
+    add_stat(stats, 'time_codegen', time.perf_counter() - tic)
+
+    # 中间列在最后一个使用它的分组算完后就会被删除，输出列则一直保留
+    peak = peak_columns(G)
+    if max_columns is not None and peak > max_columns and len(exprs_list) > 1:
+        logger.info("{}代{}批 预计列数峰值 {} 超出 {}，拆分后计算", gen, batch_id, peak, max_columns)
+        new_results = {}
+        for exprs_half in plan_batches(exprs_list, (len(exprs_list) + 1) // 2):
+            new_results.update(batched_exprs(batch_id, exprs_half, gen, label, split_date, df_raw, cache, max_columns, stats, counted=True))
+        return new_results
 
     cnt = len(exprs_list)
-    logger.info("{}代{}批 代码 开始执行。共 {} 条 表达式", gen, batch_id, cnt)
+    logger.info("{}代{}批 代码 开始执行。共 {} 条 表达式，预计列数峰值 {}", gen, batch_id, cnt, peak)
     tic = time.perf_counter()
 
     globals_ = {}
     exec(codes, globals_)
     df_output = globals_['main'](df_input, filter_last=False)
+    add_stat(stats, 'time_execute', time.perf_counter() - tic)
+    if cache is not None:
+        toc = time.perf_counter()
+        cache.update(df_output, pending)
+        add_stat(stats, 'time_cache', time.perf_counter() - toc)
 
     elapsed_time = time.perf_counter() - tic
     logger.info("{}代{}批 因子 计算完成。共用时 {:.3f} 秒，平均 {:.3f} 秒/条，或 {:.3f} 条/秒", gen, batch_id, elapsed_time, elapsed_time / cnt, cnt / elapsed_time)
 
     # 计算种群适应度
+    tic = time.perf_counter()
     ic_train, ic_valid = fitness_population(df_output, [k for k, v, c in exprs_list], label=label, split_date=split_date)
+    # 因子值签名，用于名人堂多样性
+    sig = factor_sketch(df_output, [k for k, v, c in exprs_list])
+    add_stat(stats, 'time_fitness', time.perf_counter() - tic)
     logger.info("{}代{}批 适应度 计算完成", gen, batch_id)
 
     # 样本内外适应度提取
     new_results = {}
-    for k, v, c in exprs_list:
+    for i, (k, v, c) in enumerate(exprs_list):
         v = str(v)
         new_results[v] = {'ic_train': get_fitness(k, ic_train),
                           'ic_valid': get_fitness(k, ic_valid),
+                          'sig': sig[i],
                           }
     return new_results
 
 
-def fill_fitness(exprs_old, fitness_results):
-    """填充fitness"""
+def fill_fitness(exprs_old, fitness_results, dates=None, split_date=None, windows=None, series=None):
+    """填充fitness
+
+    参数与`gp_base_cs.helper.fill_fitness`一致，方便切换。时序IC是各资产整段数据的相关系数，没有每日IC序列，
+    样本内外已在`batched_exprs`中按`split_date`切分，这里只取保存的标量，dates、split_date、series不使用
+
+    windows: 不支持滚动窗口评估，必须为None
+    """
+    if windows is not None:
+        raise ValueError('时序IC没有每日IC序列，不支持按滚动窗口评估，请将WINDOWS设为None')
     results = []
     for k, v, c in exprs_old:
         v = str(v)
@@ -1,15 +1,27 @@
 import pickle
+import sys
 from pprint import pprint
 
+import numpy as np
 import pandas as pd
 
+sys.path.append('..')
+from gp_base_cs.ic_store import ICStore  # noqa
+
 with open(f'../log/fitness_cache.pkl', 'rb') as f:
     fitness_results = pickle.load(f)
 
 pprint(fitness_results)
 
-# 转成DataFrame
-df = pd.DataFrame.from_dict(fitness_results, orient='index').reset_index()
+# 转成DataFrame。旧版缓存中可能还有IC序列与因子签名，只留标量
+df = pd.DataFrame.from_dict(fitness_results, orient='index').drop(columns=['ic', 'sig'], errors='ignore').reset_index()
+
+# 从保存的每日IC序列统计全时段指标，不用重算因子
+ic = ICStore('../log/ic_series').load(df['index']).drop('date').to_pandas()
+stats = pd.DataFrame({'ic_all': ic.mean(), 'ir_all': ic.mean() / ic.std(ddof=0),
+                      'hit_rate': (np.sign(ic) == np.sign(ic.mean())).sum() / ic.count(),
+                      'days': ic.count()})
+df = df.merge(stats, left_on='index', right_index=True, how='left')
 print(df)
 
 df.to_excel(f'../log/fitness_cache.xlsx')
@@ -35,24 +35,30 @@ os.chdir(pwd)
 sys.path.append(pwd)
 print("pwd:", os.getcwd())
 # ====================
+import multiprocessing
 import operator
 import pickle
 from datetime import datetime
+from functools import partial
 from itertools import count
 
 import polars as pl
 from deap import base, creator
 from loguru import logger
-import more_itertools
+from tensorboardX import SummaryWriter
 # ==========================
 # !!! 非常重要。给deap打补丁
 from gp_base_cs.deap_patch import *  # noqa
-from gp_base_cs.base import print_population, population_to_exprs, filter_exprs, strings_to_sympy  # noqa
+from gp_base_cs.base import print_population, population_to_exprs, filter_exprs, plan_batches, plan_tasks, share_fitness, strings_to_sympy, input_columns  # noqa
 # ==========================
 # TODO 单资产多因子，计算时序IC,使用gp_base_ts
 # TODO 多资产多因子，计算截面IC,使用gp_base_cs
 from gp_base_cs.custom import add_constants, add_operators, add_factors, RET_TYPE
-from gp_base_cs.helper import batched_exprs, fill_fitness
+from gp_base_cs.helper import MONOTONE_FUNCS, batched_exprs, diversity_penalty, fill_fitness, load_input
+from gp_base_cs.cache import ColumnCache
+from gp_base_cs.ic_store import ICStore, pop_series
+from gp_base_cs.pool import LocalPool
+from gp_base_cs.telemetry import Telemetry
 
 logger.remove()  # 这行很关键，先删除logger自动产生的handler，不然会出现重复输出的问题
 logger.add(sys.stderr, level='INFO')  # 只输出INFO以上的日志
@@ -65,57 +71,136 @@ LABEL_y = 'RETURN_OO_1'
 
 # TODO: 数据准备，脚本将取df_input，可运行`data`下脚本生成
 # 如何准备数据请参考`demo_features.py`
-df_input = pl.read_parquet('data/data.parquet')
+# 只加载add_factors中注册的因子与标签，见后面的load_input
+INPUT_PATH = 'data/data.parquet'
 dt1 = datetime(2021, 1, 1)
 # ======================================
 # 日志路径
 LOG_DIR = Path('log')
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 
-# TODO 种群如果非常大，但内存比较小，可以分批计算，每次计算BATCH_SIZE个个体
+# TODO 种群如果非常大，但内存比较小，可以分批计算，每次最多计算BATCH_SIZE个个体。None表示不限制
 BATCH_SIZE = 50
+# TODO 每批计算时新增列(输出列与中间列)的内存预算，批大小按此动态调整
+BATCH_MAX_BYTES = 8 * 1024 ** 3
 DIVIDE_SIZE = 2
-
-
-def map_exprs(evaluate, invalid_ind, gen, label, split_date):
+# TODO 子表达式缓存的内存上限，跨批、跨代复用热门子树。设为None表示不缓存
+CACHE_MAX_BYTES = 4 * 1024 ** 3
+column_cache = None if CACHE_MAX_BYTES is None else ColumnCache(max_bytes=CACHE_MAX_BYTES)
+# TODO 多进程计算的进程数，每个进程的polars线程数为CPU核数/进程数。None表示在本进程中逐批计算
+# 注意：每个进程都有BATCH_MAX_BYTES与CACHE_MAX_BYTES的内存开销
+N_JOBS = None
+# TODO 单条表达式的计算量上限，见`expr_cost`，超出的不参与计算。None表示不限制
+MAX_COST = None
+# TODO 滚动窗口分界，如[datetime(2018, 1, 1), datetime(2019, 1, 1), datetime(2020, 1, 1), datetime(2021, 1, 1)]
+# 以各窗口IC均值与跨窗口稳定性为目标。None表示按dt1切分样本内外。只有gp_base_cs支持
+WINDOWS = None
+# TODO 多样性惩罚系数。第0个适应度乘以(1 - 系数×与名人堂的最大|相关性|)，相关性由因子签名估计。None表示不惩罚
+DIVERSITY_WEIGHT = None
+# TODO 岛屿数。大于1时种群分成多个子种群独立进化，每隔5代迁移最好的5个个体，所有岛的新个体仍一起评估
+N_ISLANDS = 1
+# TODO 每批计算的超时秒数，超时的慢表达式适应度记为NaN。需要N_JOBS不为None。None表示不限制
+BATCH_TIMEOUT = None
+# 每代性能记录，写入TensorBoard与Parquet
+telemetry = Telemetry(LOG_DIR / 'telemetry')
+
+
+def map_exprs(evaluate, invalid_ind, gen, label, split_date, halloffame=None):
     """原本是一个普通的map或多进程map，个体都是独立计算
     但这里考虑到表达式很相似，可以重复利用公共子表达式，
     所以决定种群一起进行计算，返回结果评估即可
+
+    halloffame: 名人堂，用于多样性惩罚
     """
     g = next(gen)
     # 保存原始表达式，立即保存是防止崩溃后丢失信息, 注意：这里没有存fitness
-    with open(LOG_DIR / f'exprs_{g:04d}.pkl', 'wb') as f:
-        pickle.dump(invalid_ind, f)
-
-    # 读取历史fitness
-    try:
-        with open(LOG_DIR / f'fitness_cache.pkl', 'rb') as f:
-            fitness_results = pickle.load(f)
-    except FileNotFoundError:
-        fitness_results = {}
+    with telemetry.timer('io'):
+        with open(LOG_DIR / f'exprs_{g:04d}.pkl', 'wb') as f:
+            pickle.dump(invalid_ind, f)
+
+        # 读取历史fitness
+        try:
+            with open(LOG_DIR / f'fitness_cache.pkl', 'rb') as f:
+                fitness_results = pickle.load(f)
+        except FileNotFoundError:
+            fitness_results = {}
+
+        # 因子签名单独保存，只有多样性惩罚时才用到
+        signatures = {}
+        if DIVERSITY_WEIGHT is not None:
+            try:
+                with open(LOG_DIR / f'signatures.pkl', 'rb') as f:
+                    signatures = pickle.load(f)
+            except FileNotFoundError:
+                pass
 
     logger.info("表达式转码...")
     # DEAP表达式转sympy表达式。约定以GP_开头，表示遗传编程
-    exprs_list = population_to_exprs(invalid_ind, globals().copy())
+    with telemetry.timer('convert'):
+        exprs_list = population_to_exprs(invalid_ind, globals().copy())
     exprs_old = exprs_list.copy()
-    exprs_list = filter_exprs(exprs_list, pset, RET_TYPE, fitness_results)
+    with telemetry.timer('filter'):
+        exprs_list = filter_exprs(exprs_list, pset, RET_TYPE, fitness_results, MAX_COST, df_input.height, MONOTONE_FUNCS)
 
     if len(exprs_list) > 0:
-        # 单机分批计算，应当优先保证内存可放下，所以用batched，设置最大可支持一次算多少条
-        for batch_id, exprs_batched in enumerate(more_itertools.batched(exprs_list, BATCH_SIZE)):
-            new_results = batched_exprs(batch_id, exprs_batched, g, label, split_date, df_input)
-
-            # 合并历史与最新的fitness
-            fitness_results.update(new_results)
+        with telemetry.timer('evaluate'):
+            if local_pool is not None:
+                # 多进程计算，切成许多小任务，空闲的进程自动领取下一个
+                with telemetry.timer('plan'):
+                    tasks = plan_tasks(exprs_list, N_JOBS, BATCH_SIZE, BATCH_MAX_COLUMNS)
+                for new_results, batch_stats in local_pool.imap_unordered(tasks, g, label, split_date, BATCH_MAX_COLUMNS, BATCH_TIMEOUT):
+                    # 合并历史与最新的fitness
+                    fitness_results.update(new_results)
+                    telemetry.add(batch_stats)
+            else:
+                # 单机分批计算，应当优先保证内存可放下，按内存预算动态决定每批多少条
+                # 共享子树多的表达式分到同一批，公共子表达式消除更充分
+                with telemetry.timer('plan'):
+                    batches = plan_batches(exprs_list, BATCH_SIZE, BATCH_MAX_COLUMNS)
+                for batch_id, exprs_batched in enumerate(batches):
+                    batch_stats = {}
+                    new_results = batched_exprs(batch_id, exprs_batched, g, label, split_date, df_input, column_cache, BATCH_MAX_COLUMNS, batch_stats)
+                    telemetry.add(batch_stats)
+
+                    # 合并历史与最新的fitness
+                    fitness_results.update(new_results)
+
+                if column_cache is not None:
+                    logger.info('子表达式缓存 {} 条，占用 {:.1f} MB，命中率 {:.2%}', len(column_cache), column_cache.nbytes / 1024 ** 2, column_cache.hit_rate)
+
+        # 等价表达式共享适应度
+        share_fitness(exprs_old, fitness_results, MONOTONE_FUNCS)
 
         # 保存适应度，方便下一代使用
-        with open(LOG_DIR / f'fitness_cache.pkl', 'wb') as f:
-            pickle.dump(fitness_results, f)
+        with telemetry.timer('io'):
+            # 每日IC序列与因子签名单独保存，fitness_cache.pkl只留标量
+            ic_store.append(IC_DATES, pop_series(fitness_results))
+            signatures.update(pop_series(fitness_results, 'sig'))
+            with open(LOG_DIR / f'fitness_cache.pkl', 'wb') as f:
+                pickle.dump(fitness_results, f)
     else:
         pass
 
+    # 每日IC序列已保存，改切分日期或窗口只需切片，不用重算因子
+    with telemetry.timer('io'):
+        series = ic_store.get_population(exprs_old, IC_DATES, MONOTONE_FUNCS)
+
     # 取评估函数值，多目标。
-    return fill_fitness(exprs_old, fitness_results)
+    results = fill_fitness(exprs_old, fitness_results, IC_DATES, split_date, WINDOWS, series)
+    if DIVERSITY_WEIGHT is not None:
+        # 与名人堂高度相关的个体打折，只比较签名，不重算因子
+        hof_names = [] if halloffame is None else [str(v) for k, v, c in population_to_exprs(halloffame.items, globals().copy())]
+        results = diversity_penalty(results, exprs_old, signatures, hof_names, DIVERSITY_WEIGHT)
+        # 下一代的名人堂只来自当前名人堂与本代种群，其余签名不会再用到
+        keep = set(hof_names) | {str(v) for k, v, c in exprs_old}
+        signatures = {k: v for k, v in signatures.items() if k in keep}
+        with telemetry.timer('io'):
+            with open(LOG_DIR / f'signatures.pkl', 'wb') as f:
+                pickle.dump(signatures, f)
+
+    # 每代各阶段耗时、缓存命中率、内存峰值等
+    telemetry.commit(g, n_exprs=len(exprs_old), n_evaluated=len(exprs_list))
+    return results
 
 
 # ======================================
@@ -125,6 +210,23 @@ pset = add_constants(pset)
 pset = add_operators(pset)
 pset = add_factors(pset)
 
+local_pool = None
+# 多进程时子进程会重新导入本文件，数据只在主进程中加载，子进程内存映射共享
+if multiprocessing.current_process().name == 'MainProcess':
+    # 只加载用到的字段，并转成float32
+    df_input = load_input(INPUT_PATH, input_columns(pset, LABEL_y))
+    # 每列按float64估算
+    BATCH_MAX_COLUMNS = BATCH_MAX_BYTES // (df_input.height * 8)
+    # 每日IC序列对应的日期，与`rank_ic`一致
+    IC_DATES = df_input.get_column('date').unique().sort().to_numpy()
+    # 每条表达式的每日IC序列
+    ic_store = ICStore(LOG_DIR / 'ic_series')
+    if N_JOBS is not None:
+        local_pool = LocalPool(df_input, LOG_DIR / 'df_input.arrow', N_JOBS, cache_max_bytes=CACHE_MAX_BYTES, func=batched_exprs)
+    elif BATCH_TIMEOUT is not None:
+        # 本进程中的计算无法中断，超时只在多进程时生效
+        logger.warning('BATCH_TIMEOUT需要N_JOBS不为None，单进程计算时不限制超时')
+
 # 可支持多目标优化
 creator.create("FitnessMulti", base.Fitness, weights=FITNESS_WEIGHTS)
 creator.create("Individual", gp.PrimitiveTree, fitness=creator.FitnessMulti)
@@ -152,34 +254,54 @@ stats.register("min", np.nanmin, axis=0)
 stats.register("max", np.nanmax, axis=0)
 
 
-def main(pop=None):
+def main(pop=None, resume_from=None):
+    """resume_from: 检查点路径，从中断处继续，pop将被忽略"""
     # TODO: 伪随机种子，同种子可复现
     random.seed(9527)
 
-    if pop is None:
-        # TODO: 初始种群大小
-        pop = toolbox.population(n=1000)
     # TODO: 名人堂，表示最终选优多少个体
     hof = tools.HallOfFame(1000)
+    # 检查点只读一次，代数从检查点的下一代接着数，`exprs_xxxx.pkl`不会被覆盖
+    state = None if resume_from is None else load_checkpoint(resume_from)
+    start = 0 if state is None else state['gen'] + 1
+    # 名人堂传给map，用于多样性惩罚
+    toolbox.register('map', map_exprs, gen=count(start), label=LABEL_y, split_date=dt1, halloffame=hof)
+
+    if resume_from is not None:
+        pop = []
+    elif pop is None:
+        # TODO: 初始种群大小
+        pop = toolbox.population(n=1000)
+    algorithm = eaMuPlusLambda
+    if N_ISLANDS > 1:
+        algorithm = partial(eaMuPlusLambdaIslands, n_islands=N_ISLANDS, migration_interval=5, migration_size=5)
+
+    # 进化统计与性能记录写入同一个TensorBoard目录
+    writer = SummaryWriter()
+    telemetry.writer = writer
 
     # 使用修改版的eaMuPlusLambda
-    population, logbook = eaMuPlusLambda(pop, toolbox,
-                                         # 选多少个做为下一代，每次生成多少新个体
-                                         mu=150, lambda_=100,
-                                         # 交叉率、变异率，代数
-                                         cxpb=0.5, mutpb=0.1, ngen=2,
-                                         # 名人堂参数
-                                         # alpha=0.05, beta=10, gamma=0.25, rho=0.9,
-                                         stats=stats, halloffame=hof, verbose=True,
-                                         # 早停
-                                         early_stopping_rounds=5)
+    population, logbook = algorithm(pop, toolbox,
+                                    # 选多少个做为下一代，每次生成多少新个体
+                                    mu=150, lambda_=100,
+                                    # 交叉率、变异率，代数
+                                    cxpb=0.5, mutpb=0.1, ngen=2,
+                                    # 名人堂参数
+                                    # alpha=0.05, beta=10, gamma=0.25, rho=0.9,
+                                    stats=stats, halloffame=hof, verbose=True,
+                                    # 早停
+                                    early_stopping_rounds=5,
+                                    # 每代保存检查点，崩溃后可继续
+                                    checkpoint=LOG_DIR / 'checkpoint.pkl', resume_from=state,
+                                    writer=writer)
+    writer.close()
 
     return population, logbook, hof
 
 
 if __name__ == "__main__":
     print('另行执行`tensorboard --logdir=runs`，然后在浏览器中访问`http://localhost:6006/`，可跟踪运行情况')
-    logger.warning('运行前请检查`fitness_cache.pkl`是否要手工删除。数据集、切分时间发生了变化一定要删除，否则重复的表达式不会参与计算')
+    logger.warning('运行前请检查`fitness_cache.pkl`是否要手工删除。数据集发生了变化一定要删除，否则重复的表达式不会参与计算。切分时间、滚动窗口变化不用删除')
 
     # TODO 这演示从从字符串中加载种群，继续优化
     exprs = """
@@ -203,7 +325,11 @@ CLOSE+20
     except FileNotFoundError:
         pop = None
 
-    population, logbook, hof = main(pop=pop)
+    # TODO 崩溃后从检查点继续，如LOG_DIR / 'checkpoint.pkl'。None表示从头开始
+    resume_from = None
+    population, logbook, hof = main(pop=pop, resume_from=resume_from)
+    if local_pool is not None:
+        local_pool.close()
 
     # 保存名人堂
     with open(LOG_DIR / f'hall_of_fame.pkl', 'wb') as f:
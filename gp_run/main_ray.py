@@ -37,8 +37,10 @@ print("pwd:", os.getcwd())
 # ====================
 import operator
 import pickle
-import socket
+import time
+from collections import deque
 from datetime import datetime
+from functools import partial
 from itertools import count
 from pathlib import Path
 
@@ -46,17 +48,21 @@ import polars as pl
 import ray
 from deap import base, creator
 from loguru import logger
-import more_itertools
 from ray.util import ActorPool
+from tensorboardX import SummaryWriter
 # ==========================
 # !!! 非常重要。给deap打补丁
 from gp_base_cs.deap_patch import *  # noqa
-from gp_base_cs.base import print_population, population_to_exprs, filter_exprs
+from gp_base_cs.base import print_population, population_to_exprs, filter_exprs, plan_tasks, share_fitness, input_columns
 # ==========================
 # TODO 单资产多因子，计算时序IC,使用gp_base_ts
 # TODO 多资产多因子，计算截面IC,使用gp_base_cs
 from gp_base_cs.custom import add_constants, add_operators, add_factors, RET_TYPE
-from gp_base_cs.helper import batched_exprs, fill_fitness
+from gp_base_cs.helper import MONOTONE_FUNCS, batched_exprs, diversity_penalty, fill_fitness, load_input
+from gp_base_cs.cache import ColumnCache
+from gp_base_cs.ic_store import ICStore, pop_series
+from gp_base_cs.pool import nan_fitness
+from gp_base_cs.telemetry import Telemetry, worker_stats
 
 # ==========================
 
@@ -70,6 +76,8 @@ FITNESS_WEIGHTS = (1.0, 1.0)
 LABEL_y = 'RETURN_OO_1'
 
 # TODO: 数据准备，脚本将取df_input，可运行`data`下脚本生成
+# 只需主程序所在机器有数据，由ray分发到各节点
+INPUT_PATH = 'data/data.parquet'
 dt1 = datetime(2021, 1, 1)
 # ======================================
 # 日志路径
@@ -77,6 +85,9 @@ LOG_DIR = Path('log')
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 
 # TODO 初始化时指定要共享的模块，这里用的多资产多因子挖掘
+# TODO 每个actor中子表达式缓存的内存上限。设为None表示不缓存
+CACHE_MAX_BYTES = 4 * 1024 ** 3
+
 ray.init(runtime_env={"py_modules": ['gp_base_cs', 'gp_base_ts']})
 
 
@@ -84,91 +95,194 @@ ray.init(runtime_env={"py_modules": ['gp_base_cs', 'gp_base_ts']})
 class BatchExprActor:
     # 每台机器只运行一个任务，因为polars是多线程
     df = None
-    ip_path = {
-        # TODO 需要提前将数据复制到不同机器对应的目录，数据需要完全一样
-        # 如果对应机器不启用一定要注释
-        # '192.168.28.218': r'D:\alpha_examples-main\data\data.parquet',
-        '127.0.0.1': r'D:\GitHub\alpha_examples\data\data.parquet',
-    }
-
-    def get_nodes_count(self):
-        return len(self.ip_path)
-
-    def get_path_by_ip(self, ips):
-        """IP转数据地址"""
-        # 添加本地IP,方便单机跑多个actor
-        ips = ['127.0.0.1'] + ips
-        for ip in reversed(ips):
-            path = self.ip_path.get(ip, None)
-            if path is not None:
-                return path
-        return None
+    # 子表达式缓存留在actor中，跨批、跨代复用
+    cache = None
+
+    def __init__(self, table):
+        """table为放入对象存储的`pyarrow.Table`
+
+        ray会将对象引用自动解析，每个节点只从主程序拉取一次，存在共享内存中，
+        同一节点上的actor直接映射这些Arrow缓冲区，不再各自复制一份
+        """
+        # rechunk=False，保持零拷贝
+        self.df = pl.from_arrow(table, rechunk=False)
+        print('数据来自对象存储', self.df.shape)
 
     def load_data(self):
         """加载数据"""
-        if self.df is not None:
-            return self.df
-
-        hostname = socket.gethostname()
-        ips = socket.gethostbyname_ex(hostname)
-        print('每个进程只加载一次数据', ips)
-        path = self.get_path_by_ip(ips[2])
-        self.df = pl.read_parquet(path)
         return self.df
 
-    def process(self, batch_id, exprs_list, gen, label, split_date):
+    def process(self, batch_id, exprs_list, gen, label, split_date, max_columns=None):
         """批量计算"""
-        return batched_exprs(batch_id, exprs_list, gen, label, split_date, self.load_data())
+        if self.cache is None and CACHE_MAX_BYTES is not None:
+            self.cache = ColumnCache(max_bytes=CACHE_MAX_BYTES)
+        tic = time.perf_counter()
+        stats = {}
+        new_results = batched_exprs(batch_id, exprs_list, gen, label, split_date, self.load_data(), self.cache, max_columns, stats)
+        return new_results, worker_stats(stats, time.perf_counter() - tic)
 
 
-# TODO 种群如果非常大，但内存比较小，可以分批计算，每次计算BATCH_SIZE个个体
+# TODO 种群如果非常大，但内存比较小，可以分批计算，每次最多计算BATCH_SIZE个个体。None表示不限制
 BATCH_SIZE = 50
-DIVIDE_SIZE = BatchExprActor.get_nodes_count()  # TODO 每个节点启动1个actor，CPU可能占不满
+# TODO 每个actor每批计算时新增列(输出列与中间列)的内存预算，批大小按此动态调整
+BATCH_MAX_BYTES = 8 * 1024 ** 3
+DIVIDE_SIZE = len([n for n in ray.nodes() if n['Alive']])  # TODO 每个节点启动1个actor，CPU可能占不满
 DIVIDE_SIZE = 2  # TODO 单机启动2个actor，可能会cpu占满
-# 根据节点数生成对应数量的actor
-pool = ActorPool([BatchExprActor.remote() for i in range(DIVIDE_SIZE)])
-
-
-def map_exprs(evaluate, invalid_ind, gen, label, split_date):
+# TODO 单条表达式的计算量上限，见`expr_cost`，超出的不参与计算。None表示不限制
+MAX_COST = None
+# TODO 滚动窗口分界，如[datetime(2018, 1, 1), datetime(2019, 1, 1), datetime(2020, 1, 1), datetime(2021, 1, 1)]
+# 以各窗口IC均值与跨窗口稳定性为目标。None表示按dt1切分样本内外。只有gp_base_cs支持
+WINDOWS = None
+# TODO 多样性惩罚系数。第0个适应度乘以(1 - 系数×与名人堂的最大|相关性|)，相关性由因子签名估计。None表示不惩罚
+DIVERSITY_WEIGHT = None
+# TODO 每个actor平均分到的任务数。任务越多越均衡，但公共子表达式消除的范围越小
+TASKS_PER_ACTOR = 4
+# TODO 岛屿数。大于1时种群分成多个子种群独立进化，每隔5代迁移最好的5个个体，所有岛的新个体仍一起评估
+N_ISLANDS = 1
+# TODO 每批计算的超时秒数，超时的慢表达式适应度记为NaN。None表示不限制
+BATCH_TIMEOUT = None
+# 每代性能记录，写入TensorBoard与Parquet
+telemetry = Telemetry(LOG_DIR / 'telemetry')
+
+
+def imap_unordered(tasks, gen, label, split_date):
+    """按完成顺序逐个返回每批的适应度与性能记录"""
+    if BATCH_TIMEOUT is not None:
+        yield from imap_timeout(tasks, gen, label, split_date, BATCH_TIMEOUT)
+        return
+    for batch_id, batch in enumerate(tasks):
+        pool.submit(lambda a, v: a.process.remote(*v, gen, label, split_date, BATCH_MAX_COLUMNS), (batch_id, batch))
+    while pool.has_next():
+        yield pool.get_next_unordered()
+
+
+def imap_timeout(tasks, gen, label, split_date, timeout):
+    """带超时的分发，同`LocalPool`：超时的批对半拆分重算，逐步定位慢表达式，单条仍超时则适应度记为NaN
+
+    `ray.cancel`不能中断同步actor中正在执行的任务，只能结束超时的actor再重建，它的子表达式缓存也一并丢失，
+    其它actor不受影响
+    """
+    global pool
+    batch_ids = count()
+    pending = deque(tasks)
+    idle = list(actors)
+    # ObjectRef -> (actor, 表达式, 开始时间)
+    running = {}
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(idle) > 0:
+            actor, exprs_list = idle.pop(), pending.popleft()
+            ref = actor.process.remote(next(batch_ids), exprs_list, gen, label, split_date, BATCH_MAX_COLUMNS)
+            running[ref] = (actor, exprs_list, time.perf_counter())
+
+        ready, _ = ray.wait(list(running), num_returns=1, timeout=0.1)
+        for ref in ready:
+            actor, exprs_list, tic = running.pop(ref)
+            idle.append(actor)
+            yield ray.get(ref)
+
+        now = time.perf_counter()
+        for ref in [ref for ref, (actor, exprs_list, tic) in running.items() if now - tic > timeout]:
+            actor, exprs_list, tic = running.pop(ref)
+            logger.warning('{}代 有一批计算超过 {} 秒，重启actor', gen, timeout)
+            ray.kill(actor, no_restart=True)
+            actors[actors.index(actor)] = actor = BatchExprActor.remote(table_ref)
+            idle.append(actor)
+            if len(exprs_list) > 1:
+                half = (len(exprs_list) + 1) // 2
+                pending.appendleft(exprs_list[half:])
+                pending.appendleft(exprs_list[:half])
+            else:
+                logger.warning('{}代 表达式计算超时，适应度记为NaN: {}', gen, exprs_list[0][1])
+                yield nan_fitness(exprs_list), {}
+    # 换过的actor也交给ActorPool
+    pool = ActorPool(actors)
+
+
+def map_exprs(evaluate, invalid_ind, gen, label, split_date, halloffame=None):
     """原本是一个普通的map或多进程map，个体都是独立计算
     但这里考虑到表达式很相似，可以重复利用公共子表达式，
     所以决定种群一起进行计算，返回结果评估即可
+
+    halloffame: 名人堂，用于多样性惩罚
     """
     g = next(gen)
     # 保存原始表达式，立即保存是防止崩溃后丢失信息, 注意：这里没有存fitness
-    with open(LOG_DIR / f'exprs_{g:04d}.pkl', 'wb') as f:
-        pickle.dump(invalid_ind, f)
-
-    # 读取历史fitness
-    try:
-        with open(LOG_DIR / f'fitness_cache.pkl', 'rb') as f:
-            fitness_results = pickle.load(f)
-    except FileNotFoundError:
-        fitness_results = {}
+    with telemetry.timer('io'):
+        with open(LOG_DIR / f'exprs_{g:04d}.pkl', 'wb') as f:
+            pickle.dump(invalid_ind, f)
+
+        # 读取历史fitness
+        try:
+            with open(LOG_DIR / f'fitness_cache.pkl', 'rb') as f:
+                fitness_results = pickle.load(f)
+        except FileNotFoundError:
+            fitness_results = {}
+
+        # 因子签名单独保存，只有多样性惩罚时才用到
+        signatures = {}
+        if DIVERSITY_WEIGHT is not None:
+            try:
+                with open(LOG_DIR / f'signatures.pkl', 'rb') as f:
+                    signatures = pickle.load(f)
+            except FileNotFoundError:
+                pass
 
     logger.info("表达式转码...")
     # DEAP表达式转sympy表达式。约定以GP_开头，表示遗传编程
-    exprs_list = population_to_exprs(invalid_ind, globals().copy())
+    with telemetry.timer('convert'):
+        exprs_list = population_to_exprs(invalid_ind, globals().copy())
     exprs_old = exprs_list.copy()
-    exprs_list = filter_exprs(exprs_list, pset, RET_TYPE, fitness_results)
+    with telemetry.timer('filter'):
+        exprs_list = filter_exprs(exprs_list, pset, RET_TYPE, fitness_results, MAX_COST, INPUT_ROWS, MONOTONE_FUNCS)
 
     if len(exprs_list) > 0:
-        # 并行计算，木桶效益，最好多台机器能差不多时间算完
-        new_results = pool.map(lambda a, v: a.process.remote(*v, g, label, split_date), enumerate(more_itertools.batched(exprs_list, BATCH_SIZE)))
-        # new_results = pool.map(lambda a, v: a.process.remote(*v, g, label, split_date), enumerate(more_itertools.divide(DIVIDE_SIZE, exprs_list)))
-
-        for r in new_results:
-            # 合并历史与最新的fitness
-            fitness_results.update(r)
-
-        # 保存适应度，方便下一代使用
-        with open(LOG_DIR / f'fitness_cache.pkl', 'wb') as f:
-            pickle.dump(fitness_results, f)
+        with telemetry.timer('evaluate'):
+            # 并行计算，木桶效益，最好多台机器能差不多时间算完
+            # 切成许多小任务，空闲的actor自动领取下一个，计算量大的先发
+            with telemetry.timer('plan'):
+                tasks = plan_tasks(exprs_list, len(actors), BATCH_SIZE, BATCH_MAX_COLUMNS, TASKS_PER_ACTOR)
+            # 谁先算完先取谁
+            series = {}
+            for r, batch_stats in imap_unordered(tasks, g, label, split_date):
+                telemetry.add(batch_stats)
+                # 每日IC序列与因子签名本代结束时单独保存，fitness_cache.pkl只留标量
+                series.update(pop_series(r))
+                signatures.update(pop_series(r, 'sig'))
+                # 合并历史与最新的fitness
+                fitness_results.update(r)
+
+        # 等价表达式共享适应度
+        share_fitness(exprs_old, fitness_results, MONOTONE_FUNCS)
+        with telemetry.timer('io'):
+            # 等价表达式换算出的序列也在fitness_results中
+            series.update(pop_series(fitness_results))
+            signatures.update(pop_series(fitness_results, 'sig'))
+            ic_store.append(IC_DATES, series)
+            with open(LOG_DIR / f'fitness_cache.pkl', 'wb') as f:
+                pickle.dump(fitness_results, f)
     else:
         pass
 
+    # 每日IC序列已保存，改切分日期或窗口只需切片，不用重算因子
+    with telemetry.timer('io'):
+        series = ic_store.get_population(exprs_old, IC_DATES, MONOTONE_FUNCS)
+
     # 取评估函数值，多目标。
-    return fill_fitness(exprs_old, fitness_results)
+    results = fill_fitness(exprs_old, fitness_results, IC_DATES, split_date, WINDOWS, series)
+    if DIVERSITY_WEIGHT is not None:
+        # 与名人堂高度相关的个体打折，只比较签名，不重算因子
+        hof_names = [] if halloffame is None else [str(v) for k, v, c in population_to_exprs(halloffame.items, globals().copy())]
+        results = diversity_penalty(results, exprs_old, signatures, hof_names, DIVERSITY_WEIGHT)
+        # 下一代的名人堂只来自当前名人堂与本代种群，其余签名不会再用到
+        keep = set(hof_names) | {str(v) for k, v, c in exprs_old}
+        signatures = {k: v for k, v in signatures.items() if k in keep}
+        with telemetry.timer('io'):
+            with open(LOG_DIR / f'signatures.pkl', 'wb') as f:
+                pickle.dump(signatures, f)
+
+    # 每代各阶段耗时、缓存命中率、内存峰值、各actor利用率等
+    telemetry.commit(g, n_exprs=len(exprs_old), n_evaluated=len(exprs_list))
+    return results
 
 
 # ======================================
@@ -178,6 +292,21 @@ pset = add_constants(pset)
 pset = add_operators(pset)
 pset = add_factors(pset)
 
+# 只加载add_factors中注册的因子与标签，以Arrow格式放入对象存储，只放一次
+df_input = load_input(INPUT_PATH, input_columns(pset, LABEL_y))
+table_ref = ray.put(df_input.to_arrow())
+# 每列按float64估算
+INPUT_ROWS = df_input.height
+BATCH_MAX_COLUMNS = BATCH_MAX_BYTES // (INPUT_ROWS * 8)
+# 每日IC序列对应的日期，与`rank_ic`一致
+IC_DATES = df_input.get_column('date').unique().sort().to_numpy()
+# 每条表达式的每日IC序列
+ic_store = ICStore(LOG_DIR / 'ic_series')
+del df_input
+# 根据节点数生成对应数量的actor
+actors = [BatchExprActor.remote(table_ref) for i in range(DIVIDE_SIZE)]
+pool = ActorPool(actors)
+
 # 可支持多目标优化
 creator.create("FitnessMulti", base.Fitness, weights=FITNESS_WEIGHTS)
 creator.create("Individual", gp.PrimitiveTree, fitness=creator.FitnessMulti)
@@ -205,35 +334,58 @@ stats.register("min", np.nanmin, axis=0)
 stats.register("max", np.nanmax, axis=0)
 
 
-def main():
+def main(resume_from=None):
+    """resume_from: 检查点路径，从中断处继续"""
     # TODO: 伪随机种子，同种子可复现
     random.seed(9527)
 
-    # TODO: 初始种群大小
-    pop = toolbox.population(n=1000)
     # TODO: 名人堂，表示最终选优多少个体
     hof = tools.HallOfFame(1000)
+    # 检查点只读一次，代数从检查点的下一代接着数，`exprs_xxxx.pkl`不会被覆盖
+    state = None if resume_from is None else load_checkpoint(resume_from)
+    start = 0 if state is None else state['gen'] + 1
+    # 名人堂传给map，用于多样性惩罚
+    toolbox.register('map', map_exprs, gen=count(start), label=LABEL_y, split_date=dt1, halloffame=hof)
+
+    if resume_from is not None:
+        pop = []
+    else:
+        # TODO: 初始种群大小
+        pop = toolbox.population(n=1000)
+    algorithm = eaMuPlusLambda
+    if N_ISLANDS > 1:
+        algorithm = partial(eaMuPlusLambdaIslands, n_islands=N_ISLANDS, migration_interval=5, migration_size=5)
+
+    # 进化统计与性能记录写入同一个TensorBoard目录
+    writer = SummaryWriter()
+    telemetry.writer = writer
 
     # 使用修改版的eaMuPlusLambda
-    population, logbook = eaMuPlusLambda(pop, toolbox,
-                                         # 选多少个做为下一代，每次生成多少新个体
-                                         mu=150, lambda_=100,
-                                         # 交叉率、变异率，代数
-                                         cxpb=0.5, mutpb=0.1, ngen=2,
-                                         # 名人堂参数
-                                         # alpha=0.05, beta=10, gamma=0.25, rho=0.9,
-                                         stats=stats, halloffame=hof, verbose=True,
-                                         # 早停
-                                         early_stopping_rounds=5)
+    population, logbook = algorithm(pop, toolbox,
+                                    # 选多少个做为下一代，每次生成多少新个体
+                                    mu=150, lambda_=100,
+                                    # 交叉率、变异率，代数
+                                    cxpb=0.5, mutpb=0.1, ngen=2,
+                                    # 名人堂参数
+                                    # alpha=0.05, beta=10, gamma=0.25, rho=0.9,
+                                    stats=stats, halloffame=hof, verbose=True,
+                                    # 早停
+                                    early_stopping_rounds=5,
+                                    # 每代保存检查点，崩溃后可继续
+                                    checkpoint=LOG_DIR / 'checkpoint.pkl', resume_from=state,
+                                    writer=writer)
+    writer.close()
 
     return population, logbook, hof
 
 
 if __name__ == "__main__":
     print('另行执行`tensorboard --logdir=runs`，然后在浏览器中访问`http://localhost:6006/`，可跟踪运行情况')
-    logger.warning('运行前请检查`fitness_cache.pkl`是否要手工删除。数据集、切分时间发生了变化一定要删除，否则重复的表达式不会参与计算')
+    logger.warning('运行前请检查`fitness_cache.pkl`是否要手工删除。数据集发生了变化一定要删除，否则重复的表达式不会参与计算。切分时间、滚动窗口变化不用删除')
 
-    population, logbook, hof = main()
+    # TODO 崩溃后从检查点继续，如LOG_DIR / 'checkpoint.pkl'。None表示从头开始
+    resume_from = None
+    population, logbook, hof = main(resume_from=resume_from)
 
     # 保存名人堂
     with open(LOG_DIR / f'hall_of_fame.pkl', 'wb') as f:
@@ -0,0 +1,146 @@
+"""
+前向分析增量训练
+
+相邻两折的训练集几乎完全重叠，每折都从头训练，大部分时间花在重复的历史数据上。
+增量模式下后一折在前一折模型的基础上继续训练，只用新增的日期，每次重训的成本约等于新增数据量
+
+1. LightGBM：以上一折的模型为`init_model`，只在新增日期上继续加树
+2. 线性模型：累加充分统计量`XᵀX`、`Xᵀy`等，解正规方程得到系数，不再遍历历史数据
+
+注意：后一折依赖前一折，只能逐折训练，不能与`fit_folds`并行。
+`walk_forward`设置了`max_train_size`时，LightGBM早期的树仍然保留，线性模型则会扣除移出窗口的日期
+"""
+from copy import deepcopy
+from typing import Callable, Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sklearn.linear_model import LinearRegression, Ridge
+
+from ml_cs.utils import FeatureMatrix
+
+
+class LinearStats:
+    """线性回归的充分统计量，可增加或扣除样本
+
+    Parameters
+    ----------
+    n_features: int
+        特征数
+    block_rows: int
+        每块行数。转float64累加，临时内存约为 block_rows×特征数
+
+    """
+
+    def __init__(self, n_features: int, block_rows: int = 2 ** 16):
+        self.block_rows = block_rows
+        self.n = 0.0
+        self.sx = np.zeros(n_features)
+        self.sy = 0.0
+        self.sxx = np.zeros((n_features, n_features))
+        self.sxy = np.zeros(n_features)
+
+    def update(self, X: np.ndarray, y: np.ndarray, sign: int = 1) -> 'LinearStats':
+        """累加样本。sign=-1表示扣除，用于滚动窗口"""
+        for i in range(0, len(y), self.block_rows):
+            x = np.asarray(X[i:i + self.block_rows], dtype=np.float64)
+            t = np.asarray(y[i:i + self.block_rows], dtype=np.float64)
+            self.n += sign * len(t)
+            self.sx += sign * x.sum(axis=0)
+            self.sy += sign * t.sum()
+            self.sxx += sign * (x.T @ x)
+            self.sxy += sign * (x.T @ t)
+        return self
+
+    def solve(self, alpha: float = 0.0):
+        """解正规方程，返回系数与截距。alpha>0为岭回归，截距不参与惩罚"""
+        mx = self.sx / self.n
+        my = self.sy / self.n
+        # 中心化后的XᵀX与Xᵀy
+        cxx = self.sxx - self.n * np.outer(mx, mx)
+        cxy = self.sxy - self.n * mx * my
+        # 最小范数解，与LinearRegression一致，特征共线时也能解
+        coef = np.linalg.lstsq(cxx + alpha * np.eye(len(mx)), cxy, rcond=None)[0]
+        return coef, my - mx @ coef
+
+
+def fit_linear(X: np.ndarray, y: np.ndarray, columns: Sequence[str], init_model=None,
+               drop: Optional[tuple] = None, alpha: float = 0.0):
+    """用充分统计量训练线性模型
+
+    Parameters
+    ----------
+    X, y:
+        新增的样本
+    columns:
+        特征名，画系数图时要用
+    init_model:
+        上一折的模型，在其统计量上累加。None表示从头开始
+    drop: tuple
+        (X, y)，移出训练窗口的样本
+    alpha: float
+        0为`LinearRegression`，大于0为`Ridge`
+
+    Returns
+    -------
+    sklearn模型。统计量保存在`stats_`属性中，下一折继续使用
+
+    """
+    stats = LinearStats(len(columns)) if init_model is None else deepcopy(init_model.stats_)
+    stats.update(X, y)
+    if drop is not None:
+        stats.update(*drop, sign=-1)
+
+    model = Ridge(alpha=alpha) if alpha > 0 else LinearRegression()
+    model.coef_, model.intercept_ = stats.solve(alpha)
+    model.n_features_in_ = len(columns)
+    model.feature_names_in_ = np.asarray(columns, dtype=object)
+    model.stats_ = stats
+    return model
+
+
+def fit_incremental(func: Callable, fm: FeatureMatrix, folds: Iterable) -> List:
+    """逐折增量训练
+
+    Parameters
+    ----------
+    func: Callable
+        每折的训练函数，`func(fm, i, train_dt, test_dt, init_model=None, drop_dt=None) -> model`。
+        第一折train_dt为完整训练集，init_model为None；之后train_dt只含新增日期，init_model为上一折的模型，
+        drop_dt为移出训练窗口的日期区间，没有时为None
+    fm: FeatureMatrix
+        特征矩阵
+    folds:
+        `walk_forward`的输出
+
+    Returns
+    -------
+    list
+        各折的模型，按折的顺序
+
+    """
+    models = []
+    last = None
+    for i, train_dt, test_dt in folds:
+        if last is None:
+            model = func(fm, i, train_dt, test_dt)
+        else:
+            # 上一折训练集结束之后的日期为新增，开始之前的日期移出窗口
+            new_start = _next_date(fm, last[1])
+            drop_dt = None if train_dt[0] <= last[0] else (last[0], _prev_date(fm, train_dt[0]))
+            logger.info('{}: 新增 {}/{}，移出 {}', i, new_start, train_dt[1], drop_dt)
+            model = func(fm, i, (new_start, train_dt[1]), test_dt, init_model=models[-1], drop_dt=drop_dt)
+        models.append(model)
+        last = train_dt
+    return models
+
+
+def _next_date(fm: FeatureMatrix, date) -> pd.Timestamp:
+    i = np.searchsorted(fm.dates, np.datetime64(date), side='right')
+    return pd.Timestamp(fm.dates[min(i, len(fm.dates) - 1)])
+
+
+def _prev_date(fm: FeatureMatrix, date) -> pd.Timestamp:
+    i = np.searchsorted(fm.dates, np.datetime64(date), side='left')
+    return pd.Timestamp(fm.dates[max(i - 1, 0)])
@@ -0,0 +1,97 @@
+"""
+多进程并行训练前向分析的各折
+
+1. 特征矩阵保存到磁盘，子进程以内存映射方式只读打开，各进程共享操作系统的同一份页缓存。
+   没有保存过的特征矩阵每次调用都写一次临时目录，多次调用时先`fm.save`到固定目录，之后直接复用
+2. 每个进程限制`OpenMP`/`BLAS`/`polars`线程数，进程数 × 线程数 ≤ CPU核数。
+   LightGBM的`num_threads`不设置时使用`OpenMP`默认线程数，即这里的设置
+3. 不使用`fork`。`polars`的线程池在`fork`后的子进程中会死锁，Windows上也没有`fork`
+
+注意：子进程会重新导入主程序文件，主程序中加载数据、训练等耗时操作要放在`if __name__ == '__main__':`下，
+每折的训练函数要定义在模块顶层
+"""
+import multiprocessing as mp
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+
+from loguru import logger
+
+from ml_cs.utils import FeatureMatrix
+
+# 子进程中的全局变量，由_init_worker设置
+_fm: Optional[FeatureMatrix] = None
+
+THREAD_ENVS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'POLARS_MAX_THREADS')
+
+
+def _init_worker(path: str) -> None:
+    global _fm
+    # 内存映射，不复制
+    _fm = FeatureMatrix.load(path)
+
+
+def _fit(args):
+    k, func, (i, train_dt, test_dt) = args
+    return k, func(_fm, i, train_dt, test_dt)
+
+
+def fit_folds(func: Callable, fm: FeatureMatrix, folds: Iterable, n_jobs: Optional[int] = None,
+              n_threads: Optional[int] = None) -> List:
+    """并行训练各折
+
+    Parameters
+    ----------
+    func: Callable
+        每折的训练函数，`func(fm, i, train_dt, test_dt) -> model`，要定义在模块顶层
+    fm: FeatureMatrix
+        特征矩阵
+    folds:
+        `walk_forward`的输出
+    n_jobs: int
+        进程数。None表示CPU核数与折数的较小值。1表示在本进程中逐折训练，不保存特征矩阵
+    n_threads: int
+        每个进程的线程数。None表示CPU核数平分给各进程
+
+    Returns
+    -------
+    list
+        各折的模型，按折的顺序
+
+    """
+    folds = list(folds)
+    cpu_count = os.cpu_count() or 1
+    n_jobs = min(n_jobs or cpu_count, len(folds))
+    if n_jobs <= 1:
+        return [func(fm, i, train_dt, test_dt) for i, train_dt, test_dt in folds]
+    n_threads = n_threads or max(cpu_count // n_jobs, 1)
+    logger.info('{}折，{}进程 × {}线程', len(folds), n_jobs, n_threads)
+
+    models = [None] * len(folds)
+    with tempfile.TemporaryDirectory() as tmp:
+        # 已由`FeatureMatrix.save`保存或`load`打开的直接复用，否则写到临时目录，调用结束删除
+        path = fm.path
+        if path is None:
+            path = Path(tmp) / 'feature_matrix'
+            fm.save(path)
+            # 临时目录调用结束即删除，不能留给下次复用
+            fm.path = None
+
+        # 子进程启动时读取环境变量，决定线程数。主进程的线程池已创建，不受影响
+        old = {k: os.environ.get(k) for k in THREAD_ENVS}
+        os.environ.update(dict.fromkeys(THREAD_ENVS, str(n_threads)))
+        try:
+            with mp.get_context('spawn').Pool(n_jobs, initializer=_init_worker, initargs=(str(path),)) as pool:
+                args = [(k, func, fold) for k, fold in enumerate(folds)]
+                # 按完成顺序返回，按折的顺序放回
+                for n, (k, model) in enumerate(pool.imap_unordered(_fit, args, chunksize=1)):
+                    models[k] = model
+                    logger.info('{}/{} 第{}折完成', n + 1, len(folds), folds[k][0])
+        finally:
+            for k, v in old.items():
+                if v is None:
+                    del os.environ[k]
+                else:
+                    os.environ[k] = v
+    return models
@@ -2,6 +2,7 @@ from enum import Enum
 
 import joblib
 import numpy as np
+import pandas as pd
 import polars as pl
 from alphainspect.reports import create_3x2_sheet
 from alphainspect.utils import with_factor_quantile
@@ -9,9 +10,9 @@ from loguru import logger
 from matplotlib import pyplot as plt
 from sklearn.metrics import roc_auc_score, classification_report
 
-from ml_cs.config import DATE, ASSET, LABEL, MODEL_FILENAME, INPUT1_PATH, DATA_START, FWD_RET
+from ml_cs.config import DATE, ASSET, LABEL, MODEL_FILENAME, DATA_START, FWD_RET
 from ml_cs.config import load_process_regression, load_process_binary, load_process_unbalance  # noqa
-from ml_cs.utils import load_dates, get_XyOther, walk_forward
+from ml_cs.utils import walk_forward, FeatureMatrix
 
 plt.rcParams["font.sans-serif"] = ["SimHei"]  # 设置字体
 plt.rcParams["axes.unicode_minus"] = False  # 该语句解决图像中的“-”负号的乱码问题
@@ -34,6 +35,8 @@ if method == Method.Binary:
 if method == Method.Unbalance:
     df = load_process_unbalance()
     label_drop_nulls = True
+# 只转换一次，每折取视图
+fm = FeatureMatrix(df, DATE, ASSET, LABEL, FWD_RET, label_drop_nulls=label_drop_nulls)
 
 # %%
 logger.info('加载模型...')
@@ -42,14 +45,16 @@ models = joblib.load(MODEL_FILENAME)
 
 # %% 预测
 def predict():
-    trading_dates = load_dates(INPUT1_PATH, DATE)[DATA_START:]
+    trading_dates = fm.trading_dates()[DATA_START:]
 
     others = []
     for i, train_dt, test_dt in walk_forward(trading_dates,
                                              n_splits=1, max_train_size=None, test_size=None, gap=0):
         start, end = train_dt[0], test_dt[-1]
 
-        X_test, y_test, other = get_XyOther(df, start, end, DATE, ASSET, LABEL, FWD_RET, label_drop_nulls=label_drop_nulls)
+        X_test, y_test, other = fm.get_XyOther(start, end)
+        # 带上列名，线性模型训练时有列名。不复制数据
+        X_test = pd.DataFrame(X_test, columns=fm.columns, copy=False)
 
         y_preds = {}
         for i, model in enumerate(models):
@@ -1,41 +1,61 @@
 import joblib
+import pandas as pd
 from alphainspect.dtree import plot_coef_box
 from loguru import logger
 from matplotlib import pyplot as plt
 from sklearn.linear_model import Lasso, LinearRegression  # noqa
 
-from ml_cs.config import MODEL_FILENAME, INPUT1_PATH, DATE, ASSET, LABEL, DATA_END, FWD_RET, load_process_regression
-from ml_cs.utils import load_dates, walk_forward, get_XyOther
+from ml_cs.config import MODEL_FILENAME, DATE, ASSET, LABEL, DATA_END, FWD_RET, load_process_regression
+from ml_cs.incremental import fit_incremental, fit_linear
+from ml_cs.pool import fit_folds
+from ml_cs.utils import walk_forward, FeatureMatrix
 
 plt.rcParams["font.sans-serif"] = ["SimHei"]  # 设置字体
 plt.rcParams["axes.unicode_minus"] = False  # 该语句解决图像中的“-”负号的乱码问题
 
 # %%
-df = load_process_regression()
-logger.info('开始训练...')
+# TODO 并行训练的进程数。1表示在本进程中逐折训练，交互式`# %%`单元格中也能运行。
+# 多进程要在命令行运行本文件，None表示CPU核数与折数的较小值
+N_JOBS = 1
+# TODO 增量训练。后一折在前一折模型上继续训练，只用新增日期，只能逐折进行
+INCREMENTAL = False
 
 
 # %%
-def fit():
-    trading_dates = load_dates(INPUT1_PATH, DATE)[:DATA_END]
-    models = []
+def fit_fold(fm, i, train_dt, test_dt, init_model=None, drop_dt=None):
+    """训练一折。并行时在子进程中运行，fm为内存映射的特征矩阵
+
+    增量训练时train_dt只含新增日期，init_model为上一折的模型，drop_dt为移出训练窗口的日期区间
+    """
+    for start, end in (train_dt, test_dt):
+        X, y, other = fm.get_XyOther(start, end)
+        break
+
+    if INCREMENTAL:
+        # 累加新增日期的充分统计量，扣除移出窗口的日期，解正规方程
+        drop = None if drop_dt is None else fm.get_XyOther(*drop_dt)[:2]
+        return fit_linear(X, y, fm.columns, init_model=init_model, drop=drop)
 
-    for i, train_dt, test_dt in walk_forward(trading_dates,
-                                             n_splits=5, max_train_size=None, test_size=30, gap=3):
-        for start, end in (train_dt, test_dt):
-            X, y, other = get_XyOther(df, start, end, DATE, ASSET, LABEL, FWD_RET, label_drop_nulls=True)
-            break
+    # 带上列名，画系数图时要用。不复制数据
+    X = pd.DataFrame(X, columns=fm.columns, copy=False)
 
-        model = Lasso(
-            alpha=0.01,
-            max_iter=500,
-            random_state=42,
-        )
-        model = LinearRegression()
-        model.fit(X, y)
-        models.append(model)
+    model = Lasso(
+        alpha=0.01,
+        max_iter=500,
+        random_state=42,
+    )
+    model = LinearRegression()
+    model.fit(X, y)
+    return model
 
-    return models
+
+def fit():
+    trading_dates = fm.trading_dates()[:DATA_END]
+    folds = walk_forward(trading_dates, n_splits=5, max_train_size=None, test_size=30, gap=3)
+    if INCREMENTAL:
+        return fit_incremental(fit_fold, fm, folds)
+    # 各折并行训练，按折的顺序返回
+    return fit_folds(fit_fold, fm, folds, n_jobs=N_JOBS)
 
 
 def evaluate(models):
@@ -45,10 +65,16 @@ def evaluate(models):
 
 
 # %%
-models = fit()
-logger.info('保存模型...')
-joblib.dump(models, MODEL_FILENAME)
+if __name__ == '__main__':
+    df = load_process_regression()
+    # 只转换一次，每折取视图
+    fm = FeatureMatrix(df, DATE, ASSET, LABEL, FWD_RET, label_drop_nulls=True)
+    logger.info('开始训练...')
+
+    models = fit()
+    logger.info('保存模型...')
+    joblib.dump(models, MODEL_FILENAME)
 
-logger.info('加载模型...')
-models = joblib.load(MODEL_FILENAME)
-evaluate(models)
+    logger.info('加载模型...')
+    models = joblib.load(MODEL_FILENAME)
+    evaluate(models)
@@ -8,9 +8,11 @@ from imblearn.over_sampling import SMOTE  # noqa
 from loguru import logger
 from matplotlib import pyplot as plt
 
-from ml_cs.config import MODEL_FILENAME, INPUT1_PATH, DATE, ASSET, LABEL, DATA_END, FWD_RET, categorical_feature
+from ml_cs.config import MODEL_FILENAME, DATE, ASSET, LABEL, DATA_END, FWD_RET, categorical_feature
 from ml_cs.config import load_process_regression, load_process_binary, load_process_unbalance  # noqa
-from ml_cs.utils import load_dates, walk_forward, get_XyOther
+from ml_cs.incremental import fit_incremental
+from ml_cs.pool import fit_folds
+from ml_cs.utils import walk_forward, FeatureMatrix
 
 plt.rcParams["font.sans-serif"] = ["SimHei"]  # 设置字体
 plt.rcParams["axes.unicode_minus"] = False  # 该语句解决图像中的“-”负号的乱码问题
@@ -40,43 +42,55 @@ params = {
     'seed': 42,
 }
 # %%
-df = load_process_unbalance()
-logger.info('开始训练...')
+# TODO 并行训练的进程数。1表示在本进程中逐折训练，交互式`# %%`单元格中也能运行。
+# 多进程要在命令行运行本文件，None表示CPU核数与折数的较小值
+N_JOBS = 1
+# TODO 增量训练。后一折在前一折模型上继续训练，只用新增日期，只能逐折进行
+INCREMENTAL = False
 
 
 # %%
+def fit_fold(fm, i, train_dt, test_dt, init_model=None, drop_dt=None):
+    """训练一折。并行时在子进程中运行，fm为内存映射的特征矩阵
+
+    增量训练时train_dt只含新增日期，init_model为上一折的模型，drop_dt为移出训练窗口的日期区间
+    """
+    ds = []
+    for start, end in (train_dt, test_dt):
+        X, y, other = fm.get_XyOther(start, end)
+
+        if len(ds) == 0:
+            ds.append(lgb.Dataset(X, label=y, feature_name=fm.columns, categorical_feature=categorical_feature))
+        else:
+            ds.append(lgb.Dataset(X, label=y, feature_name=fm.columns, categorical_feature=categorical_feature, reference=ds[0]))
+
+    evals_result = {}
+    model = imlgb.train(
+        params,
+        train_set=ds[0],
+        num_boost_round=200,
+        valid_sets=ds,
+        valid_names=['train', 'valid'],
+        callbacks=[
+            lgb.log_evaluation(10),
+            lgb.early_stopping(50, first_metric_only=False, verbose=True),
+            lgb.record_evaluation(evals_result)
+        ],
+        # LightGBM不能删除旧样本训练出的树，drop_dt不使用
+        init_model=init_model,
+    )
+    # 这里非常重要，否则无法画损失图
+    model.evals_result_ = deepcopy(evals_result)
+    return model
+
+
 def fit():
-    trading_dates = load_dates(INPUT1_PATH, DATE)[:DATA_END]
-
-    models = []
-    for i, train_dt, test_dt in walk_forward(trading_dates,
-                                             n_splits=1, max_train_size=None, test_size=60, gap=3):
-        ds = []
-        for start, end in (train_dt, test_dt):
-            X, y, other = get_XyOther(df, start, end, DATE, ASSET, LABEL, FWD_RET, label_drop_nulls=True)
-
-            if len(ds) == 0:
-                ds.append(lgb.Dataset(X, label=y, categorical_feature=categorical_feature))
-            else:
-                ds.append(lgb.Dataset(X, label=y, categorical_feature=categorical_feature, reference=ds[0]))
-
-        evals_result = {}
-        model = imlgb.train(
-            params,
-            train_set=ds[0],
-            num_boost_round=200,
-            valid_sets=ds,
-            valid_names=['train', 'valid'],
-            callbacks=[
-                lgb.log_evaluation(10),
-                lgb.early_stopping(50, first_metric_only=False, verbose=True),
-                lgb.record_evaluation(evals_result)
-            ],
-        )
-        # 这里非常重要，否则无法画损失图
-        model.evals_result_ = deepcopy(evals_result)
-        models.append(model)
-    return models
+    trading_dates = fm.trading_dates()[:DATA_END]
+    folds = walk_forward(trading_dates, n_splits=1, max_train_size=None, test_size=60, gap=3)
+    if INCREMENTAL:
+        return fit_incremental(fit_fold, fm, folds)
+    # 各折并行训练，按折的顺序返回
+    return fit_folds(fit_fold, fm, folds, n_jobs=N_JOBS)
 
 
 # %% 模型评估
@@ -90,10 +104,16 @@ def evaluate(models):
 
 
 # %%
-models = fit()
-logger.info('保存模型...')
-joblib.dump(models, MODEL_FILENAME)
-
-logger.info('加载模型...')
-models = joblib.load(MODEL_FILENAME)
-evaluate(models)
+if __name__ == '__main__':
+    df = load_process_unbalance()
+    # 只转换一次，每折取视图
+    fm = FeatureMatrix(df, DATE, ASSET, LABEL, FWD_RET, label_drop_nulls=True)
+    logger.info('开始训练...')
+
+    models = fit()
+    logger.info('保存模型...')
+    joblib.dump(models, MODEL_FILENAME)
+
+    logger.info('加载模型...')
+    models = joblib.load(MODEL_FILENAME)
+    evaluate(models)
@@ -1,6 +1,8 @@
 import numbers
-from typing import Tuple
+from pathlib import Path
+from typing import List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 import polars as pl
 from loguru import logger
@@ -146,3 +148,164 @@ def get_XyOther(df: pl.DataFrame, start: pd.Timestamp, end: pd.Timestamp,
     _X = _X[sorted([col for col in _X.columns])]
 
     return _X, _y, _other
+
+
+def get_XyOther_numpy(df: pl.DataFrame, start: Optional[pd.Timestamp], end: Optional[pd.Timestamp],
+                      date: str, asset: str, label: str, *fwd_ret: str,
+                      label_drop_nulls: bool,
+                      block_rows: int = 2 ** 18) -> Tuple[np.ndarray, np.ndarray, pl.DataFrame, List[str]]:
+    """获取X y other，不经过pandas与复合索引
+
+    `get_XyOther`先过滤复制一份，转pandas再复制一份，还建复合索引，大面板内存翻倍。
+    这里只算出保留的行号，再分块取行直接写入float32矩阵，峰值内存约为 原数据 + X + 一块
+
+    Parameters
+    ----------
+    start, end:
+        日期区间。None表示不限
+    label_drop_nulls:bool
+        同`get_XyOther`
+    block_rows: int
+        每块行数
+
+    Returns
+    -------
+    X: np.ndarray
+        行连续的float32矩阵，可直接用于`lightgbm.Dataset`，不再复制
+    y: np.ndarray
+    other: pl.DataFrame
+        含date/asset/target/fwd_ret，与X、y逐行对齐，按date、asset排序
+    columns: list
+        X的列名，已排序，防止不同数据源的列头顺序不同
+
+    """
+    columns = sorted(df.select(pl.exclude(date, asset, label, *fwd_ret)).columns)
+    keep = pl.all_horizontal(pl.exclude(*fwd_ret).is_not_null()) if label_drop_nulls else \
+        pl.all_horizontal(pl.exclude(*fwd_ret, label).is_not_null())
+    if start is not None:
+        keep &= pl.col(date) >= start
+    if end is not None:
+        keep &= pl.col(date) <= end
+    # 只算行号，不复制整表
+    idx = df.lazy().with_row_index('_idx').filter(keep).sort(date, asset).select('_idx').collect().to_series()
+
+    X = np.empty((len(idx), len(columns)), dtype=np.float32)
+    features = df.select(columns)
+    for i in range(0, len(idx), block_rows):
+        X[i:i + block_rows] = features[idx[i:i + block_rows]].cast(pl.Float32).to_numpy(order='c')
+    y = df.get_column(label).gather(idx).to_numpy()
+    other = df.select(date, asset, label, *fwd_ret)[idx]
+    return X, y, other, columns
+
+
+def lgb_dataset(X: np.ndarray, y: np.ndarray, params: dict, init_model=None, **kwargs):
+    """直接由数组构建`lightgbm.Dataset`并立即分箱
+
+    分箱后释放对X的引用(`free_raw_data`)。X不再使用时调用方`del X`，大面板只剩分箱后的数据
+
+    Parameters
+    ----------
+    params: dict
+        训练参数，分箱参数如`max_bin`要与训练时一致
+    init_model:
+        继续训练时的初始模型。`lightgbm.train`要用原始数据算初始分数，此时不提前分箱
+    kwargs:
+        传给`lightgbm.Dataset`，如`feature_name`、`categorical_feature`、`weight`、`reference`
+
+    """
+    import lightgbm as lgb
+    ds = lgb.Dataset(X, label=y, params=params, free_raw_data=True, **kwargs)
+    return ds if init_model is not None else ds.construct()
+
+
+class FeatureMatrix:
+    """特征矩阵缓存
+
+    `get_XyOther`每折都要过滤、去空值、转pandas、建复合索引、排序列。这里只转换一次：
+
+    1. 用`get_XyOther_numpy`转成行连续的float32矩阵，标签转成数组
+    2. 记录每个日期的起始行，每折按日期取行区间，返回的是视图，不复制
+
+    Parameters
+    ----------
+    df: pl.DataFrame
+    date: str
+    asset: str
+    label: str
+    fwd_ret: str
+    label_drop_nulls: bool
+        同`get_XyOther`。训练与预测的去空值规则不同，需各建一个
+
+    """
+
+    def __init__(self, df: pl.DataFrame, date: str, asset: str, label: str, *fwd_ret: str,
+                 label_drop_nulls: bool):
+        self.X, self.y, self.other, self.columns = get_XyOther_numpy(df, None, None, date, asset, label, *fwd_ret,
+                                                                      label_drop_nulls=label_drop_nulls)
+
+        # 每个日期的起始行
+        self.dates, counts = np.unique(self.other.get_column(date).to_numpy(), return_counts=True)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        # 去空值前的完整日历，与`load_dates`一致。整日被剔除的日期也要计入，否则前向分析的折边界会偏移
+        self.calendar = df.get_column(date).unique().sort().to_numpy()
+        # 已保存的目录，见`save`
+        self.path = None
+
+    def __len__(self):
+        return len(self.y)
+
+    def save(self, path) -> None:
+        """保存到目录，子进程可用`load`以内存映射方式只读打开，不复制。`fit_folds`会直接复用该目录"""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / 'X.npy', self.X)
+        np.save(path / 'y.npy', self.y)
+        np.save(path / 'dates.npy', self.dates)
+        np.save(path / 'offsets.npy', self.offsets)
+        np.save(path / 'calendar.npy', self.calendar)
+        np.save(path / 'columns.npy', np.array(self.columns))
+        # 不压缩才能内存映射
+        self.other.write_ipc(path / 'other.arrow', compression='uncompressed')
+        self.path = path
+
+    @classmethod
+    def load(cls, path) -> 'FeatureMatrix':
+        path = Path(path)
+        self = cls.__new__(cls)
+        self.X = np.load(path / 'X.npy', mmap_mode='r')
+        self.y = np.load(path / 'y.npy', mmap_mode='r')
+        self.dates = np.load(path / 'dates.npy')
+        self.offsets = np.load(path / 'offsets.npy')
+        # 旧版保存的目录没有日历
+        self.calendar = np.load(path / 'calendar.npy') if (path / 'calendar.npy').exists() else self.dates
+        self.other = pl.read_ipc(path / 'other.arrow', memory_map=True, rechunk=False)
+        self.columns = np.load(path / 'columns.npy').tolist()
+        self.path = path
+        return self
+
+    def trading_dates(self) -> pd.Series:
+        """日期序列，同`load_dates`，不用再读文件。包含去空值后没有样本的日期"""
+        s = pd.Series(pd.to_datetime(self.calendar))
+        s.index = s.values
+        return s
+
+    def rows(self, start: pd.Timestamp, end: pd.Timestamp) -> slice:
+        """[start, end]日期区间对应的行区间"""
+        i = np.searchsorted(self.dates, np.datetime64(start), side='left')
+        j = np.searchsorted(self.dates, np.datetime64(end), side='right')
+        return slice(self.offsets[i], self.offsets[j])
+
+    def get_XyOther(self, start: pd.Timestamp, end: pd.Timestamp) -> Tuple[np.ndarray, np.ndarray, pl.DataFrame]:
+        """获取X y other，都是视图
+
+        Returns
+        -------
+        X: np.ndarray
+            列顺序同`columns`
+        y: np.ndarray
+        other: pl.DataFrame
+            含date/asset/target/fwd_ret
+
+        """
+        rows = self.rows(start, end)
+        return self.X[rows], self.y[rows], self.other[rows]
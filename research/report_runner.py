@@ -0,0 +1,148 @@
+"""
+多进程批量生成因子报表
+
+1. 所有报表用到的列只读取一次，写成`Arrow IPC`文件，子进程以内存映射方式只读打开，共享同一份页缓存
+2. 画图与生成html主要是单线程的python代码，多进程才能跑满CPU；分位数等计算用的`polars`多线程，
+   所以每个进程限制`polars`线程数，进程数 × 线程数 ≈ CPU核数，进程数再受内存限制
+3. 不使用`fork`。`polars`的线程池在`fork`后的子进程中会死锁，Windows上也没有`fork`
+
+注意：子进程会重新导入主程序文件，主程序中耗时操作要放在`if __name__ == '__main__':`下
+"""
+import multiprocessing as mp
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import polars as pl
+from loguru import logger
+
+# 子进程中的全局变量，由_init_worker设置
+_df: Optional[pl.DataFrame] = None
+
+
+def _init_worker(path: str) -> None:
+    global _df
+    # 子进程只保存报表，不弹窗
+    import matplotlib
+    matplotlib.use('Agg')
+    # 内存映射，不复制
+    _df = pl.read_ipc(path, memory_map=True, rechunk=False)
+
+
+def _report(args) -> Tuple[str, float]:
+    name, factors, columns, output, quantiles, kwargs = args
+    from alphainspect.reports import report_html
+    from alphainspect.utils import with_factor_quantile
+    from matplotlib import pyplot as plt
+
+    tic = time.perf_counter()
+    # 只选列，不复制数据
+    df = _df.select(*columns, *factors)
+    for factor in factors:
+        df = with_factor_quantile(df, factor, quantiles=quantiles, factor_quantile=f'_fq_{factor}')
+
+    report_html(name, factors, df, output, quantiles=0, top_k=0, **kwargs)
+    # report_html不关闭图，进程常驻时要手动释放
+    plt.close('all')
+    return name, time.perf_counter() - tic
+
+
+def auto_jobs(n_tasks: int, task_bytes: int, n_jobs: Optional[int] = None, n_threads: Optional[int] = None) -> Tuple[int, int]:
+    """根据CPU核数与可用内存确定进程数与每个进程的`polars`线程数
+
+    Parameters
+    ----------
+    n_tasks: int
+        报表数，进程数不超过报表数
+    task_bytes: int
+        单个报表计算时的内存估计
+    n_jobs: int
+        进程数。None表示自动
+    n_threads: int
+        每个进程的线程数。None表示CPU核数平分给各进程
+
+    """
+    cpu_count = os.cpu_count() or 1
+    if n_jobs is None:
+        n_jobs = min(n_tasks, cpu_count)
+        try:
+            import psutil
+            n_jobs = min(n_jobs, psutil.virtual_memory().available // max(task_bytes, 1))
+        except ImportError:
+            pass
+        n_jobs = max(int(n_jobs), 1)
+    n_threads = n_threads or max(cpu_count // n_jobs, 1)
+    return n_jobs, n_threads
+
+
+def run_reports(path, factors: Union[Dict[str, List[str]], Sequence[str]], output, *,
+                fwd_ret_1: str = 'FWD_RET', columns: Sequence[str] = ('date', 'asset'),
+                quantiles: int = 9, n_jobs: Optional[int] = None, n_threads: Optional[int] = None,
+                **kwargs) -> Dict[str, float]:
+    """批量生成报表
+
+    Parameters
+    ----------
+    path:
+        特征数据文件，parquet
+    factors:
+        报表名 -> 因子列表。也可以直接是因子列表，每个因子一个报表
+    output:
+        输出目录
+    fwd_ret_1: str
+        收益率列
+    columns:
+        其它需要的列
+    quantiles: int
+        分层数
+    n_jobs: int
+        进程数。None表示根据CPU核数与内存自动确定
+    n_threads: int
+        每个进程`polars`的线程数。None表示CPU核数平分给各进程
+    kwargs:
+        传给`report_html`的其它参数，如`axvlines`
+
+    Returns
+    -------
+    dict
+        报表名 -> 耗时
+
+    """
+    if not isinstance(factors, dict):
+        factors = {f: [f] for f in factors}
+    columns = list(dict.fromkeys([*columns, fwd_ret_1]))
+    # 所有报表用到的列的并集，只读一次
+    union = list(dict.fromkeys(columns + [f for v in factors.values() for f in v]))
+    df = pl.read_parquet(path, columns=union)
+
+    # 每个报表：共享的列 + 分位数列 + 计算与画图时的临时数据，粗略按2倍估计
+    largest = max(len(v) for v in factors.values())
+    task_bytes = df.height * (len(columns) + largest * 2) * 8 * 2
+    n_jobs, n_threads = auto_jobs(len(factors), task_bytes, n_jobs, n_threads)
+    logger.info('{}个报表，{}列，{}行，{}进程 × {}线程', len(factors), len(union), df.height, n_jobs, n_threads)
+
+    args = [(name, v, columns, str(output), quantiles, dict(fwd_ret_1=fwd_ret_1, **kwargs)) for name, v in factors.items()]
+    with tempfile.TemporaryDirectory() as tmp:
+        ipc = Path(tmp) / 'report_input.arrow'
+        # 不压缩才能内存映射
+        df.write_ipc(ipc, compression='uncompressed')
+        del df
+
+        # 子进程启动时读取环境变量，决定polars线程数。主进程的线程池已创建，不受影响
+        old = os.environ.get('POLARS_MAX_THREADS')
+        os.environ['POLARS_MAX_THREADS'] = str(n_threads)
+        try:
+            with mp.get_context('spawn').Pool(n_jobs, initializer=_init_worker, initargs=(str(ipc),)) as pool:
+                # 报表耗时差别大，逐个分配
+                elapsed = {}
+                for name, t in pool.imap_unordered(_report, args, chunksize=1):
+                    elapsed[name] = t
+                    logger.info('{}/{} {} {:.2f}s', len(elapsed), len(args), name, t)
+        finally:
+            if old is None:
+                del os.environ['POLARS_MAX_THREADS']
+            else:
+                os.environ['POLARS_MAX_THREADS'] = old
+    return elapsed
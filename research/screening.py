@@ -0,0 +1,148 @@
+"""
+大量候选因子的相关性筛选
+
+`alphainspect.selection.drop_above_corr_thresh`用pandas计算相关系数矩阵后两两比较，几千个因子时很慢。这里
+
+1. IC序列相关系数矩阵分块矩阵乘，可选float32。有缺失值时按成对有效样本计算，与`pandas.DataFrame.corr`一致
+2. 因子值相关性：每日截面相关系数的均值，按日期分块读取，内存只与块大小有关
+3. 按IC绝对值从高到低贪心保留，与已保留因子相关性超过阈值的剔除
+"""
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import polars as pl
+
+
+def _corr_block(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """两组列之间的相关系数，只用两列都有效的行"""
+    ma, mb = np.isfinite(a), np.isfinite(b)
+    if ma.all() and mb.all():
+        a = a - a.mean(axis=0)
+        b = b - b.mean(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (a.T @ b) / np.sqrt(np.outer((a * a).sum(axis=0), (b * b).sum(axis=0)))
+
+    fa, fb = ma.astype(a.dtype), mb.astype(b.dtype)
+    a, b = np.where(ma, a, 0), np.where(mb, b, 0)
+    n = fa.T @ fb
+    sa, sb = a.T @ fb, fa.T @ b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = a.T @ b - sa * sb / n
+        va = (a * a).T @ fb - sa * sa / n
+        vb = fa.T @ (b * b) - sb * sb / n
+        return cov / np.sqrt(va * vb)
+
+
+def corr_matrix(x: np.ndarray, block: int = 1024, dtype=np.float32) -> np.ndarray:
+    """列之间的相关系数矩阵，分块计算
+
+    Parameters
+    ----------
+    x: np.ndarray
+        行为日期，列为因子，如IC序列
+    block: int
+        每块列数。临时内存约为 行数×block
+    dtype:
+        计算精度。float32快一倍，误差约1e-6
+
+    Returns
+    -------
+    np.ndarray
+        列数×列数
+
+    """
+    x = np.asarray(x, dtype=dtype)
+    n = x.shape[1]
+    corr = np.empty((n, n), dtype=dtype)
+    for i in range(0, n, block):
+        for j in range(i, n, block):
+            c = _corr_block(x[:, i:i + block], x[:, j:j + block])
+            corr[i:i + block, j:j + block] = c
+            corr[j:j + block, i:i + block] = c.T
+    return corr
+
+
+def cs_corr_matrix(df: pl.DataFrame, factors: Sequence[str], *,
+                   date: str = 'date', rank: bool = True,
+                   chunk: int = 20, dtype=np.float32) -> np.ndarray:
+    """因子值的相关系数矩阵，每日截面相关系数的均值
+
+    Parameters
+    ----------
+    df: pl.DataFrame
+        长表，date, asset, 因子...
+    factors:
+        因子列名
+    rank: bool
+        是否先截面排名，即Spearman相关
+    chunk: int
+        每块日期数。临时内存约为 块内行数×因子数
+
+    Returns
+    -------
+    np.ndarray
+        因子数×因子数。某日某因子全缺失或为常数时，该日不参与这对因子的平均
+
+    """
+    factors = list(factors)
+    df = df.select(date, *factors).sort(date)
+    if rank:
+        df = df.with_columns(pl.col(factors).fill_nan(None).rank().over(date))
+    dates, counts = np.unique(df.get_column(date).to_numpy(), return_counts=True)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    total = np.zeros((len(factors), len(factors)), dtype=np.float64)
+    days = np.zeros((len(factors), len(factors)), dtype=np.float64)
+    for k in range(0, len(dates), chunk):
+        start, end = offsets[k], offsets[min(k + chunk, len(dates))]
+        x = df.slice(start, end - start).select(factors).to_numpy().astype(dtype, copy=False)
+        for i in range(k, min(k + chunk, len(dates))):
+            xd = x[offsets[i] - start:offsets[i + 1] - start]
+            c = _corr_block(xd, xd)
+            ok = np.isfinite(c)
+            total += np.where(ok, c, 0)
+            days += ok
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (total / days).astype(dtype)
+
+
+def greedy_prune(corr: np.ndarray, names: Sequence[str], scores: Sequence[float],
+                 thresh: float = 0.8) -> Tuple[List[str], List[Tuple[str, str, float]]]:
+    """按得分从高到低贪心保留，与已保留因子相关性超过阈值的剔除
+
+    Parameters
+    ----------
+    corr: np.ndarray
+        相关系数矩阵
+    names:
+        因子名
+    scores:
+        得分，一般为IC均值的绝对值。nan排在最后
+    thresh: float
+        阈值
+
+    Returns
+    -------
+    cols_to_drop
+        要删除的列
+    above_thresh_pairs
+        (被删除的列, 保留的列, 相关系数)
+
+    """
+    scores = np.nan_to_num(np.asarray(scores, dtype=np.float64), nan=-np.inf)
+    order = np.argsort(-scores, kind='stable')
+    dropped = np.zeros(len(names), dtype=bool)
+    cols_to_drop = []
+    above_thresh_pairs = []
+    for i in order:
+        if dropped[i]:
+            continue
+        # i保留，剔除与之高度相关且得分更低的因子
+        hit = np.abs(corr[i]) > thresh
+        hit[i] = False
+        hit &= ~dropped
+        for j in np.flatnonzero(hit):
+            cols_to_drop.append(names[j])
+            above_thresh_pairs.append((names[j], names[i], float(corr[i, j])))
+        dropped |= hit
+    return cols_to_drop, above_thresh_pairs
@@ -12,13 +12,11 @@ sys.path.append(pwd)
 print("pwd:", os.getcwd())
 # ====================
 import time
-from multiprocessing import get_context
 
-import polars as pl
-from alphainspect.reports import report_html
-from alphainspect.utils import with_factor_quantile
 from loguru import logger
 
+from research.report_runner import run_reports
+
 # 特征数据文件
 INPUT2_PATH = r'M:\preprocessing\data4.parquet'
 # 输出目录
@@ -30,22 +28,6 @@ logger.add(sys.stderr,
            level="INFO", colorize=True)
 
 
-def func(kv):
-    name, factors = kv
-    fwd_ret_1 = 'FWD_RET'
-
-    # 只记录特征，收益不全
-    df = pl.read_parquet(INPUT2_PATH, columns=['date', 'asset', 'NEXT_DOJI4', fwd_ret_1] + factors)
-
-    for factor in factors:
-        df = with_factor_quantile(df, factor, quantiles=9, factor_quantile=f'_fq_{factor}')
-
-    report_html(name, factors, df, output,
-                fwd_ret_1=fwd_ret_1, quantiles=0, top_k=0, axvlines=('2024-01-01',))
-
-    return 0
-
-
 if __name__ == '__main__':
     # 1去极值标准化/2市值中性化/3行业中性化/4行业市值中性化
     factors2 = {
@@ -55,10 +37,11 @@ if __name__ == '__main__':
     t0 = time.perf_counter()
 
     logger.info('开始')
-    # 没必要设置太大，因为部分计算使用的polars多线程，会将CPU跑满
-    # 参考CPU与内存，可以考虑在这填写合适的值，如：4、8
-    with get_context("spawn").Pool(2) as pool:
-        print(list(pool.map(func, factors2.items())))
+    # 列只读取一次，进程间共享。进程数与每个进程的polars线程数根据CPU与内存自动确定，也可用n_jobs、n_threads指定
+    # 也可以直接传因子列表，每个因子一个报表
+    run_reports(INPUT2_PATH, factors2, output,
+                fwd_ret_1='FWD_RET', columns=['date', 'asset', 'NEXT_DOJI4'],
+                quantiles=9, axvlines=('2024-01-01',))
     logger.info('结束')
     logger.info(f'耗时：{time.perf_counter() - t0:.2f}s')
     os.system(f'explorer.exe "{output}"')
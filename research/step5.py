@@ -9,12 +9,14 @@ os.chdir(pwd)
 sys.path.append(pwd)
 # ===============
 # %%
+import numpy as np
 import polars as pl
 from alphainspect.ic import create_ic2_sheet
-from alphainspect.selection import drop_above_corr_thresh
 from alphainspect.utils import select_by_suffix
 from matplotlib import pyplot as plt
 
+from research.screening import corr_matrix, cs_corr_matrix, greedy_prune
+
 INPUT_PATH = r'M:\data3\T1\feature2.parquet'
 df_output = pl.read_parquet(INPUT_PATH)
 
@@ -29,7 +31,13 @@ forward_returns = ['LABEL_OO_5']  # 同一因子，不同持有期对比
 df_ic = create_ic2_sheet(df_output, factors, forward_returns)
 
 df_pa = select_by_suffix(df_ic, '__LABEL_OO_5')
-cols_to_drop, above_thresh_pairs = drop_above_corr_thresh(df_pa.to_pandas(), thresh=0.8)
+# IC序列的相关性。因子多时改用分块矩阵乘，按IC绝对值从高到低保留
+ic = df_pa.select(factors).to_numpy()
+scores = np.abs(np.nanmean(ic, axis=0))
+corr = corr_matrix(ic)
+# 也可以用因子值的相关性，每日截面相关系数的均值
+# corr = cs_corr_matrix(df_output, factors)
+cols_to_drop, above_thresh_pairs = greedy_prune(corr, factors, scores, thresh=0.8)
 # 需要剔除的因子
 print('需要剔除的因子:')
 print(sorted(cols_to_drop))
@@ -0,0 +1,26 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import polars as pl
+import pytest
+
+
+@pytest.fixture
+def make_panel():
+    """面板数据工厂，从2021-01-01起逐日，按日期、资产排序
+
+    `make_panel(n_dates, assets, **columns)`。assets为资产数时资产名为a00、a01...，也可直接传资产名列表。
+    columns为各列的值，长度为 日期数 × 资产数，随机数由各测试自己生成
+    """
+
+    def make(n_dates, assets, **columns):
+        if isinstance(assets, int):
+            assets = [f"a{i:02d}" for i in range(assets)]
+        dates = [datetime(2021, 1, 1) + timedelta(days=i) for i in range(n_dates)]
+        return pl.DataFrame({
+            "date": np.repeat(np.array(dates, dtype="datetime64[us]"), len(assets)),
+            "asset": np.tile(assets, n_dates),
+            **columns,
+        })
+
+    return make
@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from sympy import Function, Symbol
+
+from gp_base_cs import helper as cs_helper
+from gp_base_cs.cache import ColumnCache
+from gp_base_ts import helper as ts_helper
+
+CLOSE, OPEN = Symbol("CLOSE"), Symbol("OPEN")
+ts_mean = Function("ts_mean")
+cs_rank = Function("cs_rank")
+SPLIT_DATE = datetime(2021, 2, 1)
+
+
+def _df_input(make_panel, n_dates=60, n_assets=20):
+    rng = np.random.default_rng(0)
+    n = n_dates * n_assets
+    return make_panel(n_dates, n_assets, CLOSE=rng.random(n) + 1, OPEN=rng.random(n) + 1, LABEL=rng.standard_normal(n))
+
+
+def _exprs(n=8):
+    # 每棵树只有一个时序算子，缓存与否、怎么拆分，空值分区都相同，结果应完全一致
+    return [(f"GP_{i:04d}", cs_rank(ts_mean(CLOSE, i % 4 + 2) * OPEN + i), "#") for i in range(n)]
+
+
+@pytest.mark.parametrize("helper", [cs_helper, ts_helper])
+def test_split_with_cache(make_panel, helper):
+    """列数峰值超限拆分时，下一层要用原始输入，不能重复并入缓存列与行号"""
+    df = _df_input(make_panel)
+    expected = helper.batched_exprs(0, _exprs(), 0, "LABEL", SPLIT_DATE, df, ColumnCache(min_hits=1))
+
+    cache = ColumnCache(min_hits=1)
+    for gen in range(2):
+        # 第二代时已有缓存列
+        results = helper.batched_exprs(0, _exprs(), gen, "LABEL", SPLIT_DATE, df, cache, max_columns=4)
+        assert results.keys() == expected.keys()
+        for k, v in expected.items():
+            np.testing.assert_allclose(results[k]["ic_train"], v["ic_train"])
+            np.testing.assert_allclose(results[k]["ic_valid"], v["ic_valid"])
+    assert len(cache) > 0
+
+
+@pytest.mark.parametrize("helper", [cs_helper, ts_helper])
+def test_split_counts_once(make_panel, helper):
+    """拆分后重新准备缓存，热度与命中次数每条表达式只计一次"""
+    df = _df_input(make_panel)
+    whole, split = ColumnCache(min_hits=1), ColumnCache(min_hits=1)
+    helper.batched_exprs(0, _exprs(), 0, "LABEL", SPLIT_DATE, df, whole)
+    stats = {}
+    helper.batched_exprs(0, _exprs(), 0, "LABEL", SPLIT_DATE, df, split, max_columns=4, stats=stats)
+    assert split.hits == whole.hits
+    # ts_mean(CLOSE, 2)出现在两条表达式中
+    assert whole.hits[str(ts_mean(CLOSE, 2))] == 2
+    assert (split.lookups, split.found) == (whole.lookups, 0)
+    assert (stats["cache_lookups"], stats["cache_found"]) == (split.lookups, split.found)
+
+    # 第二代有命中，统计仍与缓存的计数一致
+    stats = {}
+    lookups, found = split.lookups, split.found
+    helper.batched_exprs(0, _exprs(), 1, "LABEL", SPLIT_DATE, df, split, max_columns=4, stats=stats)
+    assert stats["cache_found"] == split.found - found > 0
+    assert stats["cache_lookups"] == split.lookups - lookups <= whole.lookups
+    assert split.hits[str(ts_mean(CLOSE, 2))] == 4
@@ -0,0 +1,79 @@
+import polars as pl
+from sympy import Function, Symbol
+
+from gp_base_cs.cache import ROW_INDEX, ColumnCache
+
+CLOSE = Symbol("CLOSE")
+ts_mean = Function("ts_mean")
+cs_rank = Function("cs_rank")
+
+
+def _compute(df_input: pl.DataFrame, pending: dict) -> pl.DataFrame:
+    """模拟codegen的输出：新增待缓存列，且行顺序被打乱"""
+    df = df_input.with_columns([(pl.col("CLOSE") * (i + 1)).alias(name) for i, name in enumerate(pending)])
+    return df.reverse()
+
+
+def test_prepare_update_replaces_cached_subtree():
+    cache = ColumnCache(min_hits=1)
+    df = pl.DataFrame({"CLOSE": [1.0, 2.0, 3.0, 4.0]})
+    exprs = [("GP_0", cs_rank(ts_mean(CLOSE, 5)), "#")]
+
+    exprs_code, df_input, pending = cache.prepare(exprs, df)
+    # 原表达式不变，尾部追加待缓存子树，输入并入行号
+    assert exprs_code[0] == exprs[0]
+    assert set(pending.values()) == {"cs_rank(ts_mean(CLOSE, 5))", "ts_mean(CLOSE, 5)"}
+    assert df_input.get_column(ROW_INDEX).to_list() == [0, 1, 2, 3]
+
+    cache.update(_compute(df_input, pending), pending)
+    assert len(cache) == 2
+
+    # 第二次整棵树命中，替换成缓存列，列值按输入行顺序并入
+    exprs_code, df_input, pending = cache.prepare(exprs, df)
+    assert pending == {}
+    name, s = cache.columns["cs_rank(ts_mean(CLOSE, 5))"]
+    assert exprs_code == [("GP_0", Symbol(name), "#")]
+    assert df_input.get_column(name).to_list() == s.to_list()
+    assert cache.hit_rate > 0
+
+
+def test_update_restores_input_row_order():
+    cache = ColumnCache(min_hits=1)
+    df = pl.DataFrame({"CLOSE": [5.0, 1.0, 4.0, 2.0]})
+    _, df_input, pending = cache.prepare([("GP_0", ts_mean(CLOSE, 5), "#")], df)
+
+    cache.update(_compute(df_input, pending), pending)
+    name, s = cache.columns["ts_mean(CLOSE, 5)"]
+    # 输出被打乱，缓存的列仍与df的行对齐
+    assert s.to_list() == [5.0, 1.0, 4.0, 2.0]
+
+
+def test_lru_eviction_under_max_bytes():
+    df = pl.DataFrame({"CLOSE": [1.0, 2.0, 3.0, 4.0]})
+    one_column = df.get_column("CLOSE").estimated_size()
+    cache = ColumnCache(min_hits=1, max_bytes=one_column * 2)
+
+    for d in (2, 3, 4):
+        _, df_input, pending = cache.prepare([("GP_0", ts_mean(CLOSE, d), "#")], df)
+        cache.update(_compute(df_input, pending), pending)
+        assert cache.nbytes <= cache.max_bytes
+    # 最早的被淘汰
+    assert "ts_mean(CLOSE, 2)" not in cache
+    assert "ts_mean(CLOSE, 3)" in cache and "ts_mean(CLOSE, 4)" in cache
+
+    # 命中的移到队尾，下次淘汰的是另一条
+    cache.prepare([("GP_0", ts_mean(CLOSE, 3), "#")], df)
+    _, df_input, pending = cache.prepare([("GP_0", ts_mean(CLOSE, 5), "#")], df)
+    cache.update(_compute(df_input, pending), pending)
+    assert "ts_mean(CLOSE, 3)" in cache and "ts_mean(CLOSE, 4)" not in cache
+
+
+def test_height_change_clears_cache():
+    cache = ColumnCache(min_hits=1)
+    df = pl.DataFrame({"CLOSE": [1.0, 2.0]})
+    _, df_input, pending = cache.prepare([("GP_0", ts_mean(CLOSE, 5), "#")], df)
+    cache.update(_compute(df_input, pending), pending)
+    assert len(cache) == 1
+
+    cache.prepare([("GP_0", ts_mean(CLOSE, 5), "#")], pl.DataFrame({"CLOSE": [1.0, 2.0, 3.0]}))
+    assert len(cache) == 0
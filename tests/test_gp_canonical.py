@@ -0,0 +1,81 @@
+import pytest
+from sympy import Function, Symbol
+
+from gp_base_cs.base import canonical_expr, share_fitness
+from gp_base_cs.helper import MONOTONE_FUNCS as CS_MONOTONE_FUNCS
+from gp_base_ts.helper import MONOTONE_FUNCS as TS_MONOTONE_FUNCS
+
+CLOSE, OPEN = Symbol("CLOSE"), Symbol("OPEN")
+ts_mean = Function("ts_mean")
+ts_rank = Function("ts_rank")
+ts_std_dev = Function("ts_std_dev")
+abs_ = Function("abs_")
+max_ = Function("max_")
+cs_rank = Function("cs_rank")
+
+
+@pytest.mark.parametrize("e,canonical,sign", [
+    # 奇函数，负号提到外面后抵消
+    (-ts_mean(-CLOSE, 5), ts_mean(CLOSE, 5), 1),
+    (ts_mean(OPEN - CLOSE, 5), ts_mean(CLOSE - OPEN, 5), -1),
+    # 根节点取负
+    (OPEN - CLOSE, CLOSE - OPEN, -1),
+    (CLOSE - OPEN, CLOSE - OPEN, 1),
+    # 偶函数内的负号直接去掉
+    (ts_std_dev(-CLOSE, 5), ts_std_dev(CLOSE, 5), 1),
+    (abs_(OPEN - CLOSE), abs_(CLOSE - OPEN), 1),
+    # 参数可交换
+    (max_(OPEN, CLOSE), max_(CLOSE, OPEN), 1),
+    (max_(CLOSE, OPEN), max_(CLOSE, OPEN), 1),
+    # 根节点上的缩放与平移
+    (2 - 3 * ts_mean(CLOSE, 5), ts_mean(CLOSE, 5), -1),
+    (0.5 * ts_mean(CLOSE, 5) + 1, ts_mean(CLOSE, 5), 1),
+    # 不在奇偶函数表中的算子，负号不能提出
+    (ts_rank(-CLOSE, 5), ts_rank(-CLOSE, 5), 1),
+    # 不会退化成单元素
+    (-CLOSE, -CLOSE, 1),
+])
+def test_canonical_expr(e, canonical, sign):
+    assert canonical_expr(e) == (canonical, sign)
+
+
+def test_monotone_funcs_from_fitness_module():
+    e = cs_rank(2 * ts_mean(CLOSE, 5) + 1)
+    # 横截面RankIC：根上的保序变换可去掉
+    assert canonical_expr(e, CS_MONOTONE_FUNCS) == (ts_mean(CLOSE, 5), 1)
+    # 时序Pearson IC：cs_rank改变适应度，不能去掉
+    assert TS_MONOTONE_FUNCS == ()
+    assert canonical_expr(e, TS_MONOTONE_FUNCS) == (e, 1)
+    assert canonical_expr(e) == (e, 1)
+
+
+def test_share_fitness_flips_sign():
+    a, b, c = ts_mean(CLOSE - OPEN, 5), ts_mean(OPEN - CLOSE, 5), -2 * ts_mean(CLOSE - OPEN, 5)
+    exprs_list = [("GP_0", a, "#"), ("GP_1", b, "#"), ("GP_2", c, "#")]
+    fitness_results = {str(a): {"ic_train": 0.1, "ic_valid": 0.05, "ir_train": 1.0, "ir_valid": 0.5}}
+
+    assert share_fitness(exprs_list, fitness_results) == 2
+    assert fitness_results[str(b)] == {"ic_train": -0.1, "ic_valid": -0.05, "ir_train": -1.0, "ir_valid": -0.5}
+    assert fitness_results[str(c)] == fitness_results[str(b)]
+    # 再次调用不重复登记
+    assert share_fitness(exprs_list, fitness_results) == 0
+
+
+def test_share_fitness_registers_canonical():
+    b = ts_mean(OPEN - CLOSE, 5)
+    fitness_results = {str(b): {"ic_train": 0.1}}
+    share_fitness([("GP_0", b, "#")], fitness_results)
+    # 只有取反形式算过，代表表达式也登记上，以后的等价表达式可直接换算
+    assert fitness_results[str(ts_mean(CLOSE - OPEN, 5))] == {"ic_train": -0.1}
+
+
+def test_share_fitness_respects_monotone_funcs():
+    x, r = ts_mean(CLOSE, 5), cs_rank(ts_mean(CLOSE, 5))
+    exprs_list = [("GP_0", x, "#"), ("GP_1", r, "#")]
+
+    fitness_results = {str(x): {"ic_train": 0.1}}
+    assert share_fitness(exprs_list, fitness_results, TS_MONOTONE_FUNCS) == 0
+    assert str(r) not in fitness_results
+
+    assert share_fitness(exprs_list, fitness_results, CS_MONOTONE_FUNCS) == 1
+    assert fitness_results[str(r)] == {"ic_train": 0.1}
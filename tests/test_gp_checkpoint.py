@@ -0,0 +1,73 @@
+import copy
+import random
+
+import numpy as np
+from deap import base, tools
+
+from gp_base_cs.deap_patch import eaMuPlusLambda, load_checkpoint
+
+
+class FitnessMax(base.Fitness):
+    weights = (1.0,)
+
+
+class Individual(list):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.fitness = FitnessMax()
+
+
+class _Writer:
+    def add_scalar(self, *args):
+        pass
+
+
+def _toolbox():
+    def mutate(ind):
+        # 两个随机数发生器都用到，恢复不全时结果不同
+        ind[random.randrange(len(ind))] += float(np.random.standard_normal())
+        return (ind,)
+
+    toolbox = base.Toolbox()
+    toolbox.register("evaluate", lambda ind: (sum(ind),))
+    toolbox.register("map", lambda f, inds: [f(ind) for ind in inds])
+    toolbox.register("mate", tools.cxTwoPoint)
+    toolbox.register("mutate", mutate)
+    toolbox.register("select", tools.selTournament, tournsize=3)
+    toolbox.register("clone", copy.deepcopy)
+    return toolbox
+
+
+def _run(ngen, checkpoint, resume_from=None):
+    random.seed(1)
+    np.random.seed(1)
+    population = [Individual(np.random.standard_normal(4).tolist()) for _ in range(20)]
+    hof = tools.HallOfFame(5)
+    population, logbook = eaMuPlusLambda(population if resume_from is None else [], _toolbox(), mu=20, lambda_=15,
+                                         cxpb=0.5, mutpb=0.4, ngen=ngen, halloffame=hof, verbose=False,
+                                         checkpoint=checkpoint, resume_from=resume_from, writer=_Writer())
+    return population, logbook, hof
+
+
+def test_checkpoint_round_trip(tmp_path):
+    full, full_log, full_hof = _run(5, tmp_path / "full.pkl")
+
+    # 跑到第2代中断，再从检查点继续
+    _run(2, tmp_path / "part.pkl")
+    state = load_checkpoint(tmp_path / "part.pkl")
+    assert state["gen"] == 2
+    assert len(state["population"]) == 20 and len(state["halloffame"]) == 5
+    assert state["logbook"].select("gen") == [0, 1, 2]
+
+    for resume_from in (tmp_path / "part.pkl", load_checkpoint(tmp_path / "part.pkl")):
+        # 打乱随机数状态，检查是否从检查点恢复
+        random.seed(123)
+        np.random.seed(123)
+        resumed, resumed_log, resumed_hof = _run(5, tmp_path / "resumed.pkl", resume_from)
+
+        assert resumed == full
+        assert [ind.fitness.values for ind in resumed] == [ind.fitness.values for ind in full]
+        assert list(resumed_hof) == list(full_hof)
+        assert resumed_log.select("gen") == full_log.select("gen") == [0, 1, 2, 3, 4, 5]
+        assert resumed_log.select("nevals") == full_log.select("nevals")
+        assert load_checkpoint(tmp_path / "resumed.pkl")["random"] == load_checkpoint(tmp_path / "full.pkl")["random"]
@@ -0,0 +1,84 @@
+import numpy as np
+import polars as pl
+from sympy import Function, Symbol
+
+from gp_base_cs import helper as cs_helper
+from gp_base_ts import helper as ts_helper
+
+CLOSE = Symbol("CLOSE")
+ts_mean = Function("ts_mean")
+
+
+def _df(make_panel, n_dates=100, n_assets=200, seed=0):
+    rng = np.random.default_rng(seed)
+    n = n_dates * n_assets
+    a = rng.standard_normal(n)
+    return make_panel(n_dates, n_assets,
+                      A=a,
+                      # 与A相关约0.8
+                      B=0.8 * a + 0.6 * rng.standard_normal(n),
+                      C=rng.standard_normal(n),
+                      D=-a).sample(fraction=1.0, shuffle=True, seed=seed)
+
+
+def _picked(df, n_dates):
+    dates = df.get_column("date").unique().sort()
+    return dates.gather(np.unique(np.linspace(0, len(dates) - 1, min(n_dates, len(dates))).round().astype(int)))
+
+
+def test_cs_sketch_matches_rank_corr(make_panel):
+    df = _df(make_panel)
+    columns = ["A", "B", "C", "D"]
+    sig = cs_helper.factor_sketch(df, columns, dim=1024, n_dates=50)
+    assert sig.shape == (4, 1024) and sig.dtype == np.float32
+    np.testing.assert_allclose(np.linalg.norm(sig, axis=1), 1, rtol=1e-5)
+
+    # 抽样日期上的平均截面秩相关
+    sub = df.filter(pl.col("date").is_in(_picked(df, 50).implode()))
+    ranks = sub.select("date", *[pl.col(c).rank().over("date") for c in columns])
+    true = np.mean([np.corrcoef(g.select(columns).to_numpy().T) for _, g in ranks.group_by("date")], axis=0)
+    np.testing.assert_allclose(sig @ sig.T, true, atol=0.1)
+
+    # 行顺序无关，不同批算出的签名可比
+    np.testing.assert_array_equal(cs_helper.factor_sketch(df.sample(fraction=1.0, shuffle=True, seed=1), ["B"], dim=1024, n_dates=50)[0], sig[1])
+
+
+def test_ts_sketch_matches_ts_corr(make_panel):
+    df = _df(make_panel, n_dates=60, n_assets=100)
+    columns = ["A", "B", "C", "D"]
+    sig = ts_helper.factor_sketch(df, columns, dim=1024, n_dates=40)
+
+    # 抽样日期上各资产时序相关系数的平均
+    sub = df.filter(pl.col("date").is_in(_picked(df, 40).implode()))
+    true = np.mean([np.corrcoef(g.select(columns).to_numpy().T) for _, g in sub.group_by("asset")], axis=0)
+    np.testing.assert_allclose(sig @ sig.T, true, atol=0.1)
+
+
+def test_diversity_penalty():
+    a, b, c, d = ts_mean(CLOSE, 5), ts_mean(CLOSE, 10), ts_mean(CLOSE, 20), ts_mean(CLOSE, 30)
+    exprs_old = [("GP_0", a, "#"), ("GP_1", b, "#"), ("GP_2", c, "#"), ("GP_3", d, "#")]
+    signatures = {
+        str(a): np.array([1.0, 0.0, 0.0], dtype=np.float32),
+        str(b): np.array([-0.6, 0.8, 0.0], dtype=np.float32),
+        str(c): np.array([0.0, 0.0, 1.0], dtype=np.float32),
+        # d没有签名
+    }
+    results = [(0.1, 0.05), (0.2, 0.1), (0.3, 0.2), (0.4, 0.3)]
+    hof_names = [str(a), str(c), "名人堂中没有签名的"]
+
+    got = cs_helper.diversity_penalty(results, exprs_old, signatures, hof_names, 0.5)
+    # 已在名人堂中的不与自己比，a与c不相关
+    assert got[0] == (0.1, 0.05)
+    assert got[2] == (0.3, 0.2)
+    # 第0个适应度乘以 1 - weight × max|corr|，负相关同样打折
+    np.testing.assert_allclose(got[1], (0.2 * (1 - 0.5 * 0.6), 0.1))
+    assert got[3] == (0.4, 0.3)
+    # 不修改传入的列表
+    assert results[1] == (0.2, 0.1)
+
+    # NaN适应度不变，名人堂为空时原样返回
+    nan = [(np.nan, np.nan)] * 4
+    assert np.isnan(cs_helper.diversity_penalty(nan, exprs_old, signatures, hof_names, 0.5)).all()
+    assert cs_helper.diversity_penalty(results, exprs_old, signatures, [], 0.5) == results
+    # 时序版接口一致
+    assert ts_helper.diversity_penalty is cs_helper.diversity_penalty
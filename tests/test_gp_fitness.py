@@ -0,0 +1,100 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from sympy import Function, Symbol
+
+from gp_base_cs import helper as cs_helper
+from gp_base_cs.helper import fill_fitness, split_fitness, window_fitness
+from gp_base_ts import helper as ts_helper
+
+DATES = np.arange("2021-01-01", "2021-01-31", dtype="datetime64[D]").astype("datetime64[us]")
+CLOSE = Symbol("CLOSE")
+ts_mean = Function("ts_mean")
+
+
+def _ic(seed=0):
+    rng = np.random.default_rng(seed)
+    ic = rng.normal(0.05, 0.1, (len(DATES), 3))
+    ic[3, 0] = np.nan
+    # 第2列训练集几乎全空
+    ic[:12, 2] = np.nan
+    return ic
+
+
+def test_split_fitness():
+    ic = _ic()
+    split = datetime(2021, 1, 16)
+    ic_train, ic_valid, ir_train, ir_valid = split_fitness(DATES, ic, split)
+
+    train, valid = ic[:15], ic[15:]
+    np.testing.assert_allclose(ic_train[:2], np.nanmean(train[:, :2], axis=0))
+    np.testing.assert_allclose(ir_train[:2], np.nanmean(train[:, :2], axis=0) / np.nanstd(train[:, :2], axis=0))
+    np.testing.assert_allclose(ic_valid, np.nanmean(valid, axis=0))
+    np.testing.assert_allclose(ir_valid, np.nanmean(valid, axis=0) / np.nanstd(valid, axis=0))
+    # 训练集有效数不足一半
+    assert np.isnan(ic_train[2]) and not np.isnan(ir_train[2])
+
+    # 一维与二维一致
+    for a, b in zip(split_fitness(DATES, ic[:, 1], split), (ic_train, ic_valid, ir_train, ir_valid)):
+        np.testing.assert_allclose(a, b[1])
+
+
+def test_window_fitness():
+    ic = _ic()[:, :2]
+    windows = [datetime(2021, 1, 1), datetime(2021, 1, 11), datetime(2021, 1, 21), datetime(2021, 2, 1)]
+    w = window_fitness(DATES, ic, windows)
+
+    parts = [ic[:10], ic[10:20], ic[20:]]
+    ic_mean = np.array([np.nanmean(p, axis=0) for p in parts])
+    np.testing.assert_allclose(w["ic_mean"], ic_mean)
+    np.testing.assert_allclose(w["ir"], [np.nanmean(p, axis=0) / np.nanstd(p, axis=0) for p in parts])
+    np.testing.assert_allclose(w["ic"], ic_mean.mean(axis=0))
+    np.testing.assert_allclose(w["stability"], ic_mean.mean(axis=0) / ic_mean.std(axis=0))
+    sign = np.sign(ic_mean.mean(axis=0))
+    np.testing.assert_allclose(w["hit_rate"], [(p * sign > 0).sum(axis=0) / (~np.isnan(p)).sum(axis=0) for p in parts])
+    # 斜率按整体IC归一化
+    np.testing.assert_allclose(w["decay"], np.polyfit([-1, 0, 1], ic_mean * sign, 1)[0] / np.abs(ic_mean.mean(axis=0)))
+
+
+def test_fill_fitness_windows():
+    ic = _ic()[:, 0]
+    windows = [datetime(2021, 1, 1), datetime(2021, 1, 11), datetime(2021, 1, 21), datetime(2021, 2, 1)]
+    a, b = ts_mean(CLOSE, 5), ts_mean(CLOSE, 10)
+    exprs_old = [("GP_0", a, "#"), ("GP_1", b, "#"), ("GP_2", -a, "#")]
+    fitness_results = {str(a): {"ic_train": 0.1, "ic_valid": 0.1, "ir_train": 1.0, "ir_valid": 1.0},
+                       str(b): {"ic_train": 0.1, "ic_valid": 0.1, "ir_train": 1.0, "ir_valid": 1.0}}
+    series = {str(a): ic, str(-a): -ic}
+
+    results = fill_fitness(exprs_old, fitness_results, DATES, None, windows, series)
+    w = window_fitness(DATES, ic, windows)
+    assert results[0] == pytest.approx((abs(float(w["ic"])), abs(float(w["stability"]))))
+    # 没有每日IC序列，与其它个体不可比
+    assert np.isnan(results[1]).all()
+    # 没有适应度的个体
+    assert np.isnan(results[2]).all()
+
+
+def test_fill_fitness_split_from_series():
+    split = datetime(2021, 1, 17)
+    # 样本内IC为-0.1，样本外为-0.08，符号翻转的小扰动均值为0
+    ic = np.where(DATES < np.datetime64(split), -0.1, -0.08) + np.tile([0.01, -0.01], len(DATES) // 2)
+    a = ts_mean(CLOSE, 5)
+    # 保存的标量过不了筛选，结果只能来自重新切分
+    fitness_results = {str(a): {"ic_train": 0.0, "ic_valid": 0.0, "ir_train": 0.0, "ir_valid": 0.0}}
+
+    results = fill_fitness([("GP_0", a, "#")], fitness_results, DATES, split, None, {str(a): ic})
+    assert results == [pytest.approx((0.1, 0.08))]
+    # 没有序列时退回保存的标量
+    assert np.isnan(fill_fitness([("GP_0", a, "#")], fitness_results, DATES, split, None, {})[0]).all()
+
+
+def test_ts_helper_same_interface():
+    a = ts_mean(CLOSE, 5)
+    exprs_old = [("GP_0", a, "#")]
+    fitness_results = {str(a): {"ic_train": -0.1, "ic_valid": 0.08}}
+    # 与gp_base_cs.helper的调用方式相同
+    assert ts_helper.fill_fitness(exprs_old, fitness_results, DATES, datetime(2021, 1, 16), None, {}) == [(0.1, 0.08)]
+    assert ts_helper.load_input is cs_helper.load_input
+    with pytest.raises(ValueError):
+        ts_helper.fill_fitness(exprs_old, fitness_results, DATES, None, [datetime(2021, 1, 1)], {})
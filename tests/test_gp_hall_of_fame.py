@@ -0,0 +1,50 @@
+from deap import base
+from deap.tools.support import HallOfFame
+
+import gp_base_cs.deap_patch  # noqa: F401
+
+
+class FitnessMax(base.Fitness):
+    weights = (1.0,)
+
+
+class Individual(str):
+    """字符串即表达式，用于名人堂查重"""
+
+    def __new__(cls, expr, fitness):
+        self = super().__new__(cls, expr)
+        self.fitness = FitnessMax((fitness,))
+        return self
+
+    def __deepcopy__(self, memo):
+        return Individual(str(self), self.fitness.values[0])
+
+
+def test_insert_remove_reinsert_better_duplicate():
+    # 索引在第一次插入时补建
+    hof = HallOfFame(2)
+    hof.update([Individual("a", 1.0), Individual("b", 2.0)])
+    assert hof._index == {"a": 1, "b": 1}
+
+    # a被挤出后，索引中不能残留
+    hof.update([Individual("c", 3.0)])
+    assert [str(i) for i in hof] == ["c", "b"]
+    assert hof._index == {"b": 1, "c": 1}
+
+    # 更好的a可以再次进入
+    hof.update([Individual("a", 4.0)])
+    assert [str(i) for i in hof] == ["a", "c"]
+    assert hof._index == {"a": 1, "c": 1}
+
+    # 已存在的不重复插入
+    hof.update([Individual("a", 5.0)])
+    assert [str(i) for i in hof] == ["a", "c"]
+    assert hof[0].fitness.values == (4.0,)
+
+
+def test_remove_builds_index_before_removing():
+    hof = HallOfFame(3)
+    hof.update([Individual("a", 1.0), Individual("b", 2.0)])
+    del hof._index
+    hof.remove(-1)
+    assert hof._index == {"b": 1}
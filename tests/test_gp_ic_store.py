@@ -0,0 +1,39 @@
+import numpy as np
+
+from gp_base_cs.ic_store import ICStore
+
+DATES = np.arange("2021-01-01", "2021-01-11", dtype="datetime64[D]").astype("datetime64[us]")
+
+
+def _series(names, value):
+    return {k: np.full(len(DATES), value + i, dtype=np.float32) for i, k in enumerate(names)}
+
+
+def test_compact_keeps_latest_series(tmp_path):
+    store = ICStore(tmp_path, max_parts=3)
+    for g in range(7):
+        # 每代都有新表达式，也有重复保存的
+        store.append(DATES, _series([f"A_{g}", "B"], g * 10))
+        assert len(store._parts()) <= 3
+
+    expected = {**{f"A_{g}": g * 10 for g in range(7)}, "B": 61}
+    # 合并后的分片编号接在旧分片之后
+    assert store._parts()[-1].name > "part_000003.parquet"
+    for s in (store, ICStore(tmp_path)):
+        # 从分片读取，不走内存缓存
+        s.memory.clear()
+        got = s.get(expected)
+        assert {k: float(v[0]) for k, v in got.items()} == expected
+        assert set(s.index.values()) <= set(s._parts())
+
+    df = ICStore(tmp_path).load()
+    assert df.height == len(DATES)
+    assert float(df.get_column("B")[0]) == 61
+
+
+def test_compact_single_part(tmp_path):
+    store = ICStore(tmp_path)
+    store.append(DATES, _series(["A"], 1))
+    store.compact()
+    assert len(store._parts()) == 1
+    assert float(store.get(["A"])["A"][0]) == 1
@@ -0,0 +1,99 @@
+import copy
+import random
+
+from deap import base, tools
+
+from gp_base_cs.deap_patch import eaMuPlusLambda, eaMuPlusLambdaIslands, load_checkpoint, save_checkpoint
+
+
+class FitnessMax(base.Fitness):
+    weights = (1.0,)
+
+
+class Individual(list):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.fitness = FitnessMax()
+
+
+class _Writer:
+    def add_scalar(self, *args):
+        pass
+
+
+def _toolbox(evaluated):
+    def evaluate(ind):
+        evaluated.append(ind[0])
+        return (float(ind[0]),)
+
+    def mutate(ind):
+        # 变异只会变差，好个体不会凭空出现
+        ind[0] -= 100
+        return (ind,)
+
+    toolbox = base.Toolbox()
+    toolbox.register("evaluate", evaluate)
+    toolbox.register("map", lambda f, inds: [f(ind) for ind in inds])
+    toolbox.register("mate", tools.cxOnePoint)
+    toolbox.register("mutate", mutate)
+    toolbox.register("select", tools.selBest)
+    toolbox.register("clone", copy.deepcopy)
+    return toolbox
+
+
+def _run(tmp_path, migration_interval, **kwargs):
+    random.seed(0)
+    evaluated = []
+    population = [Individual([i]) for i in range(10)]
+    population, logbook = eaMuPlusLambdaIslands(population, _toolbox(evaluated), mu=7, lambda_=5, cxpb=0.0, mutpb=0.5, ngen=3,
+                                                verbose=False, checkpoint=tmp_path / "checkpoint.pkl", writer=_Writer(),
+                                                n_islands=2, migration_interval=migration_interval, migration_size=1, **kwargs)
+    return population, logbook, evaluated, load_checkpoint(tmp_path / "checkpoint.pkl")
+
+
+def test_islands_migration_and_size(tmp_path):
+    population, logbook, evaluated, state = _run(tmp_path, migration_interval=2)
+
+    # mu=7分成4+3，不丢个体
+    assert len(population) == 7
+    assert [len(island) for island in state["islands"]] == [4, 3]
+    # 所有岛的新个体一起评估，每代最多lambda_=5个
+    assert logbook.select("nevals")[0] == 10
+    assert all(0 < n <= 5 for n in logbook.select("nevals")[1:])
+    assert len(evaluated) == sum(logbook.select("nevals"))
+
+    # 偶数在岛0，奇数在岛1。第2代迁移后，各自最好的个体出现在另一个岛
+    values = [[ind[0] for ind in island] for island in state["islands"]]
+    assert 9 in values[0] and 8 in values[1]
+
+
+def test_islands_without_migration(tmp_path):
+    population, logbook, evaluated, state = _run(tmp_path, migration_interval=10)
+    values = [[ind[0] for ind in island] for island in state["islands"]]
+    assert all(v % 2 == 0 for v in values[0] if v >= 0)
+    assert all(v % 2 == 1 for v in values[1] if v >= 0)
+
+
+def test_resume_islands_from_plain_checkpoint(tmp_path):
+    evaluated = []
+    toolbox = _toolbox(evaluated)
+    population = [Individual([i]) for i in range(10)]
+    for ind in population:
+        ind.fitness.values = toolbox.evaluate(ind)
+    logbook = tools.Logbook()
+    logbook.record(gen=0, nevals=10)
+    save_checkpoint(tmp_path / "plain.pkl", gen=0, population=population, logbook=logbook, halloffame=None)
+
+    # 普通检查点没有islands，重新分配到各岛
+    pop, logbook = eaMuPlusLambdaIslands([], toolbox, mu=7, lambda_=5, cxpb=0.0, mutpb=0.5, ngen=2, verbose=False,
+                                         checkpoint=tmp_path / "islands.pkl", resume_from=tmp_path / "plain.pkl",
+                                         writer=_Writer(), n_islands=3)
+    assert len(pop) == 7
+    assert logbook.select("gen") == [0, 1, 2]
+    assert [len(island) for island in load_checkpoint(tmp_path / "islands.pkl")["islands"]] == [3, 2, 2]
+
+    # 反过来，普通算法也能从岛屿模型的检查点继续
+    pop, logbook = eaMuPlusLambda([], toolbox, mu=7, lambda_=5, cxpb=0.0, mutpb=0.5, ngen=3, verbose=False,
+                                  resume_from=tmp_path / "islands.pkl", writer=_Writer())
+    assert len(pop) == 7
+    assert logbook.select("gen") == [0, 1, 2, 3]
@@ -0,0 +1,121 @@
+import networkx as nx
+from sympy import Function, Symbol
+
+from gp_base_cs.base import _columns, expr_cost, peak_columns, plan_batches, plan_tasks
+
+CLOSE, OPEN = Symbol("CLOSE"), Symbol("OPEN")
+ts_mean = Function("ts_mean")
+ts_rank = Function("ts_rank")
+ts_corr = Function("ts_corr")
+cs_rank = Function("cs_rank")
+
+
+def _dag(nodes, edges):
+    G = nx.DiGraph()
+    for name, gen in nodes.items():
+        G.add_node(name, gen=gen)
+    G.add_edges_from(edges)
+    return G
+
+
+def test_peak_columns_counts_outputs_and_live_intermediates():
+    # _x_0在第1层算出，第3层用完；_x_1只活在第2层
+    G = _dag({"CLOSE": 0, "_x_0": 1, "_x_1": 2, "GP_0": 2, "GP_1": 3},
+             [("CLOSE", "_x_0"), ("_x_0", "_x_1"), ("_x_1", "GP_0"), ("_x_0", "GP_1")])
+    # 2个输出列 + 第2层同时存活的_x_0、_x_1
+    assert peak_columns(G) == 4
+
+
+def test_peak_columns_without_intermediates():
+    G = _dag({"CLOSE": 0, "GP_0": 1, "GP_1": 1}, [("CLOSE", "GP_0"), ("CLOSE", "GP_1")])
+    assert peak_columns(G) == 2
+
+
+def _exprs():
+    # 两族表达式交错到达，族内共享子树
+    exprs = []
+    for i in range(4):
+        exprs.append((f"A_{i}", cs_rank(ts_mean(CLOSE, 5) + i), "#"))
+        exprs.append((f"B_{i}", cs_rank(ts_mean(OPEN, 7) * (i + 2)), "#"))
+    return exprs
+
+
+def test_plan_batches_keeps_every_expression_once():
+    exprs = _exprs()
+    batches = plan_batches(exprs, 3)
+    flat = [e for b in batches for e in b]
+    assert sorted(flat) == sorted(exprs)
+    assert all(len(b) <= 3 for b in batches)
+
+
+def test_plan_batches_groups_shared_subtrees():
+    batches = plan_batches(_exprs(), 4)
+    assert len(batches) == 2
+    for b in batches:
+        # 按到达顺序分批会两族混在一起，按公共子树则每批只有一族
+        assert len({k[0] for k, v, c in b}) == 1
+
+
+def test_plan_batches_respects_max_columns():
+    exprs = _exprs()
+    batches = plan_batches(exprs, None, max_columns=3)
+    for b in batches:
+        cols = set().union(*[_columns(v) for k, v, c in b])
+        assert len(b) == 1 or len(cols) <= 3
+    assert len(batches) == 4
+    assert sorted(e for b in batches for e in b) == sorted(exprs)
+
+
+def test_plan_tasks_splits_by_cost():
+    heavy = ("H_0", ts_corr(CLOSE, OPEN, 5), "#")
+    exprs = _exprs() + [heavy]
+    tasks = plan_tasks(exprs, n_workers=2, tasks_per_worker=2)
+    assert sorted(e for t in tasks for e in t) == sorted(exprs)
+
+    costs = [sum(expr_cost(v) for k, v, c in t) for t in tasks]
+    # 计算量大的先发出，超出目标的表达式单独成一个任务
+    assert costs == sorted(costs, reverse=True)
+    assert tasks[0] == [heavy]
+    target = sum(expr_cost(v) for k, v, c in exprs) / 4
+    assert all(len(t) == 1 or c <= target for t, c in zip(tasks, costs))
+    # 任务比worker多，空闲的worker可以领到下一个
+    assert len(tasks) >= 2 * 2
+
+
+def test_plan_tasks_within_batches():
+    exprs = _exprs()
+    batches = [set(b) for b in plan_batches(exprs, 4)]
+    tasks = plan_tasks(exprs, n_workers=2, batch_size=4, tasks_per_worker=2)
+    # 只在同一批内切分，不破坏公共子树分组
+    assert all(any(set(t) <= b for b in batches) for t in tasks)
+    assert sorted(e for t in tasks for e in t) == sorted(exprs)
+
+
+def test_plan_tasks_small_and_empty():
+    assert plan_tasks([], 4) == []
+    exprs = _exprs()
+    # 总量很小时也不丢表达式，每个任务至少一条
+    tasks = plan_tasks(exprs, n_workers=100)
+    assert len(tasks) == len(exprs)
+    assert sorted(e for t in tasks for e in t) == sorted(exprs)
+
+
+def test_expr_cost_ordering():
+    exprs = [
+        CLOSE,
+        CLOSE + OPEN,
+        cs_rank(CLOSE),
+        ts_mean(CLOSE, 5),
+        ts_rank(CLOSE, 5),
+        ts_mean(CLOSE, 60),
+        ts_corr(CLOSE, OPEN, 20),
+        cs_rank(ts_corr(ts_rank(CLOSE, 20), OPEN, 20)),
+    ]
+    costs = [expr_cost(e) for e in exprs]
+    # 四则运算与原始字段不计，窗口越长、算子越重、嵌套越深越贵
+    assert costs[:2] == [0, 0]
+    assert costs == sorted(costs) and len(set(costs[1:])) == len(costs) - 1
+    assert costs[5] == 12 * costs[3]
+    # 按数据行数线性放大
+    assert expr_cost(exprs[-1], rows=1000) == 1000 * costs[-1]
+    assert expr_cost("不是表达式") == 0
@@ -0,0 +1,127 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from sympy import Function, Symbol
+
+import gp_base_cs.pool
+from gp_base_cs import helper as cs_helper
+from gp_base_cs.base import plan_tasks
+from gp_base_cs.pool import LocalPool, nan_fitness
+from gp_base_ts import helper as ts_helper
+
+CLOSE, OPEN = Symbol("CLOSE"), Symbol("OPEN")
+ts_mean = Function("ts_mean")
+cs_rank = Function("cs_rank")
+SPLIT_DATE = datetime(2021, 1, 20)
+
+
+def _df_input(make_panel, n_dates=30, n_assets=10):
+    rng = np.random.default_rng(0)
+    n = n_dates * n_assets
+    return make_panel(n_dates, n_assets, CLOSE=rng.random(n) + 1, OPEN=rng.random(n) + 1, LABEL=rng.standard_normal(n))
+
+
+def _exprs(n=12):
+    return [(f"GP_{i:04d}", cs_rank(ts_mean(CLOSE, i % 4 + 2) * OPEN + i), "#") for i in range(n)]
+
+
+@pytest.mark.parametrize("helper", [cs_helper, ts_helper])
+def test_local_pool_matches_serial(make_panel, tmp_path, helper):
+    df = _df_input(make_panel)
+    exprs = _exprs()
+    expected = helper.batched_exprs(0, exprs, 0, "LABEL", SPLIT_DATE, df)
+
+    path = tmp_path / "df_input.arrow"
+    pool = LocalPool(df, path, 2, n_threads=1, cache_max_bytes=1024 ** 2, func=helper.batched_exprs)
+    try:
+        results, workers = {}, set()
+        # 小任务，两个进程都有活干
+        for new_results, stats in pool.imap_unordered(plan_tasks(exprs, 2, tasks_per_worker=3), 0, "LABEL", SPLIT_DATE):
+            results.update(new_results)
+            workers.add(stats["worker"])
+            assert stats["busy"] > 0
+    finally:
+        pool.close()
+
+    assert not path.exists()
+    assert len(workers) == 2
+    assert results.keys() == expected.keys()
+    for k, v in expected.items():
+        assert results[k].keys() == v.keys()
+        for name, x in v.items():
+            np.testing.assert_allclose(results[k][name], x, err_msg=f"{k} {name}")
+
+
+class _Clock:
+    """假时钟，sleep时才前进，超时判断不受机器快慢影响"""
+    now = 0.0
+
+    @classmethod
+    def perf_counter(cls):
+        return cls.now
+
+    @classmethod
+    def sleep(cls, seconds):
+        cls.now += seconds
+
+
+class _Result:
+    """按批中表达式名模拟耗时：SLOW永远算不完，W、L分别在0.15、0.25秒后算完"""
+
+    def __init__(self, exprs_list):
+        self.exprs_list = exprs_list
+        self.tic = _Clock.perf_counter()
+        delays = {"SLOW": float("inf"), "W": 0.15, "L": 0.25}
+        self.delay = max(delays.get(k, 0) for k, v, c in exprs_list)
+
+    def ready(self):
+        return _Clock.perf_counter() - self.tic >= self.delay
+
+    def get(self):
+        return {str(v): {"ic_train": 1.0} for k, v, c in self.exprs_list}, {"worker": 0}
+
+
+class _Pool:
+    def __init__(self):
+        self.submitted = []
+
+    def apply_async(self, func, args):
+        self.submitted.append([k for k, v, c in args[0][2]])
+        return _Result(args[0][2])
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def test_imap_timeout_isolates_slow_expression(monkeypatch):
+    monkeypatch.setattr(gp_base_cs.pool, "time", _Clock)
+    pools = [_Pool()]
+    pool = LocalPool.__new__(LocalPool)
+    pool.n_jobs, pool.func, pool.pool = 2, cs_helper.batched_exprs, pools[0]
+    # 超时后重启进程，这里换一个假进程池
+    pool._start = lambda: pools.append(_Pool()) or pools[-1]
+
+    e = {k: ts_mean(CLOSE, i + 2) for i, k in enumerate(["SLOW", "E", "W", "L"])}
+    tasks = [[("SLOW", e["SLOW"], "#"), ("E", e["E"], "#")], [("W", e["W"], "#")], [("L", e["L"], "#")]]
+    results = [r for r, stats in pool.imap_unordered(tasks, 0, "LABEL", SPLIT_DATE, timeout=0.3)]
+
+    # 每条表达式只返回一次，只有慢表达式记为NaN
+    keys = [k for r in results for k in r]
+    assert sorted(keys) == sorted(str(v) for v in e.values())
+    merged = {k: d for r in results for k, d in r.items()}
+    slow = merged[str(e["SLOW"])]
+    assert slow.keys() == nan_fitness([("SLOW", e["SLOW"], "#")])[str(e["SLOW"])].keys()
+    assert np.isnan(list(slow.values())).all()
+    assert all(merged[str(e[k])] == {"ic_train": 1.0} for k in ("E", "W", "L"))
+
+    # 第一次超时对半拆分，第二次定位到单条慢表达式
+    assert len(pools) == 3
+    assert pools[0].submitted[0] == ["SLOW", "E"]
+    assert ["SLOW"] in pools[1].submitted and ["E"] in pools[1].submitted
+    assert pools[2].submitted == []
+    # 与慢批一起被中断的L在重启后原样重算
+    assert ["L"] in pools[1].submitted
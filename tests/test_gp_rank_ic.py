@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import numpy as np
+import polars as pl
+import pytest
+
+from gp_base_cs.helper import rank_ic
+
+
+def _df(make_panel, n_dates=30, n_assets=25, seed=0):
+    rng = np.random.default_rng(seed)
+    n = n_dates * n_assets
+    df = make_panel(n_dates, n_assets,
+                    LABEL=rng.standard_normal(n),
+                    # 有并列值
+                    F0=np.round(rng.standard_normal(n), 1),
+                    F1=rng.standard_normal(n),
+                    F2=rng.standard_normal(n))
+    # 因子与标签都有空值，某日某因子为常数
+    return df.with_columns(
+        pl.when(pl.Series(rng.random(n) < 0.1)).then(None).otherwise(pl.col("F1")).alias("F1"),
+        pl.when(pl.Series(rng.random(n) < 0.05)).then(None).otherwise(pl.col("LABEL")).alias("LABEL"),
+        pl.when(pl.col("date") == datetime(2021, 1, 3)).then(1.0).otherwise(pl.col("F2")).alias("F2"),
+    ).sample(fraction=1.0, shuffle=True, seed=seed)
+
+
+def _reference(df, columns, label):
+    """polars逐日Spearman，成对剔除空值"""
+    return df.group_by("date").agg([
+        pl.corr(pl.col(c).filter(pl.col(c).is_not_null() & pl.col(label).is_not_null()),
+                pl.col(label).filter(pl.col(c).is_not_null() & pl.col(label).is_not_null()),
+                method="spearman").alias(c)
+        for c in columns
+    ]).sort("date").fill_nan(None)
+
+
+@pytest.mark.parametrize("max_elements,n_jobs", [(2 ** 24, None), (200, 2)])
+def test_rank_ic_matches_polars_spearman(make_panel, max_elements, n_jobs):
+    df = _df(make_panel)
+    columns = ["F0", "F1", "F2"]
+    dates, ic = rank_ic(df, columns, "LABEL", max_elements=max_elements, n_jobs=n_jobs)
+
+    expected = _reference(df, columns, "LABEL")
+    np.testing.assert_array_equal(dates, expected.get_column("date").to_numpy())
+    np.testing.assert_allclose(ic, expected.select(columns).to_numpy().astype(float), atol=1e-12)
+    # 常数因子那天无效
+    assert np.isnan(ic[2, 2])
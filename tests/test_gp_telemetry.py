@@ -0,0 +1,59 @@
+from gp_base_cs.telemetry import Telemetry, load_telemetry
+
+
+class _Writer:
+    def add_scalar(self, *args):
+        pass
+
+    def flush(self):
+        pass
+
+
+def _gen(telemetry, gen, busy):
+    telemetry.add({"time_evaluate": 10.0})
+    for worker, b in busy.items():
+        telemetry.add({"worker": worker, "busy": b, "time_exec": b})
+    return telemetry.commit(gen, n_exprs=gen)
+
+
+def test_worker_index_stable_across_generations(tmp_path):
+    telemetry = Telemetry(tmp_path / "telemetry", _Writer())
+    # 进程号排序与首次出现顺序不同
+    row = _gen(telemetry, 0, {900: 4.0, 100: 2.0})
+    assert (row["util_0"], row["util_1"]) == (0.4, 0.2)
+    # 后续各代出现顺序变了，编号不变
+    row = _gen(telemetry, 1, {100: 3.0, 900: 5.0})
+    assert (row["util_0"], row["util_1"]) == (0.5, 0.3)
+    # 新进程500先于900出现，不占用900的编号
+    row = _gen(telemetry, 2, {500: 1.0, 900: 6.0, 100: 7.0})
+    assert (row["util_0"], row["util_1"], row["util_2"]) == (0.6, 0.7, 0.1)
+    # 900被替换后某代没有出现，再下一代新进程沿用其编号
+    row = _gen(telemetry, 3, {100: 8.0, 500: 2.0})
+    assert "util_0" not in row and (row["util_1"], row["util_2"]) == (0.8, 0.2)
+    row = _gen(telemetry, 4, {700: 9.0, 100: 8.0, 500: 2.0})
+    assert (row["util_0"], row["util_1"], row["util_2"]) == (0.9, 0.8, 0.2)
+
+
+def test_parts_per_generation_and_resume(tmp_path):
+    path = tmp_path / "telemetry"
+    telemetry = Telemetry(path, _Writer())
+    for gen in range(4):
+        _gen(telemetry, gen, {} if gen == 0 else {100: 1.0})
+    assert sorted(f.name for f in path.iterdir()) == [f"gen_{gen:04d}.parquet" for gen in range(4)]
+    # 只写本代，之前各代的文件不重写
+    mtime = (path / "gen_0000.parquet").stat().st_mtime_ns
+    _gen(telemetry, 4, {100: 1.0})
+    assert (path / "gen_0000.parquet").stat().st_mtime_ns == mtime
+
+    # 第0代没有worker，列不同也能读回
+    df = load_telemetry(path)
+    assert df["gen"].to_list() == [0, 1, 2, 3, 4]
+    assert df["util_0"].to_list() == [None, 0.1, 0.1, 0.1, 0.1]
+
+    # 从第2代的检查点继续，之后各代以新记录为准
+    telemetry = Telemetry(path, _Writer())
+    _gen(telemetry, 2, {100: 5.0})
+    df = load_telemetry(path)
+    assert df["gen"].to_list() == [0, 1, 2]
+    assert df["util_0"].to_list() == [None, 0.1, 0.5]
+    assert load_telemetry(tmp_path / "missing").is_empty()
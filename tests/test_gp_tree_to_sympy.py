@@ -0,0 +1,50 @@
+import random
+
+import pytest
+from deap import gp
+from expr_codegen.codes import sources_to_exprs
+
+import gp_base_cs.base as base
+import gp_base_cs.deap_patch  # noqa: F401 类型不匹配时重试的gp.generate
+from gp_base_cs.base import population_to_exprs, stringify_for_sympy, tree_to_sympy
+from gp_base_cs.custom import RET_TYPE, add_constants, add_factors, add_operators
+
+
+@pytest.fixture(scope="module")
+def pset():
+    pset = gp.PrimitiveSetTyped("MAIN", [], RET_TYPE)
+    pset = add_constants(pset)
+    pset = add_operators(pset)
+    return add_factors(pset)
+
+
+def _population(pset, n, seed=0):
+    random.seed(seed)
+    return [gp.PrimitiveTree(gp.genHalfAndHalf(pset, min_=2, max_=5)) for _ in range(n)]
+
+
+def test_same_as_sources_to_exprs(pset):
+    population = _population(pset, 3000)
+    new = population_to_exprs(population, {})
+    # 旧路径：拼成源代码再解析
+    sources = [f"GP_{i:04d}={stringify_for_sympy(t)}" for i, t in enumerate(population)]
+    raw, old = sources_to_exprs({}, "\n".join(sources), convert_xor=False)
+    assert [k for k, v, c in new] == [k for k, v, c in old]
+    for (k, a, _), (_, b, _) in zip(new, old):
+        # 字符串是fitness_cache.pkl的键，也要一致
+        assert a == b and str(a) == str(b), k
+
+
+def test_memo_lru(pset, monkeypatch):
+    population = _population(pset, 50, seed=1)
+    monkeypatch.setattr(base, "_SYMPY_MEMO", base.OrderedDict())
+    monkeypatch.setattr(base, "_SYMPY_MEMO_MAX", 20)
+
+    hot = population[0]
+    expected = tree_to_sympy(hot, {}, {})
+    for t in population[1:]:
+        tree_to_sympy(t, {})
+        # 常用的子树一直被访问，不会被淘汰
+        assert tree_to_sympy(hot, {}) == expected
+        assert len(base._SYMPY_MEMO) <= 20
+    assert next(reversed(base._SYMPY_MEMO))[0] == hot[0].name
@@ -0,0 +1,71 @@
+from datetime import datetime
+
+import numpy as np
+import polars as pl
+import pytest
+
+from gp_base_ts.helper import fitness_population, fitness_population_polars, ts_corr
+
+SPLIT_DATE = datetime(2021, 3, 1)
+COLUMNS = [f"GP_{i:04d}" for i in range(6)]
+
+
+def _df(make_panel, seed=0):
+    rng = np.random.default_rng(seed)
+    assets = ["A", "B", "C", "D"]
+    n = 120 * len(assets)
+    y = rng.standard_normal(n)
+    # 每个资产各自的相关性
+    beta = rng.uniform(-0.5, 0.5, (len(COLUMNS), len(assets)))[:, np.tile(np.arange(len(assets)), 120)]
+    df = make_panel(120, assets, LABEL=y,
+                    **{c: y * beta[i] + rng.standard_normal(n) + 1000 * i for i, c in enumerate(COLUMNS)})
+    # D上市晚于切分日期，训练集为空
+    df = df.filter((pl.col("asset") != "D") | (pl.col("date") >= datetime(2021, 3, 22)))
+    n = df.height
+    return df.with_columns(
+        # 随机空值，某资产某日为NaN，标签也有空值
+        *[pl.when(pl.Series(rng.random(n) < 0.1)).then(None).otherwise(pl.col(c)).alias(c) for c in COLUMNS[:3]],
+        pl.when((pl.col("asset") == "B") & (pl.col("date") == datetime(2021, 1, 10)))
+        .then(float("nan")).otherwise(pl.col("GP_0003")).alias("GP_0003"),
+        pl.when(pl.col("date").dt.day() == 5).then(None).otherwise(pl.col("LABEL")).alias("LABEL"),
+    ).sample(fraction=1.0, shuffle=True, seed=seed)
+
+
+def _reference(df, columns, label):
+    """polars逐资产Pearson，成对剔除空值"""
+    return df.group_by("asset").agg([
+        pl.corr(pl.col(c), pl.col(label), method="pearson", ddof=0, propagate_nans=False).alias(c)
+        for c in columns
+    ]).sort("asset").fill_nan(None)
+
+
+def _assets(df):
+    return df.get_column("asset").unique().sort()
+
+
+@pytest.mark.parametrize("max_elements,n_jobs", [(2 ** 24, None), (500, 2)])
+def test_ts_corr_matches_polars(make_panel, max_elements, n_jobs):
+    df = _df(make_panel)
+    ic_train, ic_valid, n_train, n_valid = ts_corr(df, COLUMNS, "LABEL", SPLIT_DATE,
+                                                   max_elements=max_elements, n_jobs=n_jobs)
+
+    train = _reference(df.filter(pl.col("date") < SPLIT_DATE), COLUMNS, "LABEL")
+    valid = _reference(df.filter(pl.col("date") >= SPLIT_DATE), COLUMNS, "LABEL")
+    # 训练集没有D，按资产对齐
+    train = pl.DataFrame({"asset": _assets(df)}).join(train, on="asset", how="left")
+    np.testing.assert_allclose(ic_train, train.select(COLUMNS).to_numpy().astype(float), atol=1e-9)
+    np.testing.assert_allclose(ic_valid, valid.select(COLUMNS).to_numpy().astype(float), atol=1e-9)
+
+    assert n_train.tolist() == [59, 59, 59, 0]
+    assert n_valid.tolist() == [61, 61, 61, 40]
+    # NaN只影响所在分段
+    assert np.isnan(ic_train[1, 3]) and not np.isnan(ic_valid[1, 3])
+
+
+def test_fitness_population_matches_polars(make_panel):
+    df = _df(make_panel)
+    for a, b in zip(fitness_population(df, COLUMNS, "LABEL", SPLIT_DATE),
+                    fitness_population_polars(df, COLUMNS, "LABEL", SPLIT_DATE)):
+        assert a.keys() == b.keys()
+        np.testing.assert_allclose([a[k] for k in COLUMNS],
+                                   [np.nan if b[k] is None else b[k] for k in COLUMNS], atol=1e-9)
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from ml_cs.utils import FeatureMatrix, load_dates, walk_forward
+
+
+def _df(make_panel, n_dates=40, n_assets=5, seed=0):
+    rng = np.random.default_rng(seed)
+    n = n_dates * n_assets
+    df = make_panel(n_dates, n_assets, F0=rng.standard_normal(n), LABEL=rng.standard_normal(n), RET=rng.standard_normal(n))
+    # 中间某日标签全空，最后几日标签未知
+    return df.with_columns(
+        pl.when((pl.col("date") == datetime(2021, 1, 10)) | (pl.col("date") > datetime(2021, 2, 5)))
+        .then(None).otherwise(pl.col("LABEL")).alias("LABEL"))
+
+
+def test_trading_dates_matches_load_dates(make_panel, tmp_path):
+    df = _df(make_panel)
+    df.write_parquet(tmp_path / "data.parquet")
+    expected = load_dates(tmp_path / "data.parquet", "date")
+
+    fm = FeatureMatrix(df, "date", "asset", "LABEL", "RET", label_drop_nulls=True)
+    # 整日被剔除的日期仍在日历中
+    assert len(fm.dates) < len(expected)
+    pd.testing.assert_series_equal(fm.trading_dates(), expected, check_names=False)
+    assert list(walk_forward(fm.trading_dates(), n_splits=3, test_size=5)) == \
+           list(walk_forward(expected, n_splits=3, test_size=5))
+
+    fm.save(tmp_path / "fm")
+    pd.testing.assert_series_equal(FeatureMatrix.load(tmp_path / "fm").trading_dates(), expected, check_names=False)
+
+
+def test_rows_skip_dropped_dates(make_panel):
+    fm = FeatureMatrix(_df(make_panel), "date", "asset", "LABEL", "RET", label_drop_nulls=True)
+    X, y, other = fm.get_XyOther(datetime(2021, 1, 9), datetime(2021, 1, 11))
+    assert other.get_column("date").unique().sort().to_list() == [datetime(2021, 1, 9), datetime(2021, 1, 11)]
+    assert len(y) == 10
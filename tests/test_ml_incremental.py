@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from sklearn.linear_model import LinearRegression, Ridge
+
+from ml_cs.incremental import LinearStats, fit_incremental, fit_linear
+from ml_cs.utils import FeatureMatrix, walk_forward
+
+
+def _fm(make_panel, n_dates=80, n_assets=15, n_features=4, seed=0):
+    rng = np.random.default_rng(seed)
+    n = n_dates * n_assets
+    X = rng.standard_normal((n, n_features))
+    df = make_panel(n_dates, n_assets,
+                    **{f"F{j}": X[:, j] for j in range(n_features)},
+                    LABEL=X @ rng.standard_normal(n_features) + rng.standard_normal(n),
+                    RET=rng.standard_normal(n))
+    return FeatureMatrix(df, "date", "asset", "LABEL", "RET", label_drop_nulls=True)
+
+
+def test_linear_stats_add_drop_matches_full(make_panel):
+    fm = _fm(make_panel)
+    d = fm.dates
+    # 先加[0, 40)，再加[40, 60)，扣除[0, 20)，应等于直接累加[20, 60)
+    stats = LinearStats(len(fm.columns), block_rows=100)
+    stats.update(*fm.get_XyOther(d[0], d[39])[:2])
+    stats.update(*fm.get_XyOther(d[40], d[59])[:2])
+    stats.update(*fm.get_XyOther(d[0], d[19])[:2], sign=-1)
+
+    full = LinearStats(len(fm.columns)).update(*fm.get_XyOther(d[20], d[59])[:2])
+    assert stats.n == full.n
+    np.testing.assert_allclose(stats.sxx, full.sxx, rtol=1e-10, atol=1e-8)
+    np.testing.assert_allclose(stats.sxy, full.sxy, rtol=1e-10, atol=1e-8)
+    for a, b in zip(stats.solve(), full.solve()):
+        np.testing.assert_allclose(a, b, atol=1e-10)
+
+
+@pytest.mark.parametrize("max_train_size,alpha", [(None, 0.0), (30, 0.0), (30, 5.0)])
+def test_fit_incremental_matches_full_refit(make_panel, max_train_size, alpha):
+    fm = _fm(make_panel)
+
+    def fit_fold(fm, i, train_dt, test_dt, init_model=None, drop_dt=None):
+        X, y, _ = fm.get_XyOther(*train_dt)
+        drop = None if drop_dt is None else fm.get_XyOther(*drop_dt)[:2]
+        return fit_linear(X, y, fm.columns, init_model=init_model, drop=drop, alpha=alpha)
+
+    folds = list(walk_forward(fm.trading_dates(), n_splits=4, max_train_size=max_train_size, test_size=10, gap=3))
+    models = fit_incremental(fit_fold, fm, folds)
+
+    for model, (i, train_dt, test_dt) in zip(models, folds):
+        # 同一训练窗口从头训练
+        X, y, _ = fm.get_XyOther(*train_dt)
+        ref = (Ridge(alpha=alpha) if alpha > 0 else LinearRegression()).fit(X.astype(np.float64), y)
+        assert model.stats_.n == len(y)
+        np.testing.assert_allclose(model.coef_, ref.coef_, atol=1e-8)
+        np.testing.assert_allclose(model.intercept_, ref.intercept_, atol=1e-8)
@@ -0,0 +1,82 @@
+import time
+from datetime import datetime
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+
+from ml_cs.pool import fit_folds
+from ml_cs.utils import FeatureMatrix, get_XyOther, get_XyOther_numpy, lgb_dataset, walk_forward
+
+
+def _df(make_panel, n_dates=60, n_assets=12, seed=0):
+    rng = np.random.default_rng(seed)
+    n = n_dates * n_assets
+    F = rng.standard_normal((n, 3))
+    # 列顺序与排序后不同
+    df = make_panel(n_dates, n_assets, F2=F[:, 2], F0=F[:, 0], F1=F[:, 1],
+                    LABEL=F @ [1.0, -0.5, 0.2] + rng.standard_normal(n) * 0.1, RET=rng.standard_normal(n))
+    # 特征与标签有零星空值，打乱行序
+    return df.with_columns(
+        pl.when(pl.int_range(pl.len()) % 17 == 3).then(None).otherwise(pl.col("F1")).alias("F1"),
+        pl.when(pl.int_range(pl.len()) % 13 == 5).then(None).otherwise(pl.col("LABEL")).alias("LABEL"),
+    ).sample(fraction=1.0, shuffle=True, seed=seed)
+
+
+def _fit(fm, i, train_dt, test_dt):
+    # 前面的折故意慢，完成顺序与折的顺序相反
+    time.sleep(0.3 / (i + 1))
+    X, y, other = fm.get_XyOther(*train_dt)
+    return i, len(y), float(X.sum()), float(y.sum())
+
+
+def test_fit_folds_keeps_fold_order(make_panel):
+    fm = FeatureMatrix(_df(make_panel), "date", "asset", "LABEL", "RET", label_drop_nulls=True)
+    folds = list(walk_forward(fm.trading_dates(), n_splits=4, test_size=5))
+    expected = fit_folds(_fit, fm, folds, n_jobs=1)
+    assert [m[0] for m in expected] == [i for i, train_dt, test_dt in folds]
+
+    # 结果按折的顺序，与逐折训练一致，临时保存的特征矩阵不留给下次复用
+    assert fit_folds(_fit, fm, folds, n_jobs=2, n_threads=1) == expected
+    assert fm.path is None
+
+
+@pytest.mark.parametrize("label_drop_nulls", [True, False])
+@pytest.mark.parametrize("block_rows", [50, 2 ** 18])
+def test_get_XyOther_numpy_matches_pandas(make_panel, label_drop_nulls, block_rows):
+    df = _df(make_panel)
+    start, end = datetime(2021, 1, 5), datetime(2021, 2, 20)
+    X_pd, y_pd, other_pd = get_XyOther(df, start, end, "date", "asset", "LABEL", "RET", label_drop_nulls=label_drop_nulls)
+    X, y, other, columns = get_XyOther_numpy(df, start, end, "date", "asset", "LABEL", "RET",
+                                             label_drop_nulls=label_drop_nulls, block_rows=block_rows)
+
+    # 旧接口不排序行，按复合索引排序后逐行对齐
+    X_pd, y_pd = X_pd.sort_index(), y_pd.sort_index()
+    assert columns == list(X_pd.columns) == ["F0", "F1", "F2"]
+    assert X.dtype == np.float32 and X.flags.c_contiguous
+    np.testing.assert_array_equal(X, X_pd.to_numpy().astype(np.float32))
+    np.testing.assert_array_equal(y, y_pd["LABEL"].to_numpy())
+    assert np.isnan(y).any() != label_drop_nulls
+    pd.testing.assert_index_equal(pd.MultiIndex.from_arrays([other["date"].to_pandas(), other["asset"].to_pandas()]),
+                                  X_pd.index, check_names=False)
+    assert other.sort("date", "asset").equals(other_pd.sort("date", "asset"))
+
+
+def test_lgb_dataset_with_and_without_init_model(make_panel):
+    X, y, other, columns = get_XyOther_numpy(_df(make_panel), None, None, "date", "asset", "LABEL", "RET", label_drop_nulls=True)
+    params = {"objective": "regression", "max_bin": 31, "num_leaves": 7, "verbose": -1}
+
+    # 不继续训练时立即分箱，释放原始数据
+    ds = lgb_dataset(X, y, params, feature_name=columns)
+    assert ds._handle is not None and ds.data is None
+    model = lgb.train(params, ds, num_boost_round=5)
+    assert model.feature_name() == columns
+
+    # 继续训练时不提前分箱，lightgbm要用原始数据算初始分数
+    ds = lgb_dataset(X, y, params, init_model=model, feature_name=columns)
+    assert ds._handle is None
+    model2 = lgb.train(params, ds, num_boost_round=5, init_model=model)
+    assert model2.num_trees() == 10
+    np.testing.assert_allclose(model2.predict(X, num_iteration=5), model.predict(X))
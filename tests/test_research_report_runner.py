@@ -0,0 +1,38 @@
+import numpy as np
+
+from research.report_runner import auto_jobs, run_reports
+
+
+def _df(make_panel, n_dates=40, n_assets=30, seed=0):
+    rng = np.random.default_rng(seed)
+    n = n_dates * n_assets
+    ret = rng.standard_normal(n) * 0.01
+    return make_panel(n_dates, n_assets,
+                      FWD_RET=ret,
+                      F0=ret + rng.standard_normal(n) * 0.01,
+                      F1=rng.standard_normal(n),
+                      F2=-ret + rng.standard_normal(n) * 0.02,
+                      # 报表用不到的列不读取
+                      UNUSED=rng.standard_normal(n))
+
+
+def test_run_reports_two_jobs(make_panel, tmp_path):
+    path = tmp_path / "data.parquet"
+    _df(make_panel).write_parquet(path)
+    output = tmp_path / "output"
+
+    elapsed = run_reports(path, {"r1": ["F0", "F1"], "r2": ["F2"]}, output,
+                          fwd_ret_1="FWD_RET", quantiles=3, n_jobs=2, n_threads=1, axvlines=("2021-01-20",))
+
+    assert set(elapsed) == {"r1", "r2"}
+    assert all(t > 0 for t in elapsed.values())
+    for name, factors in (("r1", ["F0", "F1"]), ("r2", ["F2"])):
+        html = (output / f"{name}.html").read_text(encoding="utf-8")
+        assert all(f in html for f in factors)
+    assert sorted(p.name for p in output.iterdir()) == ["r1.html", "r2.html"]
+
+
+def test_auto_jobs():
+    # 进程数不超过报表数，指定时不自动调整
+    assert auto_jobs(1, 1)[0] == 1
+    assert auto_jobs(10, 1, n_jobs=3, n_threads=2) == (3, 2)
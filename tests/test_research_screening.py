@@ -0,0 +1,90 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+
+from research.screening import corr_matrix, cs_corr_matrix, greedy_prune
+
+
+def _ic(n_rows=200, n_columns=30, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.standard_normal((n_rows, 1))
+    x = base * rng.uniform(-1, 1, n_columns) + rng.standard_normal((n_rows, n_columns))
+    # 各列缺失位置不同，按成对有效样本计算
+    x[rng.random(x.shape) < 0.1] = np.nan
+    return x
+
+
+@pytest.mark.parametrize("dtype,atol", [(np.float64, 1e-12), (np.float32, 1e-5)])
+def test_corr_matrix_matches_pandas(dtype, atol):
+    x = _ic()
+    # 块大小不整除列数，覆盖对角块与非对角块
+    corr = corr_matrix(x, block=7, dtype=dtype)
+    assert corr.dtype == dtype
+    np.testing.assert_allclose(corr, pd.DataFrame(x).corr().to_numpy(), atol=atol)
+
+
+def test_corr_matrix_without_nan():
+    x = np.nan_to_num(_ic())
+    np.testing.assert_allclose(corr_matrix(x, dtype=np.float64), np.corrcoef(x, rowvar=False), atol=1e-12)
+
+
+def _df(make_panel, n_dates=15, n_assets=40, seed=0):
+    rng = np.random.default_rng(seed)
+    n = n_dates * n_assets
+    base = rng.standard_normal(n)
+    df = make_panel(n_dates, n_assets,
+                    F0=base + rng.standard_normal(n),
+                    F1=base * 2 + rng.standard_normal(n),
+                    F2=rng.standard_normal(n))
+    # 某日F2为常数，该日不参与F2相关的平均
+    return df.with_columns(
+        pl.when(pl.Series(rng.random(n) < 0.1)).then(None).otherwise(pl.col("F1")).alias("F1"),
+        pl.when(pl.col("date") == datetime(2021, 1, 2)).then(1.0).otherwise(pl.col("F2")).alias("F2"),
+    ).sample(fraction=1.0, shuffle=True, seed=seed)
+
+
+@pytest.mark.parametrize("chunk", [1, 4, 100])
+def test_cs_corr_matrix_matches_pandas(make_panel, chunk):
+    df = _df(make_panel)
+    factors = ["F0", "F1", "F2"]
+    corr = cs_corr_matrix(df, factors, rank=False, chunk=chunk, dtype=np.float64)
+
+    # 逐日pandas相关系数，再忽略nan求均值
+    daily = [g[factors].corr().to_numpy() for _, g in df.to_pandas().groupby("date")]
+    np.testing.assert_allclose(corr, np.nanmean(daily, axis=0), atol=1e-12)
+
+
+def test_cs_corr_matrix_rank(make_panel):
+    df = _df(make_panel)
+    factors = ["F0", "F1", "F2"]
+    corr = cs_corr_matrix(df, factors, rank=True, dtype=np.float64)
+
+    # 先截面排名再Pearson，即无缺失时的Spearman
+    ranked = df.with_columns(pl.col(factors).rank().over("date"))
+    np.testing.assert_allclose(corr, cs_corr_matrix(ranked, factors, rank=False, dtype=np.float64), atol=1e-12)
+    np.testing.assert_allclose(np.diag(corr), 1.0)
+
+
+def test_greedy_prune():
+    names = ["A", "B", "C", "D"]
+    corr = np.array([
+        [1.0, 0.9, 0.1, 0.85],
+        [0.9, 1.0, 0.95, 0.2],
+        [0.1, 0.95, 1.0, 0.1],
+        [0.85, 0.2, 0.1, 1.0],
+    ])
+    # B得分最高保留，剔除A、C；D与A高度相关，但A已被剔除，D保留
+    cols_to_drop, pairs = greedy_prune(corr, names, [0.5, 0.6, 0.3, 0.2], thresh=0.8)
+    assert cols_to_drop == ["A", "C"]
+    assert pairs == [("A", "B", 0.9), ("C", "B", 0.95)]
+
+    # 负相关按绝对值比较，nan得分排在最后
+    cols_to_drop, pairs = greedy_prune(-corr, names, [np.nan, 0.6, 0.3, 0.2], thresh=0.8)
+    assert cols_to_drop == ["A", "C"]
+    assert pairs == [("A", "B", -0.9), ("C", "B", -0.95)]
+
+    cols_to_drop, _ = greedy_prune(corr, names, [0.9, 0.1, 0.3, 0.2], thresh=0.8)
+    assert cols_to_drop == ["B", "D"]